@@ -1,19 +1,27 @@
+import json
 import os
 import shutil
 import uuid
+from contextlib import asynccontextmanager
 
 import uvicorn
 
 from fastapi import FastAPI, File, UploadFile, HTTPException
-from starlette.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
 
-from backend.src.chain import get_chain
-from backend.src.chunking import load_and_chunk
+from backend.src.answer_cache import cache_namespace, get_answer_cache
+from backend.src.chain import get_chain, retrieval_flight
+from backend.src.chat_memory import aadd_turn, get_history_messages
 from backend.src.database_utils import get_all_documents, insert_document_record, delete_document_record, \
-    get_chat_history, insert_application_logs
-from backend.src.pydantic_models import QueryResponse, QueryInput, DeleteFileRequest, DocumentInfo
-from backend.src.retriever import index_document_to_faiss, delete_doc_from_faiss
+    insert_application_logs, stop_log_writer
+from backend.src.jobs import JobQueueFull, cancel_job, get_job, interactive_request, list_jobs, submit_ingestion_job
+from backend.src import metrics
+from backend.src.metrics import MetricsMiddleware, span
+from backend.src.profiling import ProfilingMiddleware, configure_profiling, profiling_enabled
+from backend.src.pydantic_models import QueryResponse, QueryInput, DeleteFileRequest, DocumentInfo, JobInfo
+from backend.src.retriever import delete_doc_from_faiss, get_corpus_version, get_vector_store
 
 from dotenv import load_dotenv
 import logging
@@ -21,64 +29,236 @@ import logging
 
 # Start logging
 logging.basicConfig(filename="app.log", level=logging.INFO)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # write the application logs still queued before exiting
+    await run_in_threadpool(stop_log_writer)
+
+
 # Initialize FastAPI app
-app = FastAPI(title="RAG Chatbot Insurance Company")
+app = FastAPI(title="RAG Chatbot Insurance Company", lifespan=lifespan)
+# request latencies and stage timings for /metrics, and the Server-Timing header
+app.add_middleware(MetricsMiddleware)
+# the profiling settings come from the environment and .env
+load_dotenv()
+configure_profiling()
+if profiling_enabled():
+    # statistical profiles of single requests, see profiling
+    app.add_middleware(ProfilingMiddleware)
+
+
+class ChatRequest:
+    """
+    The steps of /chat and /chat/stream around the answer of the chain: before it, the history of
+    the session and the answer cache lookup; after it, the answer cache, the application logs and
+    the session memory. Both endpoints run them inside interactive_request(), so that the ingestion
+    jobs give way to the whole request.
+    """
+
+    def __init__(self, query_input: QueryInput):
+        self.query_input = query_input
+        self.question = query_input.question
+        self.model = query_input.model.value
+        # Generate session_id if not provided
+        self.session_id = query_input.session_id or str(uuid.uuid4())
+        # metadata filters restrict the vector search to the matching chunks
+        self.search_filter = query_input.filters.to_filter() if query_input.filters else None
+        self.chat_history = []
+        # the answer found in the cache, None when the chain has to answer
+        self.cached_answer = None
+        self._question_vector = None
+        self._namespace = cache_namespace(self.model, self.search_filter)
+        self._corpus_version = None
+
+    async def prepare(self) -> None:
+        """
+        Reads the history of the session and looks the question up in the answer cache.
+        :return: None
+        """
+        # get the summary and the last turns of the session that fit the history token budget
+        # (sqlite is blocking, so run it in the threadpool to keep the event loop free)
+        with span("history"):
+            self.chat_history = await run_in_threadpool(get_history_messages, self.session_id)
+
+        # the same or a near-duplicate question on the same corpus version is answered from the cache,
+        # unless it is a follow-up, whose answer depends on the history
+        self._corpus_version = get_corpus_version()
+        if not self.chat_history:
+            with span("answer_cache"):
+                self.cached_answer, self._question_vector = await get_answer_cache().aget(
+                    self._namespace, self.question, get_vector_store().embedding_function, self._corpus_version)
+
+    def chain(self):
+        """
+        :return: The chain created using langchain, for the model and filters of the request.
+        """
+        return get_chain(self.model, filter=self.search_filter)
+
+    def chain_inputs(self) -> dict:
+        return {"input": self.question, "chat_history": self.chat_history}
+
+    async def finish(self, answer: str) -> None:
+        """
+        Caches a new answer, logs the turn and adds it to the session memory.
+        :param answer: The answer sent to the user.
+        :return: None
+        """
+        if self.cached_answer is None and self._question_vector is not None:
+            get_answer_cache().put(self._namespace, self.question, self._question_vector, answer,
+                                   self._corpus_version)
+        # insert application logs into embedded database (queued, written in the background)
+        with span("log"):
+            turn_id = insert_application_logs(session_id=self.session_id, user_query=self.question,
+                                              model_response=answer, model=self.model)
+        with span("memory"):
+            await aadd_turn(self.session_id, turn_id, self.question, answer)
+        logging.info(f"Session ID: {self.session_id}, Chat Response: {answer}")
 
 
 @app.post("/chat", response_model=QueryResponse)
 async def chat(query_input: QueryInput) -> QueryResponse:
-    # Generate session_id if not provided
-    session_id = query_input.session_id or str(uuid.uuid4())
-    logging.info(f"Session ID: {session_id}, User Query: {query_input.question}")
+    request = ChatRequest(query_input)
+    logging.info(f"Session ID: {request.session_id}, User Query: {request.question}")
 
-    # get chat history
-    chat_history = get_chat_history(session_id)
+    # chat requests in flight hold the ingestion jobs back between batches
+    with interactive_request():
+        await request.prepare()
+        answer = request.cached_answer
+        if answer is None:
+            # get answer using the async path of the chain (async embeddings, retrieval and llm calls)
+            with span("chain"):
+                result = await request.chain().ainvoke(request.chain_inputs())
+            answer = result["answer"]
+        await request.finish(answer)
 
-    # get the chain created using langchain
-    rag_chain = get_chain(query_input.model.value)
-    # get answer
-    answer = rag_chain.invoke({"input": query_input.question,
-                               "chat_history": chat_history})["answer"]
-    # insert application logs into embedded database
-    insert_application_logs(session_id=session_id, user_query=query_input.question,
-                            model_response=answer, model= query_input.model.value )
+    return QueryResponse(answer=answer, session_id=request.session_id, model=query_input.model)
 
-    logging.info(f"Session ID: {session_id}, Chat Response: {answer}")
 
-    return QueryResponse(answer=answer, session_id=session_id, model=query_input.model)
+def format_sse(data: dict, event: str = None) -> str:
+    """
+    Formats a payload as a server-sent event.
+    :param data: JSON serializable payload sent in the data field.
+    :param event: Optional event name. Token events are sent without a name.
+    :return: The encoded event.
+    """
+    message = f"data: {json.dumps(data)}\n\n"
+    if event is not None:
+        message = f"event: {event}\n" + message
+    return message
+
+
+@app.post("/chat/stream")
+async def chat_stream(query_input: QueryInput) -> StreamingResponse:
+    """
+    Streaming variant of /chat. Sends the answer tokens as server-sent events as soon as
+    the LLM emits them, followed by an "end" event with the session id.
+    The full answer is logged to app_logs once the stream completes.
+    :param query_input:
+    :return:
+    """
+    request = ChatRequest(query_input)
+    logging.info(f"Session ID: {request.session_id}, User Query (stream): {request.question}")
 
+    async def event_stream():
+        # the ingestion jobs are held back while the answer is prepared and streams
+        with interactive_request():
+            try:
+                await request.prepare()
+                if request.cached_answer is not None:
+                    # a cached answer is sent as a single token
+                    answer_parts = [request.cached_answer]
+                    yield format_sse({"token": request.cached_answer})
+                else:
+                    answer_parts = []
+                    # the retrieval chain streams the context first and then the answer token by token
+                    with span("chain"):
+                        async for chunk in request.chain().astream(request.chain_inputs()):
+                            token = chunk.get("answer")
+                            if token:
+                                answer_parts.append(token)
+                                yield format_sse({"token": token})
+            except Exception as e:
+                logging.error(f"Session ID: {request.session_id}, Error while streaming the answer: {e}")
+                yield format_sse({"detail": "Error while generating the answer."}, event="error")
+                return
+            await request.finish("".join(answer_parts))
 
-@app.post("/upload-doc")
+        yield format_sse({"session_id": request.session_id, "model": request.model}, event="end")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Session-ID": request.session_id})
+
+
+@app.post("/upload-doc", status_code=202)
 async def upload_documents(file: UploadFile=File(...)):
     """
     Endpoint to upload a document (e.g., CSV).
-    Processes and adds the documents to FAISS
+    Saves the file and queues a job that adds it to FAISS, whose progress is reported by /jobs/{job_id}
     :param file:
     :return:
     """
-    temp_file_path = f"temp_{file.filename}"
+    # a unique name, the file is kept until its job finishes
+    temp_file_path = f"temp_{uuid.uuid4().hex}_{file.filename}"
+
+    # the upload is copied to disk in blocks, never held in memory as a whole
+    with span("save_upload"), open(temp_file_path, "wb") as buffer:
+        await run_in_threadpool(shutil.copyfileobj, file.file, buffer)
 
+    # insert document into database (sqlite is blocking, so run it in the threadpool)
+    with span("db_insert"):
+        file_id = await run_in_threadpool(insert_document_record, file.filename)
     try:
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # insert document into database
-        file_id = insert_document_record(file.filename)
-        # Load and chunk the data
-        chunks = load_and_chunk(file_path=temp_file_path, chunk_size=1000, chunk_overlap=200)
-        # Add chunks to FAISS
-        success = index_document_to_faiss(chunks, file_id)
-
-        if success:
-            return JSONResponse(
-                content={"message": f"File {file.filename} has been successfully uploaded and indexed."},
-                status_code=200)
-        else:
-            delete_document_record(file_id)
-            raise  HTTPException(status_code=500, detail=f"Error processing file: {file.filename}")
-    finally:
-        # Clean up the temporary file
+        # the job reads, chunks and indexes the rows in batches, and rolls the file back if it fails
+        with span("submit_job"):
+            job = submit_ingestion_job(file.filename, temp_file_path, file_id)
+    except JobQueueFull as e:
+        await run_in_threadpool(delete_document_record, file_id)
         os.remove(temp_file_path)
+        raise HTTPException(status_code=503, detail=f"Too many files waiting to be indexed, retry later: {e}")
+
+    return JSONResponse(
+        content={"message": f"File {file.filename} has been uploaded and queued for indexing.",
+                 "job_id": job.job_id, "file_id": file_id},
+        status_code=202)
+
+
+@app.get("/jobs", response_model=list[JobInfo])
+async def list_ingestion_jobs():
+    """
+    endpoint to list the ingestion jobs queued, running and recently finished
+    :return:
+    """
+    return [JobInfo(**job.to_dict()) for job in list_jobs()]
+
+
+@app.get("/jobs/{job_id}", response_model=JobInfo)
+async def get_ingestion_job(job_id: str):
+    """
+    endpoint with the status and progress (rows, chunks and vectors done) of an ingestion job
+    :param job_id:
+    :return:
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return JobInfo(**job.to_dict())
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=JobInfo)
+async def cancel_ingestion_job(job_id: str):
+    """
+    endpoint to cancel an ingestion job, a running job stops after its current batch and the
+    chunks already indexed are removed
+    :param job_id:
+    :return:
+    """
+    job = await run_in_threadpool(cancel_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return JobInfo(**job.to_dict())
 
 
 @app.get("/list-documents", response_model=list[DocumentInfo])
@@ -87,7 +267,7 @@ async def list_documents():
     endpoint to list the documents added to the RAG
     :return:
     """
-    return get_all_documents()
+    return await run_in_threadpool(get_all_documents)
 
 
 @app.post("/delete-doc")
@@ -95,8 +275,9 @@ async def delete_document(request:DeleteFileRequest):
     # Get file_id
     file_id = request.file_id
 
-    # Delete from FAISS
-    delete_success_faiss = delete_doc_from_faiss(file_id=file_id)
+    # Delete from FAISS, in the threadpool: it waits for the store lock, which an ingestion batch holds
+    with span("faiss_delete"):
+        delete_success_faiss = await run_in_threadpool(delete_doc_from_faiss, file_id=file_id)
     if not delete_success_faiss:
         # Return error if FAISS deletion fails
         raise HTTPException(
@@ -105,7 +286,8 @@ async def delete_document(request:DeleteFileRequest):
         )
 
     # Delete from Database
-    deleted_from_db = delete_document_record(request.file_id)
+    with span("db_delete"):
+        deleted_from_db = await run_in_threadpool(delete_document_record, request.file_id)
     if not deleted_from_db:
         # Return error if database deletion fails after FAISS deletion
         raise HTTPException(
@@ -121,6 +303,51 @@ async def delete_document(request:DeleteFileRequest):
         status_code=200
     )
 
+def get_cache_stats() -> dict:
+    # counters of the answer, query embedding and retrieval caches
+    answer_cache = get_answer_cache()
+    embeddings = get_vector_store().embedding_function
+    return {
+        "answers": {"hits": answer_cache.hits, "misses": answer_cache.misses, "size": len(answer_cache)},
+        "query_embeddings": embeddings.stats() if hasattr(embeddings, "stats") else {},
+        "retrieval": {"coalesced": retrieval_flight.coalesced, "in_flight": len(retrieval_flight)},
+    }
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    """
+    endpoint with the hit and coalescing counters of the answer, query embedding and retrieval caches
+    :return:
+    """
+    return get_cache_stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    endpoint with the request and stage latency histograms, token counts, cache counters and index size,
+    in the Prometheus text format
+    :return:
+    """
+    stats = get_cache_stats()
+    for cache in ("answers", "query_embeddings"):
+        hits, misses = stats[cache].get("hits", 0), stats[cache].get("misses", 0)
+        metrics.CACHE_HITS.set(hits, cache)
+        metrics.CACHE_MISSES.set(misses, cache)
+        metrics.CACHE_HIT_RATIO.set(hits / (hits + misses) if hits + misses else 0.0, cache)
+        metrics.CACHE_ENTRIES.set(stats[cache].get("size", 0), cache)
+    metrics.RETRIEVALS_COALESCED.set(stats["retrieval"]["coalesced"])
+
+    index = get_vector_store().index
+    metrics.INDEX_VECTORS.set(index.ntotal)
+    metrics.INDEX_SHARDS.set(len(index.shards) if hasattr(index, "shards") else 1)
+    jobs = list_jobs()
+    for status in ("queued", "running", "succeeded", "failed", "cancelled"):
+        metrics.INGESTION_JOBS.set(sum(job.status == status for job in jobs), status)
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the RAG Chatbot for MDS Insurance Company API"}
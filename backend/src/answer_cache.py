@@ -0,0 +1,206 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Maximum number of answers kept before evicting the least recently used
+ANSWER_CACHE_MAX_ENTRIES = 1_000
+# Seconds an answer is served from the cache
+ANSWER_CACHE_TTL = 3600
+# Minimum cosine similarity between two questions for them to share an answer
+ANSWER_CACHE_SIMILARITY = 0.95
+
+_answer_cache = None
+
+
+def _normalize_question(question: str) -> str:
+    # questions differing only by case and spacing are the same question
+    return " ".join(question.lower().split())
+
+
+def cache_namespace(model: str, search_filter: Optional[dict] = None) -> str:
+    """
+    Answers are only shared between questions asked with the same model and the same filter.
+    :param model: The name of the chat model.
+    :param search_filter: The metadata filter of the retriever, if any.
+    :return: The namespace of the answers.
+    """
+    return json.dumps([model, search_filter], sort_keys=True, default=str)
+
+
+class SemanticAnswerCache:
+    """
+    In-memory cache of chat answers keyed by the embedding of the question.
+
+    A question gets a cached answer when it is the same text as a cached question, without
+    embedding it, or when its embedding has a cosine similarity of at least similarity_threshold
+    with one. The normalized embeddings live in one matrix, so a lookup is a single matrix-vector
+    product over the cache. Answers expire after ttl seconds, the least recently used ones are
+    evicted beyond max_entries, and all of them are dropped when the corpus version changes.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl=ANSWER_CACHE_TTL,
+                 similarity_threshold=ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._version = None
+        # slot -> (exact key, answer), least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self._exact = {}
+        self._namespace_ids = {}
+        # per slot: normalized question vector, namespace id (-1 when free) and expiry time
+        self._vectors = None
+        self._slot_namespaces = np.full(max_entries, -1, dtype=np.int64)
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self) -> None:
+        """
+        Drops all the answers.
+        :return: None
+        """
+        with self._lock:
+            self._clear_locked()
+
+    def _clear_locked(self):
+        self._entries.clear()
+        self._exact.clear()
+        self._namespace_ids.clear()
+        self._slot_namespaces.fill(-1)
+
+    def _check_version(self, version) -> bool:
+        # answers of older versions are dropped, answers computed on an older version are not stored
+        if self._version is None or version > self._version:
+            self._clear_locked()
+            self._version = version
+        return version == self._version
+
+    def _remove_locked(self, slot):
+        exact_key, _ = self._entries.pop(slot)
+        self._exact.pop(exact_key, None)
+        self._slot_namespaces[slot] = -1
+
+    def _hit_locked(self, slot) -> str:
+        self._entries.move_to_end(slot)
+        self.hits += 1
+        return self._entries[slot][1]
+
+    def get_exact(self, namespace: str, question: str, version: int) -> Optional[str]:
+        """
+        Looks a question up by its text.
+        :param namespace: The namespace of the answer, see cache_namespace.
+        :param question: The question.
+        :param version: The current corpus version.
+        :return: The cached answer, or None.
+        """
+        with self._lock:
+            if not self._check_version(version):
+                return None
+            slot = self._exact.get((namespace, _normalize_question(question)))
+            if slot is None:
+                return None
+            if self._expires[slot] <= time.time():
+                self._remove_locked(slot)
+                return None
+            return self._hit_locked(slot)
+
+    def get_similar(self, namespace: str, vector: List[float], version: int) -> Optional[str]:
+        """
+        Looks a question up by its embedding.
+        :param namespace: The namespace of the answer, see cache_namespace.
+        :param vector: The embedding of the question.
+        :param version: The current corpus version.
+        :return: The answer of the most similar cached question above the threshold, or None.
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            namespace_id = self._namespace_ids.get(namespace)
+            if not self._check_version(version) or namespace_id is None or self._vectors is None:
+                self.misses += 1
+                return None
+            # one product over the whole matrix, the other namespaces and the expired answers are masked
+            similarities = self._vectors @ query
+            valid = (self._slot_namespaces == namespace_id) & (self._expires > time.time())
+            similarities[~valid] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                return self._hit_locked(best)
+            self.misses += 1
+            return None
+
+    async def aget(self, namespace: str, question: str, embeddings, version: int) -> Tuple[Optional[str], List[float]]:
+        """
+        Looks a question up by its text, then by its embedding.
+        :param namespace: The namespace of the answer, see cache_namespace.
+        :param question: The question.
+        :param embeddings: The embedding model of the retriever, so the vector is reused by the retrieval.
+        :param version: The current corpus version.
+        :return: A tuple (cached answer or None, embedding of the question or None on exact hits).
+        """
+        answer = self.get_exact(namespace, question, version)
+        if answer is not None:
+            return answer, None
+        vector = await embeddings.aembed_query(question)
+        return self.get_similar(namespace, vector, version), vector
+
+    def put(self, namespace: str, question: str, vector: List[float], answer: str, version: int) -> None:
+        """
+        Stores the answer of a question.
+        :param namespace: The namespace of the answer, see cache_namespace.
+        :param question: The question.
+        :param vector: The embedding of the question.
+        :param answer: The answer.
+        :param version: The corpus version the answer was computed on.
+        :return: None
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        exact_key = (namespace, _normalize_question(question))
+        with self._lock:
+            if not self._check_version(version):
+                return
+            if exact_key in self._exact:
+                self._remove_locked(self._exact[exact_key])
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._clear_locked()
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+
+            now = time.time()
+            free = np.flatnonzero(self._slot_namespaces == -1)
+            if not len(free):
+                # expired answers go first, then the least recently used one
+                for slot in np.flatnonzero(self._expires <= now).tolist():
+                    self._remove_locked(slot)
+                if len(self._entries) >= self.max_entries:
+                    self._remove_locked(next(iter(self._entries)))
+                free = np.flatnonzero(self._slot_namespaces == -1)
+            slot = int(free[0])
+
+            namespace_id = self._namespace_ids.setdefault(namespace, len(self._namespace_ids))
+            self._vectors[slot] = vector
+            self._slot_namespaces[slot] = namespace_id
+            self._expires[slot] = now + self.ttl
+            self._entries[slot] = (exact_key, answer)
+            self._exact[exact_key] = slot
+
+
+def get_answer_cache():
+    """
+    Retrieves the global answer cache. Initializes it if it does not already exist.
+
+    :return: The global SemanticAnswerCache.
+    """
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = SemanticAnswerCache()
+    return _answer_cache
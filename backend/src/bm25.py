@@ -0,0 +1,177 @@
+import math
+import re
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# BM25 parameters (Lucene defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Deleted documents are purged from the postings once they are this fraction of all the documents
+PURGE_RATIO = 0.3
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased word tokens, so that names such as customer names match exactly.
+    :param text: The text.
+    :return: The tokens.
+    """
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    In-memory inverted index over the chunks, scored with BM25.
+
+    Documents are added and deleted incrementally. Every document gets a slot, and each term keeps
+    the slots and term frequencies of its postings in lists that are appended to and converted to
+    NumPy arrays on the first search after a change, so a search does one vectorized pass per query
+    term even for terms present in every chunk. Deleted slots are masked out, and purged from the
+    postings once they are PURGE_RATIO of the slots.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slot_of: Dict[str, int] = {}
+        self._doc_ids: List = []
+        self._doc_lengths: List[int] = []
+        self._postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        self._total_length = 0
+        self._deleted = 0
+        # NumPy views of the lists above, rebuilt after changes
+        self._term_arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._alive = None
+        self._lengths = None
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._slot_of
+
+    def ids(self):
+        """
+        :return: The ids of the indexed documents.
+        """
+        with self._lock:
+            return set(self._slot_of)
+
+    def add(self, ids: Iterable[str], texts: Iterable[str]) -> None:
+        """
+        Indexes documents. Ids already indexed are re-indexed.
+        :param ids: The docstore ids.
+        :param texts: The texts, in the order of the ids.
+        :return: None
+        """
+        with self._lock:
+            for doc_id, text in zip(ids, texts):
+                if doc_id in self._slot_of:
+                    self._delete_locked(doc_id)
+                tokens = tokenize(text)
+                slot = len(self._doc_ids)
+                self._slot_of[doc_id] = slot
+                self._doc_ids.append(doc_id)
+                self._doc_lengths.append(len(tokens))
+                self._total_length += len(tokens)
+                for term, frequency in Counter(tokens).items():
+                    slots, frequencies = self._postings.setdefault(term, ([], []))
+                    slots.append(slot)
+                    frequencies.append(frequency)
+                    self._term_arrays.pop(term, None)
+            self._alive = None
+
+    def _delete_locked(self, doc_id):
+        slot = self._slot_of.pop(doc_id)
+        self._doc_ids[slot] = None
+        self._total_length -= self._doc_lengths[slot]
+        self._deleted += 1
+
+    def delete(self, ids: Iterable[str]) -> None:
+        """
+        Removes documents. Unknown ids are ignored.
+        :param ids: The docstore ids.
+        :return: None
+        """
+        with self._lock:
+            for doc_id in ids:
+                if doc_id in self._slot_of:
+                    self._delete_locked(doc_id)
+            self._alive = None
+            if self._deleted > PURGE_RATIO * len(self._doc_ids):
+                self._purge_locked()
+
+    def _purge_locked(self):
+        # renumber the live slots and drop the postings of the deleted ones
+        alive = np.array([doc_id is not None for doc_id in self._doc_ids], dtype=bool)
+        new_slot = np.cumsum(alive) - 1
+        postings = {}
+        for term, (slots, frequencies) in self._postings.items():
+            slots, frequencies = np.asarray(slots), np.asarray(frequencies)
+            keep = alive[slots]
+            if keep.any():
+                postings[term] = (new_slot[slots[keep]].tolist(), frequencies[keep].tolist())
+        self._postings = postings
+        self._doc_ids = [doc_id for doc_id in self._doc_ids if doc_id is not None]
+        self._doc_lengths = [length for length, kept in zip(self._doc_lengths, alive) if kept]
+        self._slot_of = {doc_id: slot for slot, doc_id in enumerate(self._doc_ids)}
+        self._deleted = 0
+        self._term_arrays = {}
+        self._alive = None
+
+    def search(self, query: str, k: int = 4,
+               allowed: Optional[Callable[[str], bool]] = None) -> List[Tuple[str, float]]:
+        """
+        Scores the documents containing any term of the query with BM25.
+        :param query: The query text.
+        :param k: Number of documents to return.
+        :param allowed: Optional predicate on docstore ids, documents it rejects are skipped.
+        :return: Up to k (docstore id, score) pairs, best first.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            num_docs = len(self._slot_of)
+            if not num_docs or not terms:
+                return []
+            if self._alive is None:
+                self._alive = np.array([doc_id is not None for doc_id in self._doc_ids], dtype=bool)
+                self._lengths = np.array(self._doc_lengths, dtype=np.float32)
+            average_length = self._total_length / num_docs
+
+            scores = np.zeros(len(self._doc_ids), dtype=np.float32)
+            for term in terms:
+                if term not in self._postings:
+                    continue
+                if term not in self._term_arrays:
+                    slots, frequencies = self._postings[term]
+                    self._term_arrays[term] = (np.array(slots, dtype=np.int64),
+                                               np.array(frequencies, dtype=np.float32))
+                slots, frequencies = self._term_arrays[term]
+                alive = self._alive[slots]
+                slots, frequencies = slots[alive], frequencies[alive]
+                if not len(slots):
+                    continue
+                idf = math.log(1 + (num_docs - len(slots) + 0.5) / (len(slots) + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[slots] / average_length)
+                scores[slots] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+
+            matched = np.flatnonzero(scores)
+            doc_ids = self._doc_ids
+
+        # rank the best candidates first, and more of them while the predicate rejects too many
+        top = k
+        while True:
+            candidates = matched
+            if len(matched) > top:
+                candidates = matched[np.argpartition(-scores[matched], top - 1)[:top]]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            # a slot may have been deleted since the scoring
+            results = [(doc_ids[slot], float(scores[slot])) for slot in candidates
+                       if doc_ids[slot] is not None and (allowed is None or allowed(doc_ids[slot]))]
+            if len(results) >= k or len(candidates) == len(matched):
+                return results[:k]
+            top *= 4
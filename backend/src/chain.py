@@ -1,15 +1,41 @@
+import json
+import threading
+import time
+
+import httpx
+from openai import DefaultHttpxClient, DefaultAsyncHttpxClient
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
 from langchain_core.output_parsers import StrOutputParser
+from backend.src.context_packing import PackedContextRetriever
+from backend.src.metrics import LLM_TOKENS, record
 from backend.src.retriever import get_vector_store, get_retriever
+from backend.src.single_flight import CoalescingRetriever, SingleFlight
+
+# Default retriever settings used to build the chains
+RETRIEVER_SETTINGS = {"search_type": "mmr", "k": 5, "lambda_mult": 0.5}
+# Keep-alive connection pool shared by all the llm clients
+HTTP_POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
 
 # get vector store
 vector_store = get_vector_store()
 # create a retriever based in vector store
-retriever = get_retriever(vector_store, search_type='mmr', k=5 , lambda_mult=0.5)
+retriever = get_retriever(vector_store, **RETRIEVER_SETTINGS)
+
+# pooled http clients, created on first use
+_http_client = None
+_http_async_client = None
+# built chains keyed by model name and retriever settings
+_chain_registry = {}
+# llm + prompt chains keyed by model name, shared by the chains of every retriever
+_answer_chains = {}
+_registry_lock = threading.RLock()
+# concurrent identical questions to retrievers with the same settings share one retrieval
+retrieval_flight = SingleFlight()
 
 
 # Define the prompt for question answering
@@ -26,21 +52,129 @@ qa_prompt = ChatPromptTemplate.from_messages(
             If you don't know the answer, say you don't know.
             """,
         ),
+        # summary of the earlier turns and the last turns of the session, see chat_memory
+        MessagesPlaceholder("chat_history", optional=True),
         ("human", "{input}"),
     ]
 )
 
 
-def get_chain(model="gpt-4o-mini"):
+class LLMMetricsCallback(BaseCallbackHandler):
+    """
+    Records the duration of the llm calls of a model and the tokens they used, as reported by the API.
+    """
+    # cheap enough to run in the event loop, and the request timings are only visible there
+    run_inline = True
+
+    def __init__(self, model):
+        self.model = model
+        self._starts = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            record("llm", time.perf_counter() - start)
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        if usage:
+            LLM_TOKENS.inc(usage.get("input_tokens", 0), self.model, "prompt")
+            LLM_TOKENS.inc(usage.get("output_tokens", 0), self.model, "completion")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._starts.pop(run_id, None)
+
+
+def get_http_clients():
+    """
+    Returns the sync and async http clients shared by every llm, so that all the chains
+    reuse the same keep-alive connections to the OpenAI API.
+
+    :return: A tuple (http_client, http_async_client).
+    """
+    global _http_client, _http_async_client
+    if _http_client is None:
+        _http_client = DefaultHttpxClient(limits=HTTP_POOL_LIMITS)
+        _http_async_client = DefaultAsyncHttpxClient(limits=HTTP_POOL_LIMITS)
+    return _http_client, _http_async_client
+
 
-    # define the llm
-    llm = ChatOpenAI(temperature=0, model_name=model)
-    question_answer_chain = create_stuff_documents_chain(
-        llm=llm, prompt=qa_prompt, output_parser=StrOutputParser()
-    )
+def get_answer_chain(model):
+    """
+    Returns the chain that answers from the retrieved documents with a model, building it on first use.
 
-    chain = create_retrieval_chain(
-        retriever=retriever, combine_docs_chain=question_answer_chain
-    )
+    :param model: The name of the OpenAI chat model.
+    :return: The combine documents chain.
+    """
+    question_answer_chain = _answer_chains.get(model)
+    if question_answer_chain is None:
+        with _registry_lock:
+            question_answer_chain = _answer_chains.get(model)
+            if question_answer_chain is None:
+                http_client, http_async_client = get_http_clients()
+                # define the llm
+                # stream_usage: the streamed answers report their token usage too
+                llm = ChatOpenAI(temperature=0, model_name=model, http_client=http_client,
+                                 http_async_client=http_async_client, stream_usage=True,
+                                 callbacks=[LLMMetricsCallback(model)])
+                question_answer_chain = create_stuff_documents_chain(
+                    llm=llm, prompt=qa_prompt, output_parser=StrOutputParser()
+                )
+                _answer_chains[model] = question_answer_chain
+    return question_answer_chain
 
+
+def build_chain(model, retriever_settings):
+    """
+    Builds the retrieval chain for a model and a set of retriever settings.
+
+    :param model: The name of the OpenAI chat model.
+    :param retriever_settings: Keyword arguments forwarded to get_retriever.
+    :return: The retrieval chain.
+    """
+    retriever = CoalescingRetriever(retriever=get_retriever(vector_store, **retriever_settings),
+                                    flight=retrieval_flight,
+                                    namespace=json.dumps(retriever_settings, sort_keys=True, default=str))
+    # deduplicated chunks packed into the context token budget of the model
+    retriever = PackedContextRetriever(retriever=retriever, model=model)
+    chain = create_retrieval_chain(retriever=retriever, combine_docs_chain=get_answer_chain(model))
+
+    return chain
+
+
+def get_chain(model="gpt-4o-mini", **retriever_settings):
+    """
+    Returns the retrieval chain for a model from the chain registry, building it on first use.
+    A chain is rebuilt only when it is requested with a new model or new retriever settings.
+    Chains with a metadata filter are built for each request and not kept, since the filter comes
+    with the question; only their retriever is new, the llm chain is shared.
+
+    :param model: The name of the OpenAI chat model (a ModelName value).
+    :param retriever_settings: Optional overrides of RETRIEVER_SETTINGS, including a metadata filter.
+    :return: The retrieval chain.
+    """
+    settings = {**RETRIEVER_SETTINGS, **retriever_settings}
+    if settings.get("filter") is not None:
+        return build_chain(model, settings)
+    key = (model, tuple(sorted(settings.items())))
+
+    chain = _chain_registry.get(key)
+    if chain is None:
+        with _registry_lock:
+            # another request may have built it while waiting for the lock
+            chain = _chain_registry.get(key)
+            if chain is None:
+                chain = build_chain(model, settings)
+                _chain_registry[key] = chain
     return chain
+
+
+def clear_chain_registry():
+    """
+    Drops all the built chains, so they are rebuilt on the next request.
+    """
+    with _registry_lock:
+        _chain_registry.clear()
+        _answer_chains.clear()
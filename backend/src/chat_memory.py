@@ -0,0 +1,278 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List, Union
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables.config import run_in_executor
+from langchain_openai import ChatOpenAI
+
+from backend.src.chain import get_http_clients
+from backend.src.database_utils import HISTORY_PAGE_SIZE, get_chat_turns, get_last_turn_id, get_session_summary, \
+    save_session_summary
+from backend.src.tokens import count_tokens
+
+# Maximum number of tokens of chat history (summary included) sent with a question
+HISTORY_TOKEN_BUDGET = 1500
+# Model that folds the turns leaving the window into the summary
+SUMMARY_MODEL = "gpt-4o-mini"
+# Number of sessions whose memory is kept in process
+MAX_CACHED_SESSIONS = 1000
+# Tokens added by the message formatting of each turn
+_TURN_OVERHEAD_TOKENS = 8
+
+summary_prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """
+            You keep a short summary of a conversation between a user and an assistant analyzing
+            customer satisfaction data. Update the summary with the new turns, keeping the facts,
+            figures, customers and questions that later questions may refer to.
+            Answer with the summary only, in at most 150 words.
+            """,
+        ),
+        ("human", "Current summary:\n{summary}\n\nNew turns:\n{turns}"),
+    ]
+)
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+_summary_chain = None
+# references to the running summary tasks, so they are not garbage collected
+_background_tasks = set()
+
+# [id, user_query, model_response, tokens], the id is None while the row is queued for app_logs
+Turn = list
+
+
+def _make_turn(turn_id, user_query, model_response) -> Turn:
+    tokens = count_tokens(user_query) + count_tokens(model_response) + _TURN_OVERHEAD_TOKENS
+    return [turn_id, user_query, model_response, tokens]
+
+
+class SessionMemory:
+    """
+    Memory of one session: the rolling summary of its turns up to summarized_id, and the turns
+    after it with their token counts. Turns stay here until they are folded into the summary, the
+    window sent with a question holds at most HISTORY_PAGE_SIZE of them.
+    """
+
+    def __init__(self, summary: str, summarized_id: int, turns: List[Turn]):
+        self.summary = summary
+        self.summary_tokens = count_tokens(summary)
+        self.summarized_id = summarized_id
+        self.turns = turns
+        self.last_id = turns[-1][0] if turns else summarized_id
+        # turns added but not yet written to app_logs
+        self.pending = 0
+        self.folding = False
+
+    def window_start(self, budget: int = HISTORY_TOKEN_BUDGET, max_turns: int = HISTORY_PAGE_SIZE) -> int:
+        """
+        :param budget: The token budget of the history.
+        :param max_turns: The maximum number of turns of the window.
+        :return: The index of the oldest turn of the newest turns (at most max_turns) that fit the budget
+            with the summary.
+        """
+        remaining = budget - self.summary_tokens
+        start = len(self.turns)
+        while start and len(self.turns) - start < max_turns and self.turns[start - 1][3] <= remaining:
+            start -= 1
+            remaining -= self.turns[start][3]
+        return start
+
+    def messages(self, budget: int = HISTORY_TOKEN_BUDGET) -> List[dict]:
+        """
+        :param budget: The token budget of the history.
+        :return: The summary and the turns of the window as chat messages.
+        """
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        for _, user_query, model_response, _ in self.turns[self.window_start(budget):]:
+            messages.extend([
+                {"role": "human", "content": user_query},
+                {"role": "ai", "content": model_response}
+            ])
+        return messages
+
+
+def _load_session(session_id) -> SessionMemory:
+    summary, summarized_id = get_session_summary(session_id)
+    rows = get_chat_turns(session_id, limit=HISTORY_PAGE_SIZE, after_id=summarized_id)
+    turns = [_make_turn(row["id"], row["user_query"], row["model_response"]) for row in rows]
+    return SessionMemory(summary, summarized_id, turns)
+
+
+def get_session(session_id) -> SessionMemory:
+    """
+    Returns the memory of a session from the in-process cache, or loads it from the database when
+    it is not cached or another worker added turns to it since.
+
+    :param session_id: The session id.
+    :return: The SessionMemory.
+    """
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+        # turns of this process are still queued, the database is behind the cache
+        if session is not None and session.pending:
+            _sessions.move_to_end(session_id)
+            return session
+
+    last_id = get_last_turn_id(session_id)
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+        if session is not None and session.last_id == last_id:
+            _sessions.move_to_end(session_id)
+            return session
+
+    session = _load_session(session_id)
+    with _sessions_lock:
+        _sessions[session_id] = session
+        _sessions.move_to_end(session_id)
+        if len(_sessions) > MAX_CACHED_SESSIONS:
+            _sessions.popitem(last=False)
+    return session
+
+
+def get_history_messages(session_id, budget=HISTORY_TOKEN_BUDGET) -> List[dict]:
+    """
+    Builds the chat history sent with a question: the summary of the older turns followed by the
+    newest turns that fit the token budget. Its size does not grow with the length of the session.
+
+    :param session_id: The session id.
+    :param budget: The token budget of the history.
+    :return: The messages, oldest first.
+    """
+    return get_session(session_id).messages(budget)
+
+
+def _resolve_turn(session: SessionMemory, turn: Turn, future: Future) -> None:
+    # called once the queued row of the turn is written, or failed to be
+    with _sessions_lock:
+        session.pending -= 1
+        log_id = future.result() if future.exception() is None else None
+        if log_id is None or any(other[0] == log_id for other in session.turns):
+            # not written, or already loaded from the database with the session
+            session.turns = [other for other in session.turns if other is not turn]
+            return
+        turn[0] = log_id
+        session.last_id = max(session.last_id, log_id)
+
+
+def add_turn(session_id, turn_id: Union[int, Future], user_query, model_response,
+             budget=HISTORY_TOKEN_BUDGET) -> bool:
+    """
+    Adds a turn to the memory of its session. The row of the turn may still be queued by the log
+    writer: the turn is in the window right away and gets its id once written.
+
+    :param session_id: The session id.
+    :param turn_id: The id of the turn in app_logs, or the future returned by insert_application_logs.
+    :param user_query: The question.
+    :param model_response: The answer.
+    :param budget: The token budget of the history.
+    :return: True if turns left the window, by tokens or by number, and should be folded into the summary.
+        They are kept until they are.
+    """
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+    if session is None:
+        # loaded before the turn is added, which is skipped if it was written already
+        session = get_session(session_id)
+
+    turn = _make_turn(None, user_query, model_response)
+    pending = isinstance(turn_id, Future) and not turn_id.done()
+    with _sessions_lock:
+        if isinstance(turn_id, Future) and not pending:
+            turn_id = turn_id.result() if turn_id.exception() is None else 0
+        if pending:
+            session.pending += 1
+            session.turns.append(turn)
+        elif turn_id > session.last_id:
+            turn[0] = turn_id
+            session.turns.append(turn)
+            session.last_id = turn_id
+        fold_needed = session.window_start(budget) > 0 and not session.folding
+    if pending:
+        # outside the lock, the callback runs right away if the row was written in the meantime
+        turn_id.add_done_callback(lambda future: _resolve_turn(session, turn, future))
+    return fold_needed
+
+
+def get_summary_chain():
+    """
+    Returns the chain updating the summary of a session, building it on first use.
+
+    :return: The summary chain.
+    """
+    global _summary_chain
+    if _summary_chain is None:
+        http_client, http_async_client = get_http_clients()
+        llm = ChatOpenAI(temperature=0, model_name=SUMMARY_MODEL, http_client=http_client,
+                         http_async_client=http_async_client)
+        _summary_chain = summary_prompt | llm | StrOutputParser()
+    return _summary_chain
+
+
+async def afold_session(session_id, budget=HISTORY_TOKEN_BUDGET) -> None:
+    """
+    Folds the oldest turns of a session into its summary, until the remaining turns take half of
+    the budget and half of a page, so the summary is updated once every few turns rather than on
+    every turn.
+
+    :param session_id: The session id.
+    :param budget: The token budget of the history.
+    :return: None
+    """
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+        if session is None or session.folding:
+            return
+        folded = session.turns[:session.window_start(budget // 2, HISTORY_PAGE_SIZE // 2)]
+        # only the turns already written to app_logs, summarized_id refers to them
+        written = 0
+        while written < len(folded) and folded[written][0] is not None:
+            written += 1
+        folded = folded[:written]
+        if not folded:
+            return
+        session.folding = True
+
+    try:
+        turns = "\n".join(f"User: {user_query}\nAssistant: {model_response}"
+                          for _, user_query, model_response, _ in folded)
+        summary = await get_summary_chain().ainvoke({"summary": session.summary or "(none)", "turns": turns})
+        summarized_id = folded[-1][0]
+        await run_in_executor(None, save_session_summary, session_id, summary, summarized_id)
+        with _sessions_lock:
+            session.summary = summary
+            session.summary_tokens = count_tokens(summary)
+            session.summarized_id = summarized_id
+            session.turns = [turn for turn in session.turns if turn[0] is None or turn[0] > summarized_id]
+    except Exception as e:
+        # the turns stay out of the window, they are folded on the next turn
+        print(f"Error summarizing the history of session {session_id}: {e}")
+    finally:
+        # under the lock, like every read and change of the session's state
+        with _sessions_lock:
+            session.folding = False
+
+
+async def aadd_turn(session_id, turn_id, user_query, model_response) -> None:
+    """
+    Async variant of add_turn, which folds the turns leaving the window into the summary in the
+    background, after the answer is sent.
+
+    :param session_id: The session id.
+    :param turn_id: The id of the turn in app_logs, or the future returned by insert_application_logs.
+    :param user_query: The question.
+    :param model_response: The answer.
+    :return: None
+    """
+    if await run_in_executor(None, add_turn, session_id, turn_id, user_query, model_response):
+        task = asyncio.create_task(afold_session(session_id))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
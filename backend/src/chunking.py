@@ -1,21 +1,60 @@
-from typing import List
+from typing import Iterator, List
 from langchain_community.document_loaders import CSVLoader
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter, CharacterTextSplitter
 
+from backend.src.data_processing import SurveyCSVLoader, is_survey_csv
 
-def load_and_chunk(file_path:str, chunk_size:int, chunk_overlap:int) -> List[Document]:
-    # TO DO: Improving chunking approach
-    # load the file as csv. Each row will be treated as a single Document object
-    loader = CSVLoader(file_path=file_path, encoding='utf-8')
-    # Document.page_content will contain the row's values as a single text string
-    document = loader.load()
-    # test the character text splitter
+# CSV columns copied into the metadata of the chunks, so that searches can be filtered on them
+METADATA_COLUMNS = ("customer", "nps_type")
+# Number of CSV rows read, chunked and indexed at a time
+INGESTION_BATCH_ROWS = 1000
+
+
+def add_column_metadata(document: Document, columns=METADATA_COLUMNS) -> Document:
+    """
+    Copies column values of a CSV row into its metadata. The values stay in the text too.
+    :param document: A document loaded by CSVLoader, whose text has one "column: value" line per column.
+    :param columns: The columns to copy.
+    :return: The same document.
+    """
+    for line in document.page_content.split("\n"):
+        column, separator, value = line.partition(": ")
+        if separator and column in columns:
+            document.metadata[column] = value
+    return document
+
+
+def iter_chunk_batches(file_path:str, chunk_size:int, chunk_overlap:int,
+                       batch_rows:int=INGESTION_BATCH_ROWS) -> Iterator[List[Document]]:
+    """
+    Streams the rows of a CSV file and yields the chunks of batch_rows rows at a time, so that
+    only one batch of rows is in memory however big the file is.
+    :param file_path: The path of the CSV file.
+    :param chunk_size: Maximum number of characters of a chunk.
+    :param chunk_overlap: Number of characters shared by consecutive chunks of a row.
+    :param batch_rows: Number of rows per batch.
+    :return: An iterator of lists of chunks.
+    """
+    # each row will be treated as a single Document object, read lazily; the rows of survey files
+    # get the customer information text and their metadata from SurveyCSVLoader
+    survey = is_survey_csv(file_path)
+    loader = SurveyCSVLoader(file_path) if survey else CSVLoader(file_path=file_path, encoding='utf-8')
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
                                                    length_function=len, separators= ["\n\n", "\n", " ", ""])
-    # split document into chunks
-    texts = text_splitter.split_documents(document)
-
-    return texts
+    rows = []
+    for row in loader.lazy_load():
+        # Document.page_content will contain the row's values as a single text string,
+        # customer and nps_type are also copied to the metadata to filter searches on them
+        rows.append(row if survey else add_column_metadata(row))
+        if len(rows) == batch_rows:
+            yield text_splitter.split_documents(rows)
+            rows = []
+    if rows:
+        yield text_splitter.split_documents(rows)
 
 
+def load_and_chunk(file_path:str, chunk_size:int, chunk_overlap:int) -> List[Document]:
+    # TO DO: Improving chunking approach
+    # loads the whole file, iter_chunk_batches streams it
+    return [chunk for batch in iter_chunk_batches(file_path, chunk_size, chunk_overlap) for chunk in batch]
@@ -0,0 +1,141 @@
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from backend.src.metrics import CONTEXT_TOKENS, record, span
+from backend.src.tokens import count_tokens
+
+# Maximum number of context tokens sent to each model, the default applies to the other models
+CONTEXT_TOKEN_BUDGETS: Dict[str, int] = {"gpt-4o-mini": 1500}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1500
+# Shortest overlap between the end of a chunk and the start of another that is cut (chunk_overlap is 200)
+MIN_OVERLAP_CHARS = 40
+# A chunk is dropped when this fraction of its word shingles is already in the context
+NEAR_DUPLICATE_CONTAINMENT = 0.8
+SHINGLE_SIZE = 5
+# Number of chunks whose token counts and shingles are kept
+CHUNK_CACHE_SIZE = 50_000
+# Tokens of the separator the stuff chain puts between the documents
+_SEPARATOR_TOKENS = 2
+
+
+@lru_cache(maxsize=CHUNK_CACHE_SIZE)
+def chunk_tokens(text: str, model: str) -> int:
+    """
+    Token count of a chunk, cached since the same chunks are retrieved over and over.
+    :param text: The text of the chunk.
+    :param model: The name of the model.
+    :return: The number of tokens.
+    """
+    return count_tokens(text, model)
+
+
+@lru_cache(maxsize=CHUNK_CACHE_SIZE)
+def chunk_shingles(text: str) -> frozenset:
+    """
+    :param text: The text of the chunk.
+    :return: The hashes of its lowercased word n-grams of SHINGLE_SIZE words.
+    """
+    words = text.lower().split()
+    if len(words) < SHINGLE_SIZE:
+        return frozenset([hash(tuple(words))]) if words else frozenset()
+    return frozenset(hash(tuple(words[i:i + SHINGLE_SIZE])) for i in range(len(words) - SHINGLE_SIZE + 1))
+
+
+def _overlap_length(first: str, second: str) -> int:
+    # length of the longest suffix of first that is a prefix of second, 0 if shorter than MIN_OVERLAP_CHARS;
+    # the candidates are the occurrences of the start of second, found by str.find
+    if len(second) < MIN_OVERLAP_CHARS:
+        return 0
+    head = second[:MIN_OVERLAP_CHARS]
+    position = first.find(head, max(0, len(first) - len(second)))
+    while position != -1:
+        if second.startswith(first[position:]):
+            return len(first) - position
+        position = first.find(head, position + 1)
+    return 0
+
+
+def remove_overlap(text: str, kept: List[str]) -> str:
+    """
+    Cuts the start or the end of a chunk that repeats the end or the start of a chunk already in
+    the context, as consecutive chunks of a row share chunk_overlap characters.
+    :param text: The text of the chunk.
+    :param kept: The texts already in the context.
+    :return: The text without the repeated spans.
+    """
+    for other in kept:
+        overlap = _overlap_length(other, text)
+        if overlap:
+            text = text[overlap:]
+        overlap = _overlap_length(text, other)
+        if overlap:
+            text = text[:-overlap]
+    return text.strip()
+
+
+def pack_context(documents: List[Document], model: str, token_budget: Optional[int] = None) -> List[Document]:
+    """
+    Assembles the context sent to the llm from the retrieved chunks, best ranked first: near-duplicate
+    chunks are dropped, spans overlapping a chunk already in the context are cut, and chunks are
+    added while they fit the token budget of the model.
+
+    :param documents: The retrieved documents, best first.
+    :param model: The name of the chat model.
+    :param token_budget: The maximum number of context tokens, CONTEXT_TOKEN_BUDGETS by default.
+    :return: The documents of the context, with their text cut where it overlapped. The retrieved
+    documents are not modified.
+    """
+    if token_budget is None:
+        token_budget = CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+    start = time.perf_counter()
+    packed, kept_texts, kept_shingles = [], [], set()
+    used = 0
+    for document in documents:
+        shingles = chunk_shingles(document.page_content)
+        if shingles and len(shingles & kept_shingles) >= NEAR_DUPLICATE_CONTAINMENT * len(shingles):
+            continue
+
+        text = remove_overlap(document.page_content, kept_texts)
+        if not text:
+            continue
+        tokens = chunk_tokens(text, model) + _SEPARATOR_TOKENS
+        if used + tokens > token_budget:
+            # a shorter chunk ranked lower may still fit
+            continue
+
+        used += tokens
+        kept_texts.append(document.page_content)
+        kept_shingles |= shingles
+        if text != document.page_content:
+            document = Document(id=document.id, page_content=text, metadata=document.metadata)
+        packed.append(document)
+    record("context_packing", time.perf_counter() - start)
+    CONTEXT_TOKENS.observe(used, model)
+    return packed
+
+
+class PackedContextRetriever(BaseRetriever):
+    """
+    Wraps the retriever of a chain so that the documents it returns go through pack_context before
+    create_stuff_documents_chain puts them in the prompt.
+    """
+
+    retriever: BaseRetriever
+    model: str
+    token_budget: Optional[int] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with span("retrieval"):
+            documents = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return pack_context(documents, self.model, self.token_budget)
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        with span("retrieval"):
+            documents = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+        return pack_context(documents, self.model, self.token_budget)
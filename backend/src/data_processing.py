@@ -1,93 +1,214 @@
+import csv
 import os
-from typing import Dict
+from itertools import repeat
+from typing import Dict, Iterator, List, Union
 
 import pandas as pd
 from dotenv import load_dotenv
 from langchain_community.document_loaders import CSVLoader
-
-
-def create_customer_info(
-    row: pd.DataFrame, info_type: str, questions: Dict
-) -> pd.Series:
-
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document
+
+try:
+    import pyarrow as pa
+    from pyarrow import compute as pa_compute
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+    pa_compute = None
+    pa_csv = None
+
+# pyarrow parses the CSV files on several threads, pandas' C parser is used when it is unavailable
+CSV_ENGINE = "pyarrow" if pa is not None else "c"
+STRING_DTYPE = "string[pyarrow]" if pa is not None else "string"
+# Bytes of CSV parsed at a time by the streaming pyarrow reader, rows at a time by the C parser
+CSV_BLOCK_SIZE = 4 << 20
+CSV_BATCH_ROWS = 10_000
+
+# For now hardcode questions_dict
+SURVEY_QUESTIONS = {
+    "Q1": "How likely are you to recommend MDS to other organisations, family or friends?",
+    "Q2": "How do you rate the speed and responsiveness of the MDS manager?",
+    "Q3": "How do you rate the ease with which MDS resolves the situations you present?",
+    "Q4": "Does the MDS Management Team follow up with the expected frequency and quality?",
+    "Q5": "How do you rate the quality of the solutions presented by MDS?",
+    "Q6": "Please let us know what we could improve by leaving your comment or suggestion.",
+    "Q7": "If you feel it is important to pass on this satisfaction questionnaire to another member(s) of staff who can help you better understand the level of service provided by MDS, please fill in the details below."
+}
+SCORE_COLUMNS = ["Q1", "Q2", "Q3", "Q4", "Q5"]
+OPEN_RESPONSE_COLUMNS = ["Q6", "Q7"]
+SURVEY_COLUMNS = ["customer", *SCORE_COLUMNS, "nps_value", "nps_type", *OPEN_RESPONSE_COLUMNS]
+# the survey columns are only put in the row texts, so they are read as strings: no type inference,
+# and a score column with a missing answer is not turned into floats ("9.0")
+SURVEY_DTYPES = {column: STRING_DTYPE for column in SURVEY_COLUMNS}
+
+# manual translation to save API costs. Temporary
+NPS_TRANSLATION = {
+    "neutro": "neutral",
+    "promotor": "promoter",
+    "detrator": "detractor",
+}
+
+
+def _concat(parts: List[Union[str, pd.Series]], index: pd.Index) -> pd.Series:
+    # concatenates strings and string columns row by row in one pass, where chaining `+` would copy
+    # the growing texts once per part
+    if pa is not None:
+        arrays = [pa.array(part.array).cast(pa.large_string()) if isinstance(part, pd.Series)
+                  else pa.scalar(part, pa.large_string()) for part in parts]
+        joined = pa_compute.binary_join_element_wise(*arrays, pa.scalar("", pa.large_string()))
+        return pd.Series(pd.arrays.ArrowStringArray(joined.cast(pa.string())), index=index)
+    columns = [part.tolist() if isinstance(part, pd.Series) else repeat(part, len(index)) for part in parts]
+    return pd.Series(list(map("".join, zip(*columns))), index=index, dtype=STRING_DTYPE)
+
+
+def _labelled_lines(df: pd.DataFrame, columns: List[str], questions: Dict) -> list:
+    parts = []
+    for position, col in enumerate(columns):
+        parts.extend([("\n" if position else "") + f"{questions[col]}: ", df[col]])
+    return parts
+
+
+def _customer_info_parts(df: pd.DataFrame, info_type: str, questions: Dict) -> list:
     if info_type == "scores":
-        relevant_columns = ["Q1", "Q2", "Q3", "Q4", "Q5"]
-        content = "\n".join(
-            [f"{questions[col]}: {row[col]}" for col in relevant_columns]
-        )
+        return _labelled_lines(df, SCORE_COLUMNS, questions)
     elif info_type == "nps_score":
-        content = f"NPS Score: {row['nps_value']}"
+        return ["NPS Score: ", df["nps_value"]]
     elif info_type == "nps_type":
-        content = f"NPS Type: {row['nps_type']}"
+        return ["NPS Type: ", df["nps_type"]]
     elif info_type == "open_responses":
-        relevant_columns = ["Q6", "Q7"]
-        content = "Open Responses: " + "\n".join(
-            [f"{questions[col]}: {row[col]}" for col in relevant_columns]
+        return ["Open Responses: ", *_labelled_lines(df, OPEN_RESPONSE_COLUMNS, questions)]
+    raise ValueError(f"Unknown Info Type: {info_type}")
+
+
+def create_customer_info(
+    df: pd.DataFrame, info_type: str, questions: Dict
+) -> pd.Series:
+    """
+    Builds one part of the text of every customer row, with column operations.
+    :param df: The survey answers, with the SURVEY_COLUMNS as strings and no missing values.
+    :param info_type: scores, nps_score, nps_type or open_responses.
+    :param questions: The text of the question of each column.
+    :return: The text of each row.
+    """
+    return _concat(_customer_info_parts(df, info_type, questions), df.index)
+
+
+def build_customer_info(df: pd.DataFrame, questions: Dict = SURVEY_QUESTIONS) -> pd.Series:
+    """
+    Combines the customer information of every row into a single string.
+    :param df: The survey answers, as returned by clean_survey_answers.
+    :param questions: The text of the question of each column.
+    :return: The text of each row.
+    """
+    return _concat([
+        "Customer: ", df["customer"], "\nScores: ",
+        *_customer_info_parts(df, "scores", questions), "\n",
+        *_customer_info_parts(df, "nps_score", questions), "\n",
+        *_customer_info_parts(df, "nps_type", questions), "\n",
+        *_customer_info_parts(df, "open_responses", questions), "\n",
+    ], df.index)
+
+
+def clean_survey_answers(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Fills the missing answers with empty strings and translates the NPS types, in place.
+    :param df: The survey answers, with the SURVEY_COLUMNS read as strings.
+    :return: The same dataframe.
+    """
+    df[SURVEY_COLUMNS] = df[SURVEY_COLUMNS].fillna("")
+    # the types already in english are kept
+    df["nps_type"] = df["nps_type"].replace(NPS_TRANSLATION)
+    return df
+
+
+def read_header(file_path: str) -> Dict[str, str]:
+    """
+    Reads the header row of a CSV file, whose names may be padded with spaces (e.g. "Q1 , Q2").
+    :param file_path: The path of the CSV file.
+    :return: The names of its columns as written in the file, by their normalized (stripped) name.
+    """
+    with open(file_path, newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader(f), [])
+    return {column.strip(): column for column in header}
+
+
+def is_survey_csv(file_path: str) -> bool:
+    """
+    :param file_path: The path of a CSV file.
+    :return: True if its header has all the SURVEY_COLUMNS.
+    """
+    return set(SURVEY_COLUMNS).issubset(read_header(file_path))
+
+
+def iter_survey_frames(file_path: str) -> Iterator[pd.DataFrame]:
+    """
+    Streams the survey columns of a CSV file as dataframes of strings, a block of rows at a time.
+    :param file_path: The path of the CSV file.
+    :return: An iterator of dataframes, cleaned by clean_survey_answers.
+    """
+    # the columns are selected by their names in the file, and renamed to the SURVEY_COLUMNS once read
+    header = read_header(file_path)
+    raw_columns = [header.get(column, column) for column in SURVEY_COLUMNS]
+    names = dict(zip(raw_columns, SURVEY_COLUMNS))
+    if pa_csv is not None:
+        reader = pa_csv.open_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(column_types={column: pa.string() for column in raw_columns},
+                                                  include_columns=raw_columns),
         )
+        string_dtype = pd.StringDtype("pyarrow")
+        for batch in reader:
+            df = batch.to_pandas(types_mapper={pa.string(): string_dtype}.get)
+            yield clean_survey_answers(df.rename(columns=names))
     else:
-        raise ValueError(f"Unknown Info Type: {info_type}")
-
-    return pd.Series(content)
+        for df in pd.read_csv(file_path, usecols=raw_columns, dtype={column: STRING_DTYPE for column in raw_columns},
+                              encoding="utf-8", chunksize=CSV_BATCH_ROWS):
+            yield clean_survey_answers(df.rename(columns=names))
+
+
+class SurveyCSVLoader(BaseLoader):
+    """
+    Loads a survey CSV file as one Document per customer row, like CSVLoader, but the text is the
+    customer information built by build_customer_info, a block of rows at a time, and the metadata
+    holds the customer, its NPS score and type next to the source and row.
+    """
+
+    def __init__(self, file_path: str, questions: Dict = SURVEY_QUESTIONS):
+        self.file_path = file_path
+        self.questions = questions
+
+    def lazy_load(self) -> Iterator[Document]:
+        row = 0
+        for df in iter_survey_frames(self.file_path):
+            texts = build_customer_info(df, self.questions)
+            nps_values = pd.to_numeric(df["nps_value"], errors="coerce").astype("Int64")
+            for text, customer, nps_value, nps_type in zip(texts.tolist(), df["customer"].tolist(),
+                                                           nps_values.tolist(), df["nps_type"].tolist()):
+                yield Document(page_content=text, metadata={
+                    "source": self.file_path, "row": row, "customer": customer,
+                    "nps_value": None if pd.isna(nps_value) else nps_value, "nps_type": nps_type,
+                })
+                row += 1
 
 
 def load_and_clean_data(file_path):
-
-    # read answers
-    df_answers = pd.read_csv(file_path, delimiter=",")
-
-    # manual transaltion nap just to save API costs
-    translation_nps_map = {
-        "neutro": "neutral",
-        "promotor": "promoter",
-        "detrator": "detractor",
-    }
-
-    # manual translation to save API costs. Temporary
-    df_answers["nps_type"] = df_answers["nps_type"].map(translation_nps_map)
-
-    # convert questions_df into questions dict
-    #questions_dict = dict(zip(questions_df.columns, questions_df.iloc[0]))
-
-    # For now hardcode questions_dict
-    questions_dict = {
-        "Q1": "How likely are you to recommend MDS to other organisations, family or friends?",
-        "Q2": "How do you rate the speed and responsiveness of the MDS manager?",
-        "Q3": "How do you rate the ease with which MDS resolves the situations you present?",
-        "Q4": "Does the MDS Management Team follow up with the expected frequency and quality?",
-        "Q5": "How do you rate the quality of the solutions presented by MDS?",
-        "Q6": "Please let us know what we could improve by leaving your comment or suggestion.",
-        "Q7": "If you feel it is important to pass on this satisfaction questionnaire to another member(s) of staff who can help you better understand the level of service provided by MDS, please fill in the details below."
-    }
-
-
-    df_answers["scores"] = df_answers.apply(
-        lambda row: create_customer_info(row, "scores", questions=questions_dict),
-        axis=1,
-    )
-    df_answers["nps_score"] = df_answers.apply(
-        lambda row: create_customer_info(row, "nps_score", questions=questions_dict),
-        axis=1,
-    )
-    df_answers["nps_type"] = df_answers.apply(
-        lambda row: create_customer_info(row, "nps_type", questions=questions_dict),
-        axis=1,
-    )
-    df_answers["open_responses"] = df_answers.apply(
-        lambda row: create_customer_info(
-            row, "open_responses", questions=questions_dict
-        ),
-        axis=1,
-    )
-
-    # Combine the customer information into a single string
-    df_answers['customer_info'] = df_answers.apply(
-        lambda row: f"Customer: {row['customer']}\n"
-                    f"Scores: {row['scores']}\n"
-                    f"NPS Score: {row['nps_score']}\n"
-                    f"NPS Type: {row['nps_type']}\n"
-                    f"Open Responses: {row['open_responses']}\n",
-        axis = 1
-    )
+    """
+    Reads a survey CSV file and adds the text of each part of the customer information
+    (scores, nps_score, nps_type and open_responses) and the combined customer_info.
+    :param file_path: The path of the CSV file.
+    :return: The dataframe.
+    """
+    # read answers, with the names of the columns stripped as in iter_survey_frames
+    header = read_header(file_path)
+    df_answers = pd.read_csv(file_path, delimiter=",", engine=CSV_ENGINE,
+                             dtype={header.get(column, column): dtype for column, dtype in SURVEY_DTYPES.items()})
+    df_answers = clean_survey_answers(df_answers.rename(columns={raw: name for name, raw in header.items()}))
+
+    df_answers["customer_info"] = build_customer_info(df_answers, SURVEY_QUESTIONS)
+    for info_type in ["scores", "nps_score", "nps_type", "open_responses"]:
+        df_answers[info_type] = create_customer_info(df_answers, info_type, questions=SURVEY_QUESTIONS)
 
     return df_answers
 
@@ -99,4 +220,3 @@ if __name__ == '__main__':
     loader = CSVLoader(file_path= file_path, encoding='utf-8')
     print("Loading document")
     document = loader.load()
-
@@ -1,107 +1,321 @@
+import atexit
+import queue
 import sqlite3
-
-from aiohttp.hdrs import PRAGMA
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 
 from backend.src.pydantic_models import DocumentInfo
 
 DBNAME = 'rag_ds_app.db'
+# Default number of turns returned by a page of chat history
+HISTORY_PAGE_SIZE = 20
+# Maximum number of open connections, requests wait for a free one beyond that
+DB_POOL_SIZE = 8
+# Milliseconds a statement waits for the write lock of another connection or worker before failing
+DB_BUSY_TIMEOUT_MS = 5000
+# Maximum number of log rows written in one transaction
+LOG_BATCH_SIZE = 500
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Pool of SQLite connections shared by the threads of the app. Connections are opened on
+    demand up to `size` and configured once: WAL lets readers run while a write is in progress,
+    synchronous=NORMAL is durable in WAL mode with one fsync per checkpoint instead of per commit,
+    and busy_timeout makes concurrent writers wait for the lock instead of raising
+    "database is locked".
+    """
+
+    def __init__(self, path=DBNAME, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._connections = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection, returned to the pool when the block exits. A transaction left open
+        by an error is rolled back.
+        """
+        try:
+            conn = self._connections.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._connections.put(conn)
+
 
 def get_db_connection():
-    conn = sqlite3.connect(DBNAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Borrows a connection of the global pool, to be used as a context manager:
+    with get_db_connection() as conn: ...
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DBNAME)
+    return _pool.connection()
 
 
-def create_document_table():
+class LogWriter:
+    """
+    Write-behind queue of app_logs rows. Requests only enqueue their row, a background thread
+    writes the queued rows in one transaction per batch: the rows arriving while a batch is
+    written form the next one, so the batches grow with the load. Each row gets a future
+    resolved with its id once committed. stop() drains the queue.
+    """
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS document_data (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        filename TEXT,
-        upload_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
-        '''
-    )
+    def __init__(self, batch_size=LOG_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
 
-    conn.close()
+    def submit(self, row) -> Future:
+        """
+        Queues a row (session_id, user_query, model_response, model).
+        :param row: The values of the row.
+        :return: A future resolved with the id of the row once written.
+        """
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._queue.put((row, future))
+        return future
 
-    return True
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
 
-def create_app_logs():
-    conn = get_db_connection()
+    @staticmethod
+    def _write(batch):
+        try:
+            with get_db_connection() as conn:
+                ids = [conn.execute('INSERT INTO app_logs (session_id, user_query, model_response, model) '
+                                    'VALUES (?, ?, ?, ?)', row).lastrowid for row, _ in batch]
+                conn.commit()
+        except Exception as e:
+            print(f"Error writing {len(batch)} application logs: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), log_id in zip(batch, ids):
+            future.set_result(log_id)
 
-    conn.execute(''' 
-        CREATE TABLE IF NOT EXISTS app_logs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        session_id TEXT,
-        user_query TEXT,
-        model_response TEXT,
-        model TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
-    ''')
+    def stop(self, timeout=None):
+        """
+        Writes the queued rows and stops the thread. A later submit starts a new one.
+        :param timeout: Maximum number of seconds to wait.
+        :return: None
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join(timeout)
 
-    conn.close()
 
+_log_writer = LogWriter()
+# the rows still queued are written when the process exits
+atexit.register(_log_writer.stop)
 
-def insert_application_logs(session_id, user_query, model_response, model):
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
-    cursor.execute(
-        'INSERT INTO app_logs (session_id, user_query, model_response, model) VALUES (?, ?, ?, ? )',
-        (session_id, user_query, model_response, model)
-    )
-    conn.commit()
-    conn.close()
+def stop_log_writer(timeout=None):
+    """
+    Drains the queue of application logs, called on shutdown.
+    :param timeout: Maximum number of seconds to wait.
+    :return: None
+    """
+    _log_writer.stop(timeout)
+
+
+def create_document_table():
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS document_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT,
+            upload_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+            '''
+        )
+        # documents are listed newest first
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_document_data_upload_timestamp '
+                     'ON document_data (upload_timestamp)')
+
+    return True
+
+def create_app_logs():
+    with get_db_connection() as conn:
+        conn.execute(''' 
+            CREATE TABLE IF NOT EXISTS app_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            user_query TEXT,
+            model_response TEXT,
+            model TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+        ''')
+        # the history of a session is read newest first by id, without scanning the other sessions
+        # (ids grow with created_at, so this also serves the session's turns in time order)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_app_logs_session_id ON app_logs (session_id, id)')
+        # rolling summary of the turns of a session up to summarized_id, that no longer fit the history window
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_id INTEGER NOT NULL)
+        ''')
+
+
+def insert_application_logs(session_id, user_query, model_response, model):
+    """
+    Queues a row of app_logs, written in the background by the log writer.
+    :return: A future resolved with the id of the row (the id of the turn, used to page the history).
+    """
+    return _log_writer.submit((session_id, user_query, model_response, model))
 
 
 def insert_document_record(filename):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO document_data (filename) VALUES (?)', (filename,))
-    # captures the id of the last inserted document
-    document_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO document_data (filename) VALUES (?)', (filename,))
+        # captures the id of the last inserted document
+        document_id = cursor.lastrowid
+        conn.commit()
 
     return document_id
 
 def delete_document_record(file_id):
-    conn = get_db_connection()
-    conn.execute('DELETE FROM document_data WHERE id = ?', (file_id,))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute('DELETE FROM document_data WHERE id = ?', (file_id,))
+        conn.commit()
     return True
 
 def get_all_documents():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, filename, upload_timestamp FROM document_data ORDER BY upload_timestamp desc')
-    rows = cursor.fetchall()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, filename, upload_timestamp FROM document_data ORDER BY upload_timestamp desc')
+        rows = cursor.fetchall()
 
     documents = [DocumentInfo(id=row['id'],
                               filename=row['filename'],
                               upload_timestamp=row['upload_timestamp']) for row in rows]
     return documents
 
-def get_chat_history(session_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT FROM app_logs WHERE session_id = ? ORDER BY created_at', (session_id))
-    logs = cursor.fetchall()
+def get_chat_turns(session_id, limit=HISTORY_PAGE_SIZE, after_id=0, before_id=None):
+    """
+    Reads a page of the turns of a session: the newest `limit` turns with an id between after_id
+    and before_id, so older pages are read by passing the id of the oldest turn as before_id.
+    :param session_id: The session id.
+    :param limit: Maximum number of turns.
+    :param after_id: Only turns with a larger id are read.
+    :param before_id: Only turns with a smaller id are read, if given.
+    :return: The rows (id, user_query, model_response), oldest first.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if before_id is None:
+            cursor.execute('SELECT id, user_query, model_response FROM app_logs WHERE session_id = ? AND id > ? '
+                           'ORDER BY id DESC LIMIT ?', (session_id, after_id, limit))
+        else:
+            cursor.execute('SELECT id, user_query, model_response FROM app_logs WHERE session_id = ? AND id > ? '
+                           'AND id < ? ORDER BY id DESC LIMIT ?', (session_id, after_id, before_id, limit))
+        rows = cursor.fetchall()
+    return rows[::-1]
 
+
+def get_chat_history(session_id, limit=HISTORY_PAGE_SIZE, before_id=None):
+    """
+    Reads a page of the history of a session as chat messages.
+    :param session_id: The session id.
+    :param limit: Maximum number of turns.
+    :param before_id: Only turns older than this id are read, if given.
+    :return: The messages, oldest first.
+    """
     messages = []
-    for row in logs:
+    for row in get_chat_turns(session_id, limit=limit, before_id=before_id):
         messages.extend([
             {"role": "human", "content": row["user_query"]},
             {"role": "ai", "content": row["model_response"]}
         ])
-    conn.close()
     return messages
 
+
+def get_last_turn_id(session_id):
+    with get_db_connection() as conn:
+        row = conn.execute('SELECT MAX(id) FROM app_logs WHERE session_id = ?', (session_id,)).fetchone()
+    return row[0] or 0
+
+
+def get_session_summary(session_id):
+    """
+    :param session_id: The session id.
+    :return: A tuple (summary, id of the last summarized turn), ("", 0) if there is none.
+    """
+    with get_db_connection() as conn:
+        row = conn.execute('SELECT summary, summarized_id FROM session_summaries WHERE session_id = ?',
+                           (session_id,)).fetchone()
+    return (row["summary"], row["summarized_id"]) if row else ("", 0)
+
+
+def save_session_summary(session_id, summary, summarized_id):
+    with get_db_connection() as conn:
+        conn.execute('INSERT OR REPLACE INTO session_summaries (session_id, summary, summarized_id) '
+                     'VALUES (?, ?, ?)', (session_id, summary, summarized_id))
+        conn.commit()
+
 # init database
 create_app_logs()
 create_document_table()
@@ -0,0 +1,222 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+# Define docstore database path
+DOCSTORE_DB_PATH = 'docstore.db'
+# SQLite limits the number of bound parameters per statement
+_SQLITE_BATCH = 500
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """
+    Disk-backed docstore implementing the interface used by the LangChain FAISS wrapper.
+    Documents stay in SQLite and are only read when a search hit needs them, so startup
+    time and resident memory do not depend on the size of the corpus.
+
+    It also keeps the file_id -> (docstore id, vector id) map used to delete the chunks of a file
+    without scanning the corpus.
+    """
+
+    def __init__(self, path=DOCSTORE_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS documents (
+            id TEXT PRIMARY KEY,
+            page_content TEXT NOT NULL,
+            metadata TEXT NOT NULL)
+            '''
+        )
+        self._conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS file_chunks (
+            doc_id TEXT PRIMARY KEY,
+            file_id INTEGER,
+            index_id INTEGER)
+            '''
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_file_chunks_file_id ON file_chunks (file_id)')
+        # rows whose vector id is not known yet (documents migrated from previous versions)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_file_chunks_missing_index_id '
+                           'ON file_chunks (doc_id) WHERE index_id IS NULL')
+
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+            # one-off backfill of the file map for docstores created before it existed
+            self._conn.execute(
+                "INSERT OR IGNORE INTO file_chunks (doc_id, file_id) "
+                "SELECT id, json_extract(metadata, '$.file_id') FROM documents"
+            )
+            self._conn.execute('PRAGMA user_version = 1')
+        self._conn.commit()
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        """
+        Adds documents to the docstore. Existing ids are overwritten, so replaying an add is harmless.
+        :param texts: A dict of documents by id.
+        :return: None
+        """
+        rows = [(id_, doc.page_content, json.dumps(doc.metadata, default=str)) for id_, doc in texts.items()]
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO documents (id, page_content, metadata) VALUES (?, ?, ?)', rows
+            )
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO file_chunks (doc_id, file_id) VALUES (?, ?)',
+                [(id_, doc.metadata.get("file_id")) for id_, doc in texts.items()]
+            )
+            self._conn.commit()
+
+    def delete(self, ids: List) -> None:
+        """
+        Deletes documents from the docstore. Unknown ids are ignored.
+        :param ids: The ids to delete.
+        :return: None
+        """
+        ids = list(ids)
+        with self._lock:
+            for start in range(0, len(ids), _SQLITE_BATCH):
+                batch = ids[start:start + _SQLITE_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                self._conn.execute(f'DELETE FROM documents WHERE id IN ({placeholders})', batch)
+                self._conn.execute(f'DELETE FROM file_chunks WHERE doc_id IN ({placeholders})', batch)
+            self._conn.commit()
+
+    def search(self, search: str) -> Union[str, Document]:
+        """
+        Looks a document up by id.
+        :param search: The document id.
+        :return: The Document, or a message string if it is not found (same as InMemoryDocstore).
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT page_content, metadata FROM documents WHERE id = ?', (search,)
+            ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def mget(self, ids: List[str]) -> List[Optional[Document]]:
+        """
+        Looks several documents up with one query per batch.
+        :param ids: The document ids.
+        :return: The documents in the order of the ids, None for the ones not found.
+        """
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), _SQLITE_BATCH):
+                batch = ids[start:start + _SQLITE_BATCH]
+                rows = self._conn.execute(
+                    f'SELECT id, page_content, metadata FROM documents WHERE id IN ({",".join("?" * len(batch))})',
+                    batch
+                ).fetchall()
+                for id_, page_content, metadata in rows:
+                    found[id_] = Document(id=id_, page_content=page_content, metadata=json.loads(metadata))
+        return [found.get(id_) for id_ in ids]
+
+    def _iter_column(self, column, batch_size):
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    f'SELECT rowid, id, {column} FROM documents WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last_rowid, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            for _, id_, value in rows:
+                yield id_, value
+
+    def iter_texts(self, batch_size: int = 10_000) -> Iterator[Tuple[str, str]]:
+        """
+        Iterates over the texts of all the documents, reading them in batches.
+        :param batch_size: Number of documents read per query.
+        :return: An iterator of (id, page_content) pairs.
+        """
+        return self._iter_column('page_content', batch_size)
+
+    def iter_metadata(self, batch_size: int = 10_000) -> Iterator[Tuple[str, dict]]:
+        """
+        Iterates over the metadata of all the documents, reading them in batches.
+        :param batch_size: Number of documents read per query.
+        :return: An iterator of (id, metadata) pairs.
+        """
+        return ((id_, json.loads(metadata)) for id_, metadata in self._iter_column('metadata', batch_size))
+
+    def set_index_ids(self, ids: List[str], index_ids: List[int]) -> None:
+        """
+        Records the vector ids of documents in the file map.
+        :param ids: The docstore ids.
+        :param index_ids: The vector ids, in the order of the docstore ids.
+        :return: None
+        """
+        with self._lock:
+            self._conn.executemany('UPDATE file_chunks SET index_id = ? WHERE doc_id = ?',
+                                   [(int(index_id), id_) for id_, index_id in zip(ids, index_ids)])
+            self._conn.commit()
+
+    def get_file_chunks(self, file_id) -> Tuple[List[str], List[Optional[int]]]:
+        """
+        Looks up the chunks of a file in the file map, using the index on file_id.
+        :param file_id: The id of an uploaded file.
+        :return: A tuple (docstore ids, vector ids) of the chunks of that file.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT doc_id, index_id FROM file_chunks WHERE file_id = ?', (file_id,)
+            ).fetchall()
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def ids_missing_index_id(self) -> List[str]:
+        """
+        :return: The docstore ids whose vector id is not recorded in the file map yet.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT doc_id FROM file_chunks WHERE index_id IS NULL').fetchall()
+        return [row[0] for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+
+def migrate_pickled_docstore(pickle_path, docstore: SQLiteDocstore) -> int:
+    """
+    One-off migration of a pickled InMemoryDocstore into a SQLiteDocstore.
+    The pickle file is renamed with a ".migrated" suffix once its documents are stored.
+
+    :param pickle_path: The path of the pickled docstore.
+    :param docstore: The SQLite docstore to fill.
+    :return: The number of migrated documents.
+    """
+    with open(pickle_path, "rb") as f:
+        pickled_docstore = pickle.load(f)
+
+    documents = pickled_docstore._dict
+    items = list(documents.items())
+    for start in range(0, len(items), _SQLITE_BATCH):
+        docstore.add(dict(items[start:start + _SQLITE_BATCH]))
+
+    os.replace(pickle_path, f"{pickle_path}.migrated")
+    return len(items)
+
+
+if __name__ == '__main__':
+    from backend.src.retriever import DOCSTORE_PATH
+
+    if os.path.exists(DOCSTORE_PATH):
+        migrated = migrate_pickled_docstore(DOCSTORE_PATH, SQLiteDocstore())
+        print(f"Migrated {migrated} documents from {DOCSTORE_PATH} to {DOCSTORE_DB_PATH}")
+    else:
+        print(f"No pickled docstore found at {DOCSTORE_PATH}")
@@ -0,0 +1,231 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables.config import run_in_executor
+
+from backend.src.metrics import span
+from backend.src.single_flight import SingleFlight, normalize_query
+
+# Define embedding cache path
+EMBEDDING_CACHE_PATH = 'embedding_cache.db'
+# Maximum number of vectors kept in the cache before evicting the least recently used
+EMBEDDING_CACHE_MAX_ENTRIES = 500_000
+# Maximum number of query vectors kept in memory in front of the SQLite cache
+QUERY_CACHE_MAX_ENTRIES = 10_000
+# SQLite limits the number of bound parameters per statement
+_SQLITE_BATCH = 500
+
+
+class SQLiteEmbeddingCache:
+    """
+    Persistent, content-addressed cache of embedding vectors stored in SQLite.
+    Vectors are stored as float32 blobs keyed by a hash of the text and the embedding model name.
+    When the cache grows beyond max_entries, the least recently used vectors are evicted.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            vector BLOB NOT NULL,
+            last_used REAL NOT NULL)
+            '''
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)')
+        self._conn.commit()
+        self._count = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    @staticmethod
+    def make_key(text: str, model: str) -> str:
+        """
+        Builds the cache key of a text for a given embedding model.
+        :param text: The embedded text.
+        :param model: The embedding model name.
+        :return: The hex digest used as key.
+        """
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """
+        Looks up several keys at once and refreshes the last used time of the hits.
+        :param keys: The cache keys.
+        :return: A dict with the vectors found, by key.
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), _SQLITE_BATCH):
+                batch = unique_keys[start:start + _SQLITE_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+                if rows:
+                    hit_keys = [row[0] for row in rows]
+                    self._conn.execute(
+                        f'UPDATE embeddings SET last_used = ? WHERE key IN ({",".join("?" * len(hit_keys))})',
+                        [time.time(), *hit_keys]
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]) -> None:
+        """
+        Stores several vectors and evicts the least recently used ones if the cache is full.
+        :param vectors: A dict of vectors by key.
+        :return: None
+        """
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in vectors.items()]
+        with self._lock:
+            cursor = self._conn.executemany(
+                'INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)', rows
+            )
+            self._count += cursor.rowcount
+
+            overflow = self._count - self.max_entries
+            if overflow > 0:
+                cursor = self._conn.execute(
+                    'DELETE FROM embeddings WHERE key IN '
+                    '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)', (overflow,)
+                )
+                self._count -= cursor.rowcount
+            self._conn.commit()
+
+    def __len__(self):
+        return self._count
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that consults a SQLiteEmbeddingCache before calling the underlying
+    embedding model, for both documents and queries. Only the cache misses are sent to the model.
+
+    Queries are normalized (whitespace collapsed) and first looked up in an in-memory LRU of
+    query_cache_size vectors. Concurrent misses on the same query share one lookup and embedding.
+    """
+
+    def __init__(self, underlying: Embeddings, cache: SQLiteEmbeddingCache, model_name: str = None,
+                 query_cache_size: int = QUERY_CACHE_MAX_ENTRIES):
+        self.underlying = underlying
+        self.cache = cache
+        # the model name is part of the key, so switching models never returns stale vectors
+        self.model_name = model_name or getattr(underlying, "model", type(underlying).__name__)
+        self.query_cache_size = query_cache_size
+        self._query_vectors: OrderedDict = OrderedDict()
+        self._query_lock = threading.Lock()
+        self._query_flight = SingleFlight()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The counters of the in-memory query cache.
+        """
+        return {"hits": self.query_cache_hits, "misses": self.query_cache_misses,
+                "coalesced": self._query_flight.coalesced, "size": len(self._query_vectors)}
+
+    def _get_query_vector(self, text: str) -> Optional[List[float]]:
+        with self._query_lock:
+            vector = self._query_vectors.get(text)
+            if vector is None:
+                self.query_cache_misses += 1
+                return None
+            self._query_vectors.move_to_end(text)
+            self.query_cache_hits += 1
+            return vector
+
+    def _put_query_vector(self, text: str, vector: List[float]) -> None:
+        with self._query_lock:
+            self._query_vectors[text] = vector
+            self._query_vectors.move_to_end(text)
+            if len(self._query_vectors) > self.query_cache_size:
+                self._query_vectors.popitem(last=False)
+
+    def _keys(self, texts: List[str]) -> List[str]:
+        return [self.cache.make_key(text, self.model_name) for text in texts]
+
+    @staticmethod
+    def _missing(texts: List[str], keys: List[str], cached: Dict[str, List[float]]) -> Dict[str, str]:
+        # texts to embed by key, deduplicated so repeated rows are embedded once
+        return {key: text for key, text in zip(keys, texts) if key not in cached}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with span("embed_documents"):
+            keys = self._keys(texts)
+            cached = self.cache.get_many(keys)
+
+            missing = self._missing(texts, keys, cached)
+            if missing:
+                vectors = dict(zip(missing.keys(), self.underlying.embed_documents(list(missing.values()))))
+                self.cache.put_many(vectors)
+                cached.update(vectors)
+
+            return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        with span("embed_query"):
+            text = normalize_query(text)
+            vector = self._get_query_vector(text)
+            if vector is None:
+                vector = self._query_flight.do(text, self._embed_query, text)
+            return vector
+
+    def _embed_query(self, text: str) -> List[float]:
+        key = self.cache.make_key(text, self.model_name)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            vector = cached[key]
+        else:
+            vector = self.underlying.embed_query(text)
+            self.cache.put_many({key: vector})
+        self._put_query_vector(text, vector)
+        return vector
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        with span("embed_documents"):
+            keys = self._keys(texts)
+            # sqlite access is blocking, keep it off the event loop
+            cached = await run_in_executor(None, self.cache.get_many, keys)
+
+            missing = self._missing(texts, keys, cached)
+            if missing:
+                vectors = dict(zip(missing.keys(), await self.underlying.aembed_documents(list(missing.values()))))
+                await run_in_executor(None, self.cache.put_many, vectors)
+                cached.update(vectors)
+
+            return [cached[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        with span("embed_query"):
+            text = normalize_query(text)
+            vector = self._get_query_vector(text)
+            if vector is None:
+                vector = await self._query_flight.ado(text, self._aembed_query, text)
+            return vector
+
+    async def _aembed_query(self, text: str) -> List[float]:
+        key = self.cache.make_key(text, self.model_name)
+        cached = await run_in_executor(None, self.cache.get_many, [key])
+        if key in cached:
+            vector = cached[key]
+        else:
+            vector = await self.underlying.aembed_query(text)
+            await run_in_executor(None, self.cache.put_many, {key: vector})
+        self._put_query_vector(text, vector)
+        return vector
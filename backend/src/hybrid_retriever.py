@@ -0,0 +1,68 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables.config import run_in_executor
+
+from backend.src.metrics import span
+
+# Rank constant of reciprocal-rank fusion, 60 as in the original paper
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], rrf_k: int = RRF_K) -> List[str]:
+    """
+    Fuses ranked lists of ids: each id scores sum(1 / (rrf_k + rank)) over the lists it is in.
+    :param rankings: Lists of ids, best first.
+    :param rrf_k: The rank constant, larger values flatten the differences between ranks.
+    :return: All the ids, best fused score first.
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, start=1):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Combines dense retrieval from the vector store with BM25 retrieval from a lexical index,
+    using reciprocal-rank fusion. Exact terms such as customer names are found by BM25 even when
+    their embedding is not close to the question.
+    """
+
+    vector_retriever: BaseRetriever
+    lexical_index: Any
+    docstore: Any
+    k: int = 5
+    fetch_k: int = 20
+    rrf_k: int = RRF_K
+    # optional predicate on docstore ids applied to the BM25 results
+    allowed: Optional[Callable[[str], bool]] = None
+
+    def _fuse(self, dense: List[Document], lexical: List[str]) -> List[Document]:
+        fused = reciprocal_rank_fusion([[doc.id for doc in dense], lexical], self.rrf_k)[:self.k]
+        documents = {doc.id: doc for doc in dense}
+        # documents only found by BM25 are read from the docstore
+        missing = [id_ for id_ in fused if id_ not in documents]
+        documents.update((id_, doc) for id_, doc in zip(missing, self.docstore.mget(missing)) if doc is not None)
+        return [documents[id_] for id_ in fused if id_ in documents]
+
+    def _lexical_search(self, query: str) -> List[str]:
+        with span("bm25"):
+            return [doc_id for doc_id, _ in self.lexical_index.search(query, self.fetch_k, allowed=self.allowed)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        dense = self.vector_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return self._fuse(dense, self._lexical_search(query))
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        # both searches run at the same time
+        dense, lexical = await asyncio.gather(
+            self.vector_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()}),
+            run_in_executor(None, self._lexical_search, query),
+        )
+        return self._fuse(dense, lexical)
@@ -0,0 +1,809 @@
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+# Index types supported by the factory
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "sq8", "ivf_sq8")
+# Index type the store migrates to once it is large enough for approximate search ('flat' disables it)
+ANN_INDEX_TYPE = 'ivf_flat'
+# Number of vectors after which the flat index is trained and migrated to ANN_INDEX_TYPE
+ANN_MIGRATION_THRESHOLD = 50_000
+# Maximum number of vectors used to train the IVF and PQ quantizers
+MAX_TRAINING_VECTORS = 100_000
+
+# Search and build settings of the approximate indexes
+IVF_NPROBE = 16
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+# HNSW graphs cannot remove nodes: removed vectors are tombstoned (their id set to -1 and skipped
+# by the searches) and the index is only rebuilt once this fraction of its vectors are tombstones
+HNSW_REBUILD_TOMBSTONES = 0.2
+
+# A shard is closed once it holds SHARD_MAX_VECTORS vectors. An upload starts a new shard unless the
+# current one holds fewer than SHARD_MIN_VECTORS, so small files share a shard instead of each
+# adding a tiny index to every search.
+SHARD_MAX_VECTORS = 100_000
+SHARD_MIN_VECTORS = 10_000
+# Threads searching the shards of a query in parallel, faiss releases the GIL while it searches
+SHARD_SEARCH_THREADS = min(8, os.cpu_count() or 1)
+SHARDS_MANIFEST = 'shards.json'
+
+
+def _nlist(num_vectors: int) -> int:
+    # rule of thumb: about 4 * sqrt(n) inverted lists
+    return int(min(65536, max(16, 4 * math.sqrt(max(num_vectors, 1)))))
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    # the number of sub-quantizers must divide the dimension, with at least 8 dimensions each
+    for m in (64, 48, 32, 24, 16, 8, 4, 2):
+        if dimension % m == 0 and dimension // m >= 8:
+            return m
+    return 1
+
+
+def index_description(index_type: str, dimension: int, num_vectors: int = 0) -> str:
+    """
+    Builds the faiss index_factory description of an index type.
+    Flat, HNSW and SQ indexes are wrapped in IDMap2; IVF indexes store the ids themselves.
+
+    :param index_type: One of INDEX_TYPES.
+    :param dimension: The dimension of the vectors.
+    :param num_vectors: Expected number of vectors, used to size the IVF lists.
+    :return: The description string.
+    """
+    if index_type == "flat":
+        return "IDMap2,Flat"
+    if index_type == "hnsw":
+        return f"IDMap2,HNSW{HNSW_M}"
+    if index_type == "sq8":
+        return "IDMap2,SQ8"
+    if index_type == "ivf_flat":
+        return f"IVF{_nlist(num_vectors)},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{_nlist(num_vectors)},PQ{_pq_subquantizers(dimension)}"
+    if index_type == "ivf_sq8":
+        return f"IVF{_nlist(num_vectors)},SQ8"
+    raise ValueError(f"Unknown index_type: {index_type}. Use one of {', '.join(INDEX_TYPES)}")
+
+
+def configure_index(index) -> None:
+    """
+    Applies the search settings (nprobe, efSearch) and, for IVF indexes, a hashtable direct map
+    so vectors can be reconstructed and removed by id.
+    :param index: A faiss index created by this module.
+    :return: None
+    """
+    if isinstance(index, ShardedIndex):
+        for shard in index.shards.values():
+            configure_index(shard)
+        return
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(IVF_NPROBE, ivf.nlist)
+        if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return
+
+    if isinstance(index, faiss.IndexIDMap2):
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = HNSW_EF_SEARCH
+
+
+def _hnsw_id_map(index) -> Optional[np.ndarray]:
+    # writable view of the ids of an IDMap2 over HNSW, tombstones are -1; None for other indexes
+    if not isinstance(index, faiss.IndexIDMap2) or not isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW):
+        return None
+    return faiss.rev_swig_ptr(index.id_map.data(), index.id_map.size())
+
+
+def live_count(index) -> int:
+    """
+    :param index: A faiss index created by this module.
+    :return: Its number of vectors, without the HNSW tombstones.
+    """
+    id_map = _hnsw_id_map(index)
+    if id_map is None:
+        return index.ntotal
+    return int(np.count_nonzero(id_map >= 0))
+
+
+def search_parameters(index, selector):
+    """
+    Search parameters restricting a search to the ids accepted by a selector, of the type each index
+    requires (IVF and HNSW indexes reject the generic ones) and with the index's own search settings.
+    :param index: A faiss index created by this module.
+    :param selector: A faiss IDSelector.
+    :return: The faiss SearchParameters.
+    """
+    if isinstance(index, ShardedIndex):
+        # each shard gets the parameters of its own type when it is searched
+        return ShardSearchParameters(selector)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def create_index(index_type: str, dimension: int, num_vectors: int = 0):
+    """
+    Creates an empty, untrained index of the given type.
+    :param index_type: One of INDEX_TYPES.
+    :param dimension: The dimension of the vectors.
+    :param num_vectors: Expected number of vectors, used to size the IVF lists.
+    :return: The faiss index.
+    """
+    index = faiss.index_factory(dimension, index_description(index_type, dimension, num_vectors))
+    if index_type == "hnsw":
+        faiss.downcast_index(index.index).hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    configure_index(index)
+    return index
+
+
+def get_index_type(index) -> str:
+    """
+    :param index: A faiss index created by this module.
+    :return: Its index type, one of INDEX_TYPES.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        if isinstance(ivf, faiss.IndexIVFPQ):
+            return "ivf_pq"
+        if isinstance(ivf, faiss.IndexIVFScalarQuantizer):
+            return "ivf_sq8"
+        return "ivf_flat"
+
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return "sq8"
+    return "flat"
+
+
+def to_id_mapped_index(index, index_to_docstore_id):
+    """
+    Converts an index from previous versions (positional ids) into an id-mapped flat index,
+    using the positions as ids so the index-to-docstore ID mapping stays valid.
+    :param index: A faiss index.
+    :param index_to_docstore_id: The index-to-docstore ID mapping of the index.
+    :return: The id-mapped index (the same index if it already stores ids).
+    """
+    if isinstance(index, ShardedIndex):
+        configure_index(index)
+        return index
+    if isinstance(index, faiss.IndexIDMap2) or faiss.try_extract_index_ivf(index) is not None:
+        configure_index(index)
+        return index
+    id_mapped = create_index("flat", index.d)
+    if index.ntotal:
+        vectors = index.reconstruct_n(0, index.ntotal)
+        positions = np.array(sorted(index_to_docstore_id), dtype=np.int64)
+        id_mapped.add_with_ids(vectors[positions], positions)
+    return id_mapped
+
+
+def read_index(path, mmap: bool = False):
+    """
+    Reads an index written with write_index and applies the search settings.
+    :param path: The file path of the index, a directory for a sharded index.
+    :param mmap: Memory-map the index read-only instead of reading it into memory. Processes that
+        map the same file share its pages through the page cache. With this faiss version only the
+        inverted lists of IVF indexes are mapped, other index types are still read into memory.
+    :return: The faiss index.
+    """
+    if os.path.isdir(path):
+        return ShardedIndex.read(path, mmap=mmap)
+    index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0)
+    configure_index(index)
+    return index
+
+
+def write_index(index, path) -> None:
+    """
+    Writes an index, a sharded index as a directory with one file per shard.
+    :param index: A faiss index or a ShardedIndex.
+    :param path: The file path of the index.
+    :return: None
+    """
+    if isinstance(index, ShardedIndex):
+        index.write(path)
+    else:
+        faiss.write_index(index, path)
+
+
+def clone_index(index):
+    """
+    :param index: A faiss index or a ShardedIndex.
+    :return: A copy of the index, whose changes do not affect the original.
+    """
+    if isinstance(index, ShardedIndex):
+        return index.clone()
+    return faiss.clone_index(index)
+
+
+def make_writable(index) -> None:
+    """
+    Copies the inverted lists of an index memory-mapped read-only into memory, so that vectors
+    can be added to it or removed from it. Does nothing for other indexes.
+    :param index: A faiss index created by this module.
+    :return: None
+    """
+    if isinstance(index, ShardedIndex):
+        for shard in index.shards.values():
+            make_writable(shard)
+        return
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return
+    mapped = faiss.downcast_InvertedLists(ivf.invlists)
+    if not isinstance(mapped, faiss.OnDiskInvertedLists) or not mapped.read_only:
+        return
+    invlists = faiss.ArrayInvertedLists(ivf.nlist, ivf.code_size)
+    for list_no in range(ivf.nlist):
+        size = mapped.list_size(list_no)
+        if size:
+            invlists.add_entries(list_no, size, mapped.get_ids(list_no), mapped.get_codes(list_no))
+    # the index owns the new lists from now on
+    invlists.this.disown()
+    ivf.replace_invlists(invlists, True)
+
+
+def extract_vectors(index) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads all the ids and (reconstructed) vectors stored in an index.
+    :param index: A faiss index created by this module.
+    :return: A tuple (ids, vectors).
+    """
+    if isinstance(index, ShardedIndex):
+        extracted = [extract_vectors(shard) for shard in index.shards.values()]
+        if not extracted:
+            return np.empty(0, dtype=np.int64), np.empty((0, index.d), dtype=np.float32)
+        return np.concatenate([ids for ids, _ in extracted]), np.vstack([vectors for _, vectors in extracted])
+    ids = stored_ids(index)
+    if faiss.try_extract_index_ivf(index) is not None:
+        vectors = index.reconstruct_batch(ids) if len(ids) else np.empty((0, index.d), dtype=np.float32)
+        return ids, vectors
+
+    inner = faiss.downcast_index(index.index)
+    vectors = inner.reconstruct_n(0, inner.ntotal) if inner.ntotal else np.empty((0, index.d), dtype=np.float32)
+    # the rows of the HNSW tombstones are dropped, as stored_ids drops their ids
+    return ids, vectors[faiss.vector_to_array(index.id_map) >= 0]
+
+
+def stored_ids(index) -> np.ndarray:
+    """
+    Reads the ids stored in an index, without its vectors.
+    :param index: A faiss index created by this module.
+    :return: The ids, without the HNSW tombstones, in the order extract_vectors returns the vectors.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        invlists = ivf.invlists
+        ids = [faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+               for i in range(ivf.nlist) if invlists.list_size(i)]
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+    return ids[ids >= 0]
+
+
+def build_index(index_type: str, ids: np.ndarray, vectors: np.ndarray):
+    """
+    Creates an index of the given type, trains it on (a sample of) the vectors and adds them.
+    :param index_type: One of INDEX_TYPES.
+    :param ids: The vector ids.
+    :param vectors: The vectors, in the order of the ids.
+    :return: The filled faiss index.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index = create_index(index_type, vectors.shape[1], len(vectors))
+    if not index.is_trained:
+        sample = vectors
+        if len(vectors) > MAX_TRAINING_VECTORS:
+            rows = np.random.default_rng(0).choice(len(vectors), MAX_TRAINING_VECTORS, replace=False)
+            sample = vectors[rows]
+        index.train(sample)
+    if len(vectors):
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    return index
+
+
+def remove_ids(index, index_ids: np.ndarray):
+    """
+    Removes vectors by id. The vectors of HNSW indexes, which do not support removal, are
+    tombstoned, and the index is rebuilt without them once they pass HNSW_REBUILD_TOMBSTONES.
+    :param index: A faiss index created by this module.
+    :param index_ids: The ids to remove.
+    :return: The index to use from now on (the same one, unless it was rebuilt).
+    """
+    index_ids = np.asarray(index_ids, dtype=np.int64)
+    if isinstance(index, ShardedIndex):
+        index.remove_ids(index_ids)
+        return index
+    id_map = _hnsw_id_map(index)
+    if id_map is not None:
+        id_map[np.isin(id_map, index_ids)] = -1
+        if live_count(index) < index.ntotal * (1 - HNSW_REBUILD_TOMBSTONES):
+            ids, vectors = extract_vectors(index)
+            return build_index("hnsw", ids, vectors)
+        index.construct_rev_map()
+        return index
+    make_writable(index)
+    try:
+        index.remove_ids(index_ids)
+        return index
+    except RuntimeError:
+        ids, vectors = extract_vectors(index)
+        keep = ~np.isin(ids, index_ids)
+        return build_index(get_index_type(index), ids[keep], vectors[keep])
+
+
+def needs_migration(index) -> bool:
+    """
+    :param index: A faiss index created by this module.
+    :return: True if it is a flat index that passed ANN_MIGRATION_THRESHOLD and ANN_INDEX_TYPE is approximate.
+    """
+    return ANN_INDEX_TYPE != "flat" and get_index_type(index) == "flat" and index.ntotal >= ANN_MIGRATION_THRESHOLD
+
+
+def migration_candidates(index) -> List[int]:
+    """
+    :param index: A ShardedIndex.
+    :return: The keys of its shards to migrate to ANN_INDEX_TYPE.
+    """
+    return [key for key, shard in index.shards.items() if needs_migration(shard)]
+
+
+def build_migrated_index(ids: np.ndarray, vectors: np.ndarray):
+    """
+    Trains and builds an ANN_INDEX_TYPE index from a copy of the vectors of a flat index. Takes a
+    while for large indexes, so it runs on a copy while the flat index keeps serving the searches.
+    :param ids: The vector ids.
+    :param vectors: The vectors, in the order of the ids.
+    :return: The new faiss index.
+    """
+    print(f"Migrating a FAISS index with {len(ids)} vectors to {ANN_INDEX_TYPE}...")
+    return build_index(ANN_INDEX_TYPE, ids, vectors)
+
+
+def sync_index(index, copied_ids: np.ndarray, source):
+    """
+    Applies to an index built from a copy of another one the changes made to that one since the copy:
+    the vectors added since are added, the removed ones are removed.
+    :param index: The index built from the copy.
+    :param copied_ids: The ids of the copied vectors.
+    :param source: The index the vectors were copied from.
+    :return: The index to use from now on, see remove_ids.
+    """
+    current_ids = stored_ids(source)
+    added = np.setdiff1d(current_ids, copied_ids)
+    removed = np.setdiff1d(copied_ids, current_ids)
+    if len(added):
+        index.add_with_ids(source.reconstruct_batch(added), added)
+    if len(removed):
+        index = remove_ids(index, removed)
+    return index
+
+
+class ShardSearchParameters:
+    """
+    Search parameters of a ShardedIndex: the IDSelector applied to every shard.
+    """
+
+    def __init__(self, sel):
+        self.sel = sel
+
+
+_search_executor = None
+_search_executor_lock = threading.Lock()
+
+
+def _get_search_executor() -> ThreadPoolExecutor:
+    global _search_executor
+    if _search_executor is None:
+        with _search_executor_lock:
+            if _search_executor is None:
+                _search_executor = ThreadPoolExecutor(max_workers=SHARD_SEARCH_THREADS,
+                                                      thread_name_prefix="shard-search")
+    return _search_executor
+
+
+# accepts every id but the -1 of the HNSW tombstones, so that they do not take the place of results
+_LIVE_IDS = faiss.IDSelectorRange(0, np.iinfo(np.int64).max)
+
+
+def _search_shards(shards, x, k, selector) -> List[Tuple[np.ndarray, np.ndarray]]:
+    results = []
+    for shard in shards:
+        shard_selector = selector
+        if shard_selector is None and _hnsw_id_map(shard) is not None:
+            shard_selector = _LIVE_IDS
+        results.append(shard.search(x, k, params=None if shard_selector is None
+                                    else search_parameters(shard, shard_selector)))
+    return results
+
+
+class _ReadWriteLock:
+    """
+    Lock held by any number of readers or by one writer. A waiting writer holds the new readers
+    back, so that a stream of searches does not starve the changes. A thread can take the lock again
+    while it holds it, and the writer can also read.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writer = None
+        self._write_depth = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self._local, "read_depth", 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.read_depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.read_depth = depth
+            return
+        with self._condition:
+            while self._writer is not None or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        self._local.read_depth = 1
+        try:
+            yield
+        finally:
+            self._local.read_depth = 0
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me:
+                self._writers_waiting += 1
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+                self._writers_waiting -= 1
+                self._writer = me
+            self._write_depth += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._write_depth -= 1
+                if not self._write_depth:
+                    self._writer = None
+                    self._condition.notify_all()
+
+
+class ShardedIndex:
+    """
+    Index split into shards, each a faiss index created by this module, which implements the part
+    of the faiss Index interface used by the vector store.
+
+    A shard holds a contiguous range of vector ids and is keyed by the first one: new vectors go to
+    the newest (open) shard, a new one is opened when an upload starts (see seal) or the open one
+    is full, and the shard of an id is found by bisecting the keys. A query is searched on the shards
+    in parallel, in at most SHARD_SEARCH_THREADS groups of similar size, and the top k of each shard
+    are merged with a faiss ResultHeap. Removing all the vectors of a shard, e.g. deleting the file
+    that filled it, drops the shard instead of removing the ids one by one.
+
+    Vectors are added to and removed from the shards in place, so the searches and reads hold a
+    read lock and the changes a write lock: the searches run in parallel with each other, and a
+    change waits for the searches in flight to finish.
+    """
+
+    def __init__(self, d: int, shards: Optional[Dict[int, object]] = None, metric_type=faiss.METRIC_L2):
+        self.d = d
+        self.metric_type = metric_type
+        self.is_trained = True
+        self._layout = (np.empty(0, dtype=np.int64), [])
+        self._set_shards(shards or {})
+        # key of the shard receiving new vectors, None when the next ones start a new shard
+        self._open = int(self._layout[0][-1]) if len(self._layout[0]) else None
+        self._lock = _ReadWriteLock()
+
+    @property
+    def shards(self) -> Dict[int, object]:
+        """
+        :return: The shards by key, in the order of the keys.
+        """
+        keys, shards = self._layout
+        return dict(zip(keys.tolist(), shards))
+
+    @property
+    def ntotal(self) -> int:
+        with self._lock.read():
+            return sum(live_count(shard) for shard in self._layout[1])
+
+    def _set_shards(self, shards: Dict[int, object]) -> None:
+        keys = sorted(shards)
+        self._layout = (np.array(keys, dtype=np.int64), [shards[key] for key in keys])
+
+    def replace_shards(self, shards: Dict[int, object]) -> None:
+        """
+        Replaces or adds shards.
+        :param shards: The new shards by key.
+        :return: None
+        """
+        with self._lock.write():
+            self._set_shards({**self.shards, **shards})
+
+    def _positions(self, ids: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        # position of the shard of each id in the keys
+        return np.maximum(np.searchsorted(keys, ids, side="right") - 1, 0)
+
+    def shard_keys(self, ids) -> List[int]:
+        """
+        :param ids: Vector ids.
+        :return: The keys of the shards holding those ids.
+        """
+        keys, _ = self._layout
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(keys) or not len(ids):
+            return []
+        return keys[np.unique(self._positions(ids, keys))].tolist()
+
+    def ensure_shards(self, keys: List[int]) -> None:
+        """
+        Creates the shards that are missing, e.g. when replaying the vectors added to them.
+        :param keys: Shard keys.
+        :return: None
+        """
+        with self._lock.write():
+            shards = self.shards
+            missing = {int(key): create_index("flat", self.d) for key in keys if int(key) not in shards}
+            if missing:
+                self._set_shards({**shards, **missing})
+                if max(missing) == int(self._layout[0][-1]):
+                    self._open = max(missing)
+
+    def seal(self, min_vectors: Optional[int] = None) -> None:
+        """
+        Closes the open shard if it holds at least min_vectors vectors, the next vectors then start
+        a new shard. Called when an upload starts, so that a file gets shards of its own.
+        :param min_vectors: Minimum size of the shard to close, SHARD_MIN_VECTORS by default.
+        :return: None
+        """
+        if min_vectors is None:
+            min_vectors = SHARD_MIN_VECTORS
+        with self._lock.write():
+            open_shard = self.shards.get(self._open)
+            if open_shard is not None and open_shard.ntotal >= min_vectors:
+                self._open = None
+
+    def add_with_ids(self, x, ids) -> None:
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        with self._lock.write():
+            shards = self.shards
+            open_shard = shards.get(self._open)
+            first_id = int(ids.min())
+            if ((open_shard is None or open_shard.ntotal >= SHARD_MAX_VECTORS)
+                    and (not shards or first_id > max(shards))):
+                # keys grow with the ids, older ids (replayed from previous versions) go to their shard
+                self._open = first_id
+                self._set_shards({**shards, first_id: create_index("flat", self.d)})
+            keys, shards = self._layout
+            positions = self._positions(ids, keys)
+            for position in np.unique(positions):
+                selected = positions == position
+                make_writable(shards[position])
+                shards[position].add_with_ids(x[selected], ids[selected])
+
+    def remove_ids(self, ids) -> int:
+        """
+        Removes vectors by id. A shard whose vectors are all removed is dropped.
+        :param ids: The ids to remove.
+        :return: The number of vectors removed.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        removed = 0
+        with self._lock.write():
+            keys, shards = self._layout
+            if not len(keys) or not len(ids):
+                return 0
+            positions = self._positions(ids, keys)
+            replaced, dropped = {}, set()
+            for position in np.unique(positions):
+                shard_ids = ids[positions == position]
+                shard = shards[position]
+                before = live_count(shard)
+                if len(shard_ids) >= before and len(np.intersect1d(shard_ids, stored_ids(shard))) == before:
+                    dropped.add(int(keys[position]))
+                    removed += before
+                    continue
+                new_shard = remove_ids(shard, shard_ids)
+                after = live_count(new_shard)
+                removed += before - after
+                if after == 0:
+                    dropped.add(int(keys[position]))
+                elif new_shard is not shard:
+                    replaced[int(keys[position])] = new_shard
+            shards = {**self.shards, **replaced}
+            for key in dropped:
+                del shards[key]
+            self._set_shards(shards)
+            if self._open in dropped:
+                self._open = None
+        return removed
+
+    def reconstruct_batch(self, ids) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.empty((len(ids), self.d), dtype=np.float32)
+        if not len(ids):
+            return vectors
+        with self._lock.read():
+            keys, shards = self._layout
+            positions = self._positions(ids, keys)
+            for position in np.unique(positions):
+                selected = positions == position
+                vectors[selected] = shards[position].reconstruct_batch(ids[selected])
+        return vectors
+
+    def search(self, x, k, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches the shards in parallel and merges their results.
+        :param x: The query vectors, of shape (n, d).
+        :param k: Number of results per query.
+        :param params: Optional ShardSearchParameters restricting the search to the ids of a selector.
+        :return: The (distances, ids) arrays, as returned by faiss.
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        selector = params.sel if params is not None else None
+        with self._lock.read():
+            return self._search(x, k, selector)
+
+    def _search(self, x, k, selector) -> Tuple[np.ndarray, np.ndarray]:
+        shards = [shard for shard in self._layout[1] if shard.ntotal]
+        if len(shards) == 1:
+            return _search_shards(shards, x, k, selector)[0]
+
+        # shards are spread over the threads largest first, each going to the least loaded group
+        groups = [[] for _ in range(min(SHARD_SEARCH_THREADS, len(shards)))]
+        loads = [0] * len(groups)
+        for shard in sorted(shards, key=lambda shard: shard.ntotal, reverse=True):
+            group = loads.index(min(loads))
+            groups[group].append(shard)
+            loads[group] += shard.ntotal
+
+        heap = faiss.ResultHeap(len(x), k, keep_max=self.metric_type == faiss.METRIC_INNER_PRODUCT)
+        if len(groups) > 1:
+            executor = _get_search_executor()
+            results = [future.result() for future in
+                       [executor.submit(_search_shards, group, x, k, selector) for group in groups]]
+        else:
+            results = [_search_shards(group, x, k, selector) for group in groups]
+        for group_results in results:
+            for distances, labels in group_results:
+                heap.add_result(np.ascontiguousarray(distances, dtype=np.float32),
+                                np.ascontiguousarray(labels, dtype=np.int64))
+        heap.finalize()
+        return heap.D, heap.I
+
+    def clone(self) -> "ShardedIndex":
+        """
+        :return: A copy of the index, with copies of the shards.
+        """
+        with self._lock.read():
+            clone = ShardedIndex(self.d, {key: faiss.clone_index(shard) for key, shard in self.shards.items()},
+                                 self.metric_type)
+            clone._open = self._open
+        return clone
+
+    def write(self, path) -> None:
+        """
+        Writes the index as a directory with one file per shard.
+        :param path: The directory.
+        :return: None
+        """
+        os.makedirs(path, exist_ok=True)
+        with self._lock.read():
+            shards = self.shards
+            for key, shard in shards.items():
+                faiss.write_index(shard, os.path.join(path, f"shard_{key:012d}.index"))
+        with open(os.path.join(path, SHARDS_MANIFEST), "w") as f:
+            json.dump({"d": self.d, "metric_type": int(self.metric_type), "shards": list(shards)}, f)
+
+    @classmethod
+    def read(cls, path, mmap: bool = False) -> "ShardedIndex":
+        """
+        Reads an index written with write.
+        :param path: The directory.
+        :param mmap: Memory-map the shards read-only (see read_index).
+        :return: The ShardedIndex.
+        """
+        with open(os.path.join(path, SHARDS_MANIFEST)) as f:
+            manifest = json.load(f)
+        shards = {key: read_index(os.path.join(path, f"shard_{key:012d}.index"), mmap=mmap)
+                  for key in manifest["shards"]}
+        return cls(manifest["d"], shards, manifest["metric_type"])
+
+
+def to_sharded_index(index) -> ShardedIndex:
+    """
+    :param index: A faiss index created by this module, or a ShardedIndex.
+    :return: A ShardedIndex, with the faiss index as its only shard.
+    """
+    if isinstance(index, ShardedIndex):
+        return index
+    return ShardedIndex(index.d, {0: index} if index.ntotal else {}, index.metric_type)
+
+
+def evaluate_index_types(vectors: np.ndarray, queries: np.ndarray, k: int = 5,
+                         index_types=INDEX_TYPES) -> List[Dict]:
+    """
+    Measures recall@k and query latency of each index type against exact (flat) search.
+
+    :param vectors: The vectors to index.
+    :param queries: The query vectors.
+    :param k: Number of neighbours compared.
+    :param index_types: The index types to evaluate.
+    :return: One dict per index type with build time, recall@k and mean latency per query.
+    """
+    ids = np.arange(len(vectors), dtype=np.int64)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    exact = build_index("flat", ids, vectors)
+    _, exact_ids = exact.search(queries, k)
+
+    results = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        index = build_index(index_type, ids, vectors)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # one query at a time, as the retriever does
+        approx_ids = np.vstack([index.search(query[None, :], k)[1] for query in queries])
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        hits = sum(len(set(a) & set(e)) for a, e in zip(approx_ids.tolist(), exact_ids.tolist()))
+        results.append({"index_type": index_type, "build_s": build_seconds,
+                        "recall_at_k": hits / (len(queries) * k), "latency_ms": latency_ms})
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from backend.src.retriever import get_vector_store
+
+    parser = argparse.ArgumentParser(description="Recall@k and latency of each index type on the stored vectors")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    _, stored_vectors = extract_vectors(get_vector_store().index)
+    rng = np.random.default_rng(0)
+    # queries are stored vectors with a little noise, so they are realistic but not exact matches
+    query_rows = rng.choice(len(stored_vectors), min(args.queries, len(stored_vectors)), replace=False)
+    noise = rng.normal(0, stored_vectors.std() * 0.1, (len(query_rows), stored_vectors.shape[1]))
+    query_vectors = (stored_vectors[query_rows] + noise).astype(np.float32)
+
+    print(f"{len(stored_vectors)} vectors, {len(query_vectors)} queries, k={args.k}")
+    print(f"{'index_type':<10} {'build (s)':>10} {'recall@k':>10} {'latency (ms)':>13}")
+    for result in evaluate_index_types(stored_vectors, query_vectors, k=args.k):
+        print(f"{result['index_type']:<10} {result['build_s']:>10.2f} {result['recall_at_k']:>10.3f} "
+              f"{result['latency_ms']:>13.3f}")
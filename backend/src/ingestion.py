@@ -0,0 +1,132 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, List, Tuple
+
+import openai
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+# Number of chunks sent in each embedding request
+EMBEDDING_BATCH_SIZE = 256
+# Number of embedding requests in flight at the same time
+EMBEDDING_MAX_CONCURRENCY = 4
+# Retries of a batch after a rate limit (429) response
+EMBEDDING_MAX_RETRIES = 6
+# Exponential backoff settings, in seconds
+EMBEDDING_BACKOFF_BASE = 1.0
+EMBEDDING_BACKOFF_MAX = 60.0
+
+
+def _retry_after(error: openai.RateLimitError) -> float:
+    # the API may tell us how long to wait
+    try:
+        return float(error.response.headers.get("retry-after", 0))
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+def embed_with_backoff(embeddings: Embeddings, texts: List[str], max_retries=EMBEDDING_MAX_RETRIES,
+                       backoff_base=EMBEDDING_BACKOFF_BASE, backoff_max=EMBEDDING_BACKOFF_MAX) -> List[List[float]]:
+    """
+    Embeds a batch of texts, retrying with exponential backoff and jitter when rate limited.
+
+    :param embeddings: The embedding model.
+    :param texts: The texts of the batch.
+    :param max_retries: Number of retries before giving up.
+    :param backoff_base: Delay before the first retry, in seconds.
+    :param backoff_max: Maximum delay between retries, in seconds.
+    :return: The embedding vectors, in the order of the texts.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return embeddings.embed_documents(texts)
+        except openai.RateLimitError as e:
+            if attempt == max_retries:
+                raise
+            delay = min(backoff_max, backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+            delay = max(delay, _retry_after(e))
+            print(f"Embedding batch rate limited, retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
+            time.sleep(delay)
+
+
+def embed_in_batches(embeddings: Embeddings, texts: List[str], batch_size=EMBEDDING_BATCH_SIZE,
+                     max_concurrency=EMBEDDING_MAX_CONCURRENCY, **backoff_kwargs) -> Iterator[Tuple[int, List[List[float]]]]:
+    """
+    Splits the texts into batches and embeds up to max_concurrency batches at once.
+    Batches are yielded as soon as they are embedded, so not necessarily in order.
+
+    :param embeddings: The embedding model.
+    :param texts: The texts to embed.
+    :param batch_size: Number of texts per embedding request.
+    :param max_concurrency: Maximum number of batches embedded at the same time.
+    :param backoff_kwargs: Retry settings forwarded to embed_with_backoff.
+    :return: An iterator of (start offset of the batch, vectors of the batch).
+    """
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        futures = {
+            executor.submit(embed_with_backoff, embeddings, texts[start:start + batch_size], **backoff_kwargs): start
+            for start in range(0, len(texts), batch_size)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # on failure, do not start the batches still waiting
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def embed_documents(embeddings: Embeddings, texts: List[str], batch_size=EMBEDDING_BATCH_SIZE,
+                    max_concurrency=EMBEDDING_MAX_CONCURRENCY, **backoff_kwargs) -> List[List[float]]:
+    """
+    Embeds texts in concurrent batches, see embed_in_batches.
+
+    :param embeddings: The embedding model.
+    :param texts: The texts to embed.
+    :param batch_size: Number of texts per embedding request.
+    :param max_concurrency: Maximum number of batches embedded at the same time.
+    :param backoff_kwargs: Retry settings forwarded to embed_with_backoff.
+    :return: The embedding vectors, in the order of the texts.
+    """
+    vectors = [None] * len(texts)
+    for start, batch_vectors in embed_in_batches(embeddings, texts, batch_size=batch_size,
+                                                 max_concurrency=max_concurrency, **backoff_kwargs):
+        vectors[start:start + len(batch_vectors)] = batch_vectors
+    return vectors
+
+
+def add_documents_in_batches(vector_store, documents: List[Document], batch_size=EMBEDDING_BATCH_SIZE,
+                             max_concurrency=EMBEDDING_MAX_CONCURRENCY, on_batch_added=None,
+                             **backoff_kwargs) -> List[str]:
+    """
+    Embeds documents in concurrent batches and adds each batch to the FAISS vector store as soon as
+    it is embedded. If any batch fails, the batches already added are removed again.
+
+    :param vector_store: The FAISS vector store.
+    :param documents: The documents (chunks) to add.
+    :param batch_size: Number of documents per embedding request.
+    :param max_concurrency: Maximum number of batches embedded at the same time.
+    :param on_batch_added: Optional callback called with (ids, vectors) after each batch is added.
+    :param backoff_kwargs: Retry settings forwarded to embed_with_backoff.
+    :return: The docstore ids of the added documents.
+    """
+    texts = [doc.page_content for doc in documents]
+    added_ids = []
+    try:
+        for start, vectors in embed_in_batches(vector_store.embeddings, texts, batch_size=batch_size,
+                                               max_concurrency=max_concurrency, **backoff_kwargs):
+            batch = documents[start:start + len(vectors)]
+            # writes happen on this thread only, one batch at a time
+            ids = vector_store.add_embeddings(
+                zip(texts[start:start + len(vectors)], vectors),
+                metadatas=[doc.metadata for doc in batch],
+            )
+            added_ids.extend(ids)
+            if on_batch_added is not None:
+                on_batch_added(ids, vectors)
+    except Exception:
+        if added_ids:
+            vector_store.delete(added_ids)
+        raise
+
+    return added_ids
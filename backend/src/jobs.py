@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Optional
+
+from backend.src.chunking import iter_chunk_batches
+from backend.src.database_utils import delete_document_record
+from backend.src.metrics import record, span
+from backend.src.retriever import index_document_batches_to_faiss
+
+# Number of ingestion jobs running at the same time
+JOB_WORKERS = 1
+# Maximum number of jobs waiting for a worker, uploads are refused beyond that
+JOB_MAX_QUEUED = 16
+# Number of finished jobs kept for /jobs
+MAX_FINISHED_JOBS = 100
+# Niceness of the ingestion threads, so the OS schedules the chat threads first
+INGESTION_NICENESS = 10
+# Seconds a batch waits for the chat requests in flight to finish before it is indexed anyway
+INTERACTIVE_MAX_WAIT = 2.0
+# Chunking of the uploaded files
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+_executor = None
+# number of chat requests in flight, the ingestion batches wait for them
+_interactive_requests = 0
+_interactive_condition = threading.Condition()
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class IngestionJob:
+    """
+    Ingestion of one uploaded file, run by the job workers: its status (queued, running,
+    succeeded, failed or cancelled) and its progress in rows, chunks and vectors.
+    """
+
+    def __init__(self, filename, file_path, file_id):
+        self.job_id = str(uuid.uuid4())
+        self.filename = filename
+        self.file_path = file_path
+        self.file_id = file_id
+        self.status = "queued"
+        self.rows_done = 0
+        self.chunks_done = 0
+        self.vectors_done = 0
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = threading.Event()
+        self.future = None
+
+    @property
+    def finished(self):
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id, "filename": self.filename, "file_id": self.file_id, "status": self.status,
+            "rows_done": self.rows_done, "chunks_done": self.chunks_done, "vectors_done": self.vectors_done,
+            "error": self.error, "created_at": self.created_at, "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+@contextmanager
+def interactive_request():
+    """
+    Marks a chat request in flight, the ingestion jobs give way to it between batches.
+    """
+    global _interactive_requests
+    with _interactive_condition:
+        _interactive_requests += 1
+    try:
+        yield
+    finally:
+        with _interactive_condition:
+            _interactive_requests -= 1
+            _interactive_condition.notify_all()
+
+
+def _wait_for_interactive_requests(max_wait=INTERACTIVE_MAX_WAIT):
+    deadline = time.monotonic() + max_wait
+    with _interactive_condition:
+        while _interactive_requests:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _interactive_condition.wait(remaining)
+
+
+def _lower_thread_priority():
+    # on Linux the niceness applies to the calling thread only
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), INGESTION_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="ingestion",
+                                       initializer=_lower_thread_priority)
+    return _executor
+
+
+def _track_progress(job, chunk_batches):
+    # counts the rows and chunks of each batch, and stops between batches on cancellation
+    for chunks in chunk_batches:
+        if job.cancel_requested.is_set():
+            raise JobCancelled(f"Ingestion job {job.job_id} cancelled")
+        _wait_for_interactive_requests()
+        if chunks:
+            job.rows_done = chunks[-1].metadata.get("row", job.rows_done - 1) + 1
+        job.chunks_done += len(chunks)
+        yield chunks
+
+
+def _finish(job, status, error=None):
+    if status != "succeeded":
+        # the chunks already indexed were rolled back, remove the record too
+        delete_document_record(job.file_id)
+    if os.path.exists(job.file_path):
+        os.remove(job.file_path)
+    job.error = error
+    job.finished_at = time.time()
+    job.status = status
+    with _jobs_lock:
+        finished = [job_id for job_id, other in _jobs.items() if other.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del _jobs[job_id]
+
+
+def _run_job(job):
+    if job.cancel_requested.is_set():
+        _finish(job, "cancelled")
+        return
+    job.status = "running"
+    job.started_at = time.time()
+    record("job_queue_wait", job.started_at - job.created_at)
+
+    def count_vectors(added):
+        job.vectors_done += added
+
+    try:
+        chunk_batches = _track_progress(job, iter_chunk_batches(job.file_path, CHUNK_SIZE, CHUNK_OVERLAP))
+        with span("ingestion_job"):
+            index_document_batches_to_faiss(chunk_batches, job.file_id, on_batch_indexed=count_vectors)
+    except JobCancelled:
+        _finish(job, "cancelled")
+    except Exception as e:
+        print(f"Error running ingestion job {job.job_id}: {e}")
+        _finish(job, "failed", error=f"Error processing file {job.filename}: {e}")
+    else:
+        _finish(job, "succeeded")
+
+
+def submit_ingestion_job(filename, file_path, file_id) -> IngestionJob:
+    """
+    Queues the ingestion of an uploaded file. The job removes the file when it finishes, and the
+    document record if the ingestion fails or is cancelled.
+
+    :param filename: The name of the uploaded file.
+    :param file_path: The path of the uploaded file on disk.
+    :param file_id: The id of its document record.
+    :return: The job.
+    :raises JobQueueFull: If JOB_MAX_QUEUED jobs are already waiting.
+    """
+    job = IngestionJob(filename, file_path, file_id)
+    with _jobs_lock:
+        queued = sum(other.status == "queued" for other in _jobs.values())
+        if queued >= JOB_MAX_QUEUED:
+            raise JobQueueFull(f"{queued} ingestion jobs are already queued")
+        _jobs[job.job_id] = job
+        job.future = _get_executor().submit(_run_job, job)
+    return job
+
+
+def get_job(job_id) -> Optional[IngestionJob]:
+    return _jobs.get(job_id)
+
+
+def list_jobs() -> List[IngestionJob]:
+    """
+    :return: The jobs queued, running and recently finished, newest first.
+    """
+    with _jobs_lock:
+        return list(reversed(_jobs.values()))
+
+
+def cancel_job(job_id) -> Optional[IngestionJob]:
+    """
+    Cancels a job. A queued job is cancelled at once, a running job stops before its next batch
+    and the batches already indexed are rolled back.
+
+    :param job_id: The job id.
+    :return: The job, or None if it does not exist.
+    """
+    job = _jobs.get(job_id)
+    if job is None or job.finished:
+        return job
+    job.cancel_requested.set()
+    if job.future is not None and job.future.cancel():
+        _finish(job, "cancelled")
+    return job
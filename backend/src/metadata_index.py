@@ -0,0 +1,122 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+# Metadata fields with an index, that filters on are applied inside the vector search
+FILTER_FIELDS = ("file_id", "customer", "nps_type")
+
+FilterValue = Union[str, int, List[Union[str, int]]]
+
+
+def _normalize(value) -> str:
+    # filters match regardless of case and surrounding spaces, and of the type of ids (1 == "1")
+    return str(value).strip().lower()
+
+
+class MetadataIndex:
+    """
+    Inverted index from metadata values to vector ids, one per field of FILTER_FIELDS.
+
+    A filter such as {"file_id": [3, 4], "nps_type": "detractor"} (values of a field are OR-ed,
+    fields are AND-ed) is turned into a sorted array of vector ids, which the vector store passes
+    to faiss as an IDSelector so only that subset is searched. The sorted array of each value is
+    cached until the value gets new ids or loses some.
+    """
+
+    def __init__(self, fields=FILTER_FIELDS):
+        self.fields = tuple(fields)
+        self._lock = threading.Lock()
+        self._postings: Dict[str, Dict[str, set]] = {field: {} for field in self.fields}
+        # indexed values of each vector id, used to remove it and to check single documents
+        self._values: Dict[int, Dict[str, str]] = {}
+        self._arrays: Dict[tuple, np.ndarray] = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def ids(self) -> set:
+        """
+        :return: The indexed vector ids.
+        """
+        with self._lock:
+            return set(self._values)
+
+    def add(self, index_ids: Iterable[int], metadatas: Iterable[dict]) -> None:
+        """
+        Indexes the metadata fields of documents.
+        :param index_ids: The vector ids.
+        :param metadatas: The metadata dicts, in the order of the ids.
+        :return: None
+        """
+        with self._lock:
+            for index_id, metadata in zip(index_ids, metadatas):
+                index_id = int(index_id)
+                values = {field: _normalize(metadata[field]) for field in self.fields
+                          if metadata.get(field) is not None}
+                self._values[index_id] = values
+                for field, value in values.items():
+                    self._postings[field].setdefault(value, set()).add(index_id)
+                    self._arrays.pop((field, value), None)
+
+    def delete(self, index_ids: Iterable[int]) -> None:
+        """
+        Removes documents. Unknown ids are ignored.
+        :param index_ids: The vector ids.
+        :return: None
+        """
+        with self._lock:
+            for index_id in index_ids:
+                for field, value in self._values.pop(int(index_id), {}).items():
+                    ids = self._postings[field][value]
+                    ids.discard(int(index_id))
+                    if not ids:
+                        del self._postings[field][value]
+                    self._arrays.pop((field, value), None)
+
+    def supports(self, filter) -> bool:
+        """
+        :param filter: A search filter.
+        :return: True if the filter is a dict on indexed fields, which select can apply.
+        """
+        return isinstance(filter, dict) and bool(filter) and all(field in self.fields for field in filter)
+
+    def _value_ids(self, field, value) -> np.ndarray:
+        key = (field, value)
+        if key not in self._arrays:
+            self._arrays[key] = np.array(sorted(self._postings[field].get(value, ())), dtype=np.int64)
+        return self._arrays[key]
+
+    def select(self, filter: Dict[str, FilterValue]) -> np.ndarray:
+        """
+        :param filter: A dict of field -> value or list of values.
+        :return: The sorted vector ids of the documents matching the filter.
+        """
+        selected: Optional[np.ndarray] = None
+        with self._lock:
+            for field, values in filter.items():
+                values = values if isinstance(values, (list, tuple, set)) else [values]
+                arrays = [self._value_ids(field, _normalize(value)) for value in values]
+                if not arrays:
+                    ids = np.empty(0, dtype=np.int64)
+                else:
+                    ids = np.unique(np.concatenate(arrays)) if len(arrays) > 1 else arrays[0]
+                selected = ids if selected is None else np.intersect1d(selected, ids, assume_unique=True)
+                if not len(selected):
+                    break
+        return selected
+
+    def matches(self, index_id: int, filter: Dict[str, FilterValue]) -> bool:
+        """
+        :param index_id: A vector id.
+        :param filter: A dict of field -> value or list of values.
+        :return: True if the document matches the filter.
+        """
+        values = self._values.get(int(index_id))
+        if values is None:
+            return False
+        for field, expected in filter.items():
+            expected = expected if isinstance(expected, (list, tuple, set)) else [expected]
+            if values.get(field) not in {_normalize(value) for value in expected}:
+                return False
+        return True
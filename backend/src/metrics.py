@@ -0,0 +1,220 @@
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds of the context token histogram buckets
+TOKEN_BUCKETS = (100, 250, 500, 1000, 1500, 2000, 4000, 8000)
+# Adds a Server-Timing header with the duration of each stage to the responses
+SERVER_TIMING = True
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# stage durations (ms) of the request being handled, None outside of a request
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_timings",
+                                                                                             default=None)
+# metrics in the order they are rendered
+_registry: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """
+    A metric family with a fixed set of label names, rendered in the Prometheus text format.
+    """
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+        _registry.append(self)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                    for labels, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, *labels) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, value: float, *labels) -> None:
+        # for the counters kept by another object (e.g. the cache hits), copied when scraped
+        with self._lock:
+            self._values[labels] = value
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, *labels) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """
+    Histogram with cumulative buckets; each label set keeps its bucket counts, sum and count.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels) -> None:
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for labels, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    bucket_labels = _format_labels(self.labelnames + ("le",), labels + (_format_value(bound),))
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                label_text = _format_labels(self.labelnames, labels)
+                lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+                lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+REQUEST_DURATION = Histogram("rag_request_duration_seconds", "Duration of the HTTP requests, until the last byte.",
+                             ("method", "route", "status"))
+STAGE_DURATION = Histogram("rag_stage_duration_seconds", "Duration of each stage of the requests and jobs.",
+                           ("stage",))
+LLM_TOKENS = Counter("rag_llm_tokens_total", "Tokens of the llm calls, as reported by the API.",
+                     ("model", "kind"))
+CONTEXT_TOKENS = Histogram("rag_context_tokens", "Tokens of the context packed for each question.",
+                           ("model",), buckets=TOKEN_BUCKETS)
+# set from the state of the app when /metrics is scraped
+CACHE_HITS = Counter("rag_cache_hits_total", "Hits of the answer and query embedding caches.", ("cache",))
+CACHE_MISSES = Counter("rag_cache_misses_total", "Misses of the answer and query embedding caches.", ("cache",))
+CACHE_HIT_RATIO = Gauge("rag_cache_hit_ratio", "Fraction of the cache lookups that were hits.", ("cache",))
+CACHE_ENTRIES = Gauge("rag_cache_entries", "Entries in the in-memory caches.", ("cache",))
+RETRIEVALS_COALESCED = Counter("rag_retrievals_coalesced_total",
+                               "Retrievals that waited for an identical one in flight.")
+INDEX_VECTORS = Gauge("rag_index_vectors", "Vectors in the FAISS index (index.ntotal).")
+INDEX_SHARDS = Gauge("rag_index_shards", "Shards of the FAISS index.")
+INGESTION_JOBS = Gauge("rag_ingestion_jobs", "Ingestion jobs by status (finished jobs are kept for a while).",
+                       ("status",))
+
+
+def record(stage: str, seconds: float) -> None:
+    """
+    Records the duration of a stage in the stage histogram and in the timings of the current request.
+    :param stage: The name of the stage.
+    :param seconds: Its duration.
+    :return: None
+    """
+    STAGE_DURATION.observe(seconds, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        # a stage run several times in a request (e.g. the searches of a hybrid retrieval) adds up
+        timings[stage] = timings.get(stage, 0.0) + seconds * 1000
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Times the block it wraps as a stage, see record. Works in threads and coroutines alike.
+    :param stage: The name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """
+    :param timings: Stage durations in milliseconds.
+    :return: The value of a Server-Timing header listing them.
+    """
+    return ", ".join(f"{stage};dur={duration:.1f}" for stage, duration in timings.items())
+
+
+def render() -> str:
+    """
+    :return: Every metric in the Prometheus text exposition format.
+    """
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every HTTP request until its last byte, labelled by route template,
+    and collects the stage timings recorded while handling it. With SERVER_TIMING, the stages
+    finished when the response starts are sent in a Server-Timing header (for a streamed response,
+    the stages before the first byte).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING and timings:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", server_timing(timings).encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            # the route template, so that /jobs/{job_id} is one series
+            route = scope.get("route")
+            REQUEST_DURATION.observe(time.perf_counter() - start, scope["method"],
+                                     getattr(route, "path", "unmatched"), status)
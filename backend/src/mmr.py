@@ -0,0 +1,55 @@
+from typing import List
+
+import numpy as np
+
+
+def _row_norms(vectors: np.ndarray) -> np.ndarray:
+    # one pass over the rows, without the temporary squares of np.linalg.norm
+    norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    # zero vectors get a similarity of 0 to everything, like in cosine_similarity
+    norms[norms == 0] = 1.0
+    return norms
+
+
+def mmr_select(query_vector, candidate_vectors, k: int = 4, lambda_mult: float = 0.5) -> List[int]:
+    """
+    Maximal marginal relevance selection with NumPy, selecting the same candidates as
+    langchain's maximal_marginal_relevance.
+
+    The candidate norms are computed once per query, so every similarity is a scaled dot product:
+    one matrix-vector product for the relevance to the query, then one per selected candidate to
+    update the highest similarity of every candidate to the selection. There is no Python work
+    per candidate, so the cost grows with fetch_k at BLAS speed. The norms are not stored with the
+    vectors: computing them takes one pass over the candidates, less than one of those products.
+
+    :param query_vector: The query embedding.
+    :param candidate_vectors: The candidate embeddings, one per row.
+    :param k: Number of candidates to select.
+    :param lambda_mult: Between 0 (maximum diversity) and 1 (maximum relevance).
+    :return: The positions of the selected candidates, in selection order.
+    """
+    candidates = np.asarray(candidate_vectors, dtype=np.float32)
+    k = min(k, len(candidates))
+    if k <= 0:
+        return []
+
+    candidates = candidates.reshape(len(candidates), -1)
+    norms = _row_norms(candidates)
+    query = np.asarray(query_vector, dtype=np.float32).reshape(1, -1)
+    relevance = candidates @ query[0] / (norms * _row_norms(query)[0])
+
+    best = int(np.argmax(relevance))
+    selected = [best]
+    # highest similarity of each candidate to the selected ones
+    redundancy = candidates @ candidates[best] / (norms * norms[best])
+    available = np.ones(len(candidates), dtype=bool)
+    available[best] = False
+
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, candidates @ candidates[best] / (norms * norms[best]), out=redundancy)
+    return selected
@@ -0,0 +1,278 @@
+import json
+import os
+import pickle
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where the store is used by a single process
+    fcntl = None
+
+# Number of delta segments after which they are compacted into a new base snapshot
+COMPACTION_THRESHOLD = 50
+
+MANIFEST_NAME = 'MANIFEST.json'
+DELTAS_DIR = 'deltas'
+SEGMENT_SUFFIX = '.delta'
+LOCK_NAME = 'LOCK'
+
+
+def _atomic_write(path, data: bytes):
+    # write to a temporary file and rename it, so readers never see a partial file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class DeltaLog:
+    """
+    Append-only log of the changes made to the vector store since its last base snapshot.
+
+    The store directory holds a manifest, numbered snapshot directories and a deltas directory:
+
+        <store_dir>/MANIFEST.json                {"base": "snapshot_000000000012", "base_seq": 12}
+        <store_dir>/snapshot_000000000012/       full index and id map
+        <store_dir>/deltas/000000000013.delta    new vectors, or tombstones
+
+    Documents are not part of the log, the docstore persists them itself.
+
+    Each change is written as one small segment, so the write cost is proportional to the change.
+    Compaction writes a new snapshot and only then switches the manifest to it, which makes the
+    manifest the commit point of a compaction.
+
+    Several processes can share the store directory: writers serialize with process_lock, and
+    readers call refresh to notice, with a single stat, that another process published a snapshot,
+    and with a directory listing, the segments it appended since.
+    A snapshot is only committed under process_lock and when it is newer than the current base, so
+    the base never moves back; readers hold the lock while they read the base and the segments, so
+    a commit does not remove files they are reading (the pages of a memory-mapped base that is
+    removed afterwards stay readable until it is unmapped).
+    """
+
+    def __init__(self, store_dir, compaction_threshold=COMPACTION_THRESHOLD):
+        self.store_dir = store_dir
+        self.deltas_dir = os.path.join(store_dir, DELTAS_DIR)
+        self.manifest_path = os.path.join(store_dir, MANIFEST_NAME)
+        self.compaction_threshold = compaction_threshold
+        self.lock_path = os.path.join(store_dir, LOCK_NAME)
+        os.makedirs(self.deltas_dir, exist_ok=True)
+        # process_lock is reentrant, the file is locked by the outermost holder only
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+
+        self._manifest_stat = self._stat_manifest()
+        self.manifest = self._read_manifest()
+        self.last_seq = max([self.manifest["base_seq"], *self._segment_seqs()])
+
+    def _stat_manifest(self):
+        # the manifest is replaced by a rename, so a new inode or mtime means a new version
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _read_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {"base": None, "base_seq": 0}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _segment_seqs(self) -> List[int]:
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.deltas_dir)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.deltas_dir, f"{seq:012d}{SEGMENT_SUFFIX}")
+
+    def refresh(self) -> bool:
+        """
+        Picks up the changes made by other processes: the manifest is read again only when it
+        changed on disk, and the last sequence number is recomputed from the segments.
+        :return: True if the manifest changed.
+        """
+        stat = self._stat_manifest()
+        changed = stat != self._manifest_stat
+        if changed:
+            self._manifest_stat = stat
+            self.manifest = self._read_manifest()
+        self.last_seq = max([self.manifest["base_seq"], *self._segment_seqs()])
+        return changed
+
+    @contextmanager
+    def process_lock(self):
+        """
+        Exclusive lock on the store directory, held by a process while it changes the store
+        so that workers sharing the directory do not write the same sequence numbers, and while it
+        reads the base snapshot and the segments. Also excludes the other threads of the process,
+        and can be taken again by the thread holding it.
+        """
+        with self._thread_lock:
+            if fcntl is None or self._lock_depth:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def pending_segments(self, after_seq: int = 0) -> List[int]:
+        """
+        :param after_seq: Only the segments after this sequence number, e.g. the last one applied.
+        :return: The sequence numbers of the segments that are not in the base snapshot yet.
+        """
+        after_seq = max(after_seq, self.manifest["base_seq"])
+        return [seq for seq in self._segment_seqs() if seq > after_seq]
+
+    def base_snapshot(self) -> Optional[str]:
+        """
+        :return: The directory of the current base snapshot, or None if there is none yet.
+        """
+        if self.manifest["base"] is None:
+            return None
+        return os.path.join(self.store_dir, self.manifest["base"])
+
+    def snapshot_path(self, seq: int) -> str:
+        """
+        :param seq: The last sequence number included in the snapshot.
+        :return: The directory where that snapshot is written.
+        """
+        return os.path.join(self.store_dir, f"snapshot_{seq:012d}")
+
+    def staging_path(self, seq: int) -> str:
+        """
+        :param seq: The last sequence number included in the snapshot.
+        :return: The directory where this process writes that snapshot before committing it, so that
+            workers compacting at the same sequence number do not write to the same files.
+        """
+        return f"{self.snapshot_path(seq)}.{os.getpid()}.tmp"
+
+    def _append(self, record: dict) -> int:
+        seq = self.last_seq + 1
+        _atomic_write(self._segment_path(seq), pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+        self.last_seq = seq
+        return seq
+
+    def append_add(self, ids: List[str], vectors, index_ids: List[int], shards: Optional[List[int]] = None) -> int:
+        """
+        Records vectors added to the store.
+        :param ids: The docstore ids of the added documents.
+        :param vectors: The embedding vectors, in the order of the ids.
+        :param index_ids: The vector ids in the faiss index, in the order of the ids.
+        :param shards: The keys of the shards of a sharded index the vectors were added to.
+        :return: The sequence number of the segment.
+        """
+        record = {"op": "add", "ids": list(ids),
+                  "vectors": np.asarray(vectors, dtype=np.float32),
+                  "index_ids": np.asarray(index_ids, dtype=np.int64)}
+        if shards:
+            record["shards"] = list(shards)
+        return self._append(record)
+
+    def append_delete(self, ids: List[str]) -> int:
+        """
+        Records a tombstone for documents removed from the store.
+        :param ids: The docstore ids of the removed documents.
+        :return: The sequence number of the segment.
+        """
+        return self._append({"op": "delete", "ids": list(ids)})
+
+    def read_pending(self, after_seq: int = 0) -> Iterator[dict]:
+        """
+        :param after_seq: Only the records after this sequence number.
+        :return: An iterator over the records not in the base snapshot, in order.
+        """
+        for seq in self.pending_segments(after_seq):
+            with open(self._segment_path(seq), "rb") as f:
+                yield pickle.load(f)
+
+    def replay(self, vector_store, after_seq: int = 0) -> int:
+        """
+        Applies the pending records to a vector store loaded from the base snapshot, or only the
+        records after after_seq to a store that already contains the previous ones (e.g. the segments
+        written by another worker since the last replay).
+        Only the index and the id map are touched, the documents are already in the docstore.
+        Replay is idempotent: ids already present are not added twice and missing ids are not deleted.
+
+        :param vector_store: The FAISS vector store.
+        :param after_seq: The last sequence number already applied to the store.
+        :return: The number of records applied.
+        """
+        present = set(vector_store.index_to_docstore_id.values())
+        applied = 0
+        for record in self.read_pending(after_seq):
+            if record["op"] == "add":
+                keep = [i for i, id_ in enumerate(record["ids"]) if id_ not in present]
+                if keep:
+                    ids = [record["ids"][i] for i in keep]
+                    if "documents" in record:
+                        # segments written before the docstore moved to SQLite carry the documents
+                        vector_store.docstore.add({ids[j]: record["documents"][i] for j, i in enumerate(keep)})
+                    # segments written before the index was id-mapped get new vector ids
+                    index_ids = record["index_ids"][keep] if "index_ids" in record else None
+                    vector_store.restore_vectors(ids, record["vectors"][keep], index_ids,
+                                                 shards=record.get("shards"))
+                    present.update(ids)
+            else:
+                ids = [id_ for id_ in record["ids"] if id_ in present]
+                if ids:
+                    vector_store.delete(ids)
+                    present.difference_update(ids)
+            applied += 1
+        return applied
+
+    def needs_compaction(self) -> bool:
+        return len(self.pending_segments()) >= self.compaction_threshold
+
+    def commit_snapshot(self, seq: int, snapshot_dir: Optional[str] = None) -> bool:
+        """
+        Makes a snapshot the new base, then removes the previous snapshot and the segments it contains.
+        Runs under process_lock, and refuses a snapshot that is not newer than the current base,
+        e.g. when another worker committed a later one since this one was started.
+
+        :param seq: The last sequence number included in the snapshot.
+        :param snapshot_dir: The directory the snapshot was written to (see staging_path), moved to
+            snapshot_path(seq). Defaults to snapshot_path(seq) itself.
+        :return: True if the snapshot is the new base, False if it was refused and removed.
+        """
+        final_dir = self.snapshot_path(seq)
+        snapshot_dir = snapshot_dir or final_dir
+        with self.process_lock():
+            self.refresh()
+            if seq <= self.manifest["base_seq"]:
+                if snapshot_dir != self.base_snapshot():
+                    shutil.rmtree(snapshot_dir, ignore_errors=True)
+                return False
+
+            if snapshot_dir != final_dir:
+                # left by a compaction that stopped before its commit
+                shutil.rmtree(final_dir, ignore_errors=True)
+                os.replace(snapshot_dir, final_dir)
+            previous_base = self.base_snapshot()
+            manifest = {"base": os.path.basename(final_dir), "base_seq": seq}
+            _atomic_write(self.manifest_path, json.dumps(manifest).encode("utf-8"))
+            self.manifest = manifest
+            self._manifest_stat = self._stat_manifest()
+
+            if previous_base is not None and previous_base != final_dir:
+                shutil.rmtree(previous_base, ignore_errors=True)
+            for old_seq in self._segment_seqs():
+                if old_seq <= seq:
+                    os.remove(self._segment_path(old_seq))
+        return True
@@ -0,0 +1,220 @@
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+# Fraction of the profiled routes' requests that are profiled, 0 disables the sampling
+PROFILE_SAMPLE_RATE = 0.0
+# Requests sent with this value in the PROFILE_HEADER header are profiled; None disables the header
+PROFILE_ADMIN_TOKEN = None
+PROFILE_HEADER = "x-profile-token"
+# Directory of the profiles, the oldest are removed beyond PROFILE_MAX_FILES
+PROFILE_DIR = "profiles"
+PROFILE_MAX_FILES = 200
+# "speedscope" (JSON for https://www.speedscope.app) or "collapsed" (folded stacks for flamegraph.pl)
+PROFILE_FORMAT = "speedscope"
+# Seconds between two stack samples
+PROFILE_INTERVAL = 0.005
+PROFILE_ROUTES = ("/chat", "/chat/stream", "/upload-doc")
+# Leaf functions of the threads that are waiting for work, their samples are dropped
+_IDLE_FRAMES = {("threading.py", "wait"), ("queue.py", "get"), ("thread.py", "_worker"),
+                ("selectors.py", "select")}
+
+# one profile at a time, the samples of concurrent ones would overlap
+_profile_lock = threading.Lock()
+
+
+def configure_profiling(environ=os.environ) -> None:
+    """
+    Reads the settings from the environment, so that profiling is switched on without a code change.
+    Called by the app before it installs the middleware; the unset variables keep the defaults above.
+    :param environ: The environment variables.
+    """
+    global PROFILE_SAMPLE_RATE, PROFILE_ADMIN_TOKEN, PROFILE_DIR, PROFILE_MAX_FILES, PROFILE_FORMAT, PROFILE_INTERVAL
+    PROFILE_SAMPLE_RATE = float(environ.get("PROFILE_SAMPLE_RATE", PROFILE_SAMPLE_RATE))
+    PROFILE_ADMIN_TOKEN = environ.get("PROFILE_ADMIN_TOKEN", PROFILE_ADMIN_TOKEN) or None
+    PROFILE_DIR = environ.get("PROFILE_DIR", PROFILE_DIR)
+    PROFILE_MAX_FILES = int(environ.get("PROFILE_MAX_FILES", PROFILE_MAX_FILES))
+    PROFILE_FORMAT = environ.get("PROFILE_FORMAT", PROFILE_FORMAT)
+    PROFILE_INTERVAL = float(environ.get("PROFILE_INTERVAL", PROFILE_INTERVAL))
+
+
+def profiling_enabled() -> bool:
+    """
+    :return: Whether requests can be profiled. When not, the middleware is not installed at all.
+    """
+    return PROFILE_SAMPLE_RATE > 0 or bool(PROFILE_ADMIN_TOKEN)
+
+
+def _frame_name(code) -> str:
+    # the first line of the function, so that the samples of a function share one frame
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Statistical profiler: a thread samples the Python stacks of the other threads every interval
+    seconds and counts the identical stacks. The thread handling the request is always sampled; the
+    other threads (e.g. the threadpool running the blocking calls of the request) only when they are
+    busy. Concurrent requests running in those threads show up in the profile too.
+    """
+
+    def __init__(self, request_thread: int, interval: float = None):
+        self.request_thread = request_thread
+        self.interval = PROFILE_INTERVAL if interval is None else interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._start = time.perf_counter()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._start
+
+    def _run(self):
+        own_thread = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                code = frame.f_code
+                if thread_id != self.request_thread and (os.path.basename(code.co_filename),
+                                                         code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                thread_name = "request" if thread_id == self.request_thread else names.get(thread_id, thread_id)
+                stack.append(f"thread {thread_name}")
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+def to_collapsed(stacks: Dict[Tuple[str, ...], int]) -> str:
+    """
+    :param stacks: Sample counts by stack, root first.
+    :return: The stacks in the folded format of flamegraph.pl ("root;...;leaf count" lines).
+    """
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.items())
+
+
+def to_speedscope(stacks: Dict[Tuple[str, ...], int], interval: float, name: str) -> dict:
+    """
+    :param stacks: Sample counts by stack, root first.
+    :param interval: The sampling interval in seconds, the weight of a sample.
+    :param name: The name of the profile.
+    :return: The profile in the sampled speedscope file format.
+    """
+    frames, frame_indexes = [], {}
+    samples, weights = [], []
+    for stack, count in stacks.items():
+        sample = []
+        for frame in stack:
+            if frame not in frame_indexes:
+                frame_indexes[frame] = len(frames)
+                frames.append({"name": frame})
+            sample.append(frame_indexes[frame])
+        samples.append(sample)
+        weights.append(count * interval)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "rag_project_ds",
+        "shared": {"frames": frames},
+        "profiles": [{"type": "sampled", "name": name, "unit": "seconds", "startValue": 0,
+                      "endValue": sum(weights), "samples": samples, "weights": weights}],
+    }
+
+
+def _rotate(directory: str, max_files: int) -> None:
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:max(0, len(paths) - max_files)]:
+        os.remove(path)
+
+
+def write_profile(sampler: StackSampler, filename: str, name: str) -> str:
+    """
+    Writes a profile in PROFILE_FORMAT to PROFILE_DIR and removes the oldest ones beyond PROFILE_MAX_FILES.
+    :param sampler: The stopped sampler.
+    :param filename: The name of the file, without extension.
+    :param name: The name of the profile, shown by the viewers.
+    :return: The path of the file.
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if PROFILE_FORMAT == "collapsed":
+        path = os.path.join(PROFILE_DIR, f"{filename}.collapsed")
+        content = to_collapsed(sampler.stacks)
+    else:
+        path = os.path.join(PROFILE_DIR, f"{filename}.speedscope.json")
+        content = json.dumps(to_speedscope(sampler.stacks, sampler.interval, name))
+    with open(path, "w") as f:
+        f.write(content)
+    _rotate(PROFILE_DIR, PROFILE_MAX_FILES)
+    return path
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles the requests to PROFILE_ROUTES sent with the admin token in
+    PROFILE_HEADER, and a PROFILE_SAMPLE_RATE fraction of the others. A profile covers the request
+    until the last byte of its response, and its file name is sent in the X-Profile header.
+    Only installed when profiling_enabled(), so that it costs nothing otherwise.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def _wants_profile(self, scope) -> bool:
+        if scope["type"] != "http" or scope["path"] not in PROFILE_ROUTES:
+            return False
+        if PROFILE_ADMIN_TOKEN:
+            token = dict(scope["headers"]).get(PROFILE_HEADER.encode("latin-1"))
+            if token is not None and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN.encode("latin-1")):
+                return True
+        return random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if not self._wants_profile(scope) or not _profile_lock.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        path_name = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_")
+        filename = f"{time.strftime('%Y%m%dT%H%M%S')}_{path_name}_{uuid.uuid4().hex[:8]}"
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile", filename.encode("latin-1"))]
+            await send(message)
+
+        sampler = StackSampler(threading.get_ident())
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            sampler.stop()
+            try:
+                name = f"{scope['method']} {scope['path']} ({sampler.duration * 1000:.0f} ms)"
+                path = await run_in_threadpool(write_profile, sampler, filename, name)
+                print(f"Profile of {name} written to {path}")
+            finally:
+                _profile_lock.release()
@@ -1,6 +1,6 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -8,10 +8,25 @@ class ModelName(str, Enum):
     GPT4_O_MINI = "gpt-4o-mini"
 
 
+class SearchFilters(BaseModel):
+    # restricts the retrieval to chunks matching every given field (any of the values of a field)
+    file_ids: Optional[List[int]] = None
+    customers: Optional[List[str]] = None
+    nps_types: Optional[List[str]] = None
+
+    def to_filter(self) -> Optional[dict]:
+        """
+        :return: The metadata filter used by the retriever, or None if no field is set.
+        """
+        fields = {"file_id": self.file_ids, "customer": self.customers, "nps_type": self.nps_types}
+        return {field: values for field, values in fields.items() if values is not None} or None
+
+
 class QueryInput(BaseModel):
     question: str
     session_id: str = Field(default=None)
     model: ModelName = Field(default=ModelName.GPT4_O_MINI)
+    filters: Optional[SearchFilters] = Field(default=None)
 
 
 
@@ -26,4 +41,18 @@ class DocumentInfo(BaseModel):
     upload_timestamp: datetime
 
 class DeleteFileRequest(BaseModel):
-    file_id:int
\ No newline at end of file
+    file_id:int
+
+class JobInfo(BaseModel):
+    job_id: str
+    filename: str
+    file_id: int
+    # queued, running, succeeded, failed or cancelled
+    status: str
+    rows_done: int
+    chunks_done: int
+    vectors_done: int
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
@@ -1,76 +1,129 @@
 import os
-import faiss
+import shutil
+import threading
+import time
+
 import pickle
 from dotenv import load_dotenv
 
-from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 from langchain_openai import OpenAIEmbeddings
 
+from backend.src.bm25 import BM25Index
+from backend.src.docstore import DOCSTORE_DB_PATH, SQLiteDocstore, migrate_pickled_docstore
+from backend.src.embedding_cache import CachedEmbeddings, SQLiteEmbeddingCache
+from backend.src.hybrid_retriever import HybridRetriever
+from backend.src.index_factory import ShardedIndex, build_migrated_index, clone_index, extract_vectors, \
+    get_index_type, migration_candidates, read_index, sync_index, to_id_mapped_index, to_sharded_index, write_index
+from backend.src.ingestion import embed_documents
+from backend.src.metrics import span
+from backend.src.persistence import DeltaLog
+from backend.src.vector_store import IdMappedFAISS
+
 # start vector store as none
 _vector_store = None
 # Define faiss index path
 FAISS_INDEX_PATH = 'faiss_index'
+# pickled docstore of previous versions, migrated to DOCSTORE_DB_PATH on startup
 DOCSTORE_PATH ='docstore'
 INDEX_TO_DOCSTORE_ID = 'index_to_docstore_id'
-
-
-def save_vector_store(vector_store, index_path=FAISS_INDEX_PATH, id_map_path=INDEX_TO_DOCSTORE_ID, docstore_path=DOCSTORE_PATH) :
+# Directory with the base snapshots and the append-only delta log
+VECTOR_STORE_DIR = 'faiss_store'
+# Memory-map the base snapshot read-only, so that several uvicorn workers share one copy of it through
+# the page cache. faiss only maps the inverted lists of IVF indexes: flat and HNSW shards (the open
+# shard, and the shards below ANN_MIGRATION_THRESHOLD) are read into the memory of every worker, and a
+# mapped shard is copied into it once vectors are added to it or removed from it, until the next
+# compaction. None maps it when uvicorn runs several workers (WEB_CONCURRENCY > 1), True or False forces it.
+MMAP_INDEX = None
+# Seconds between two checks for the delta segments and base snapshots published by other workers
+INDEX_POLL_INTERVAL = 1.0
+
+_delta_log = None
+# serializes the changes to the vector store and their delta log records
+_store_lock = threading.RLock()
+_compaction_thread = None
+_migration_thread = None
+# one compaction at a time, two would both remove the segments of their snapshots
+_compaction_lock = threading.Lock()
+# base snapshot the in-memory vector store is built on, and last delta segment applied to it
+_loaded_snapshot = None
+_applied_seq = 0
+_watcher_thread = None
+# Incremented whenever the documents of the store change, cached answers are only valid for one version
+_corpus_version = 0
+# lexical index of the chunks for hybrid search, built on first use
+_bm25_index = None
+
+
+def save_vector_store(vector_store, index_path=FAISS_INDEX_PATH, id_map_path=INDEX_TO_DOCSTORE_ID) :
     """
-    Saves the FAISS index, document store, and index-to-docstore ID mapping to disk.
+    Saves the FAISS index and index-to-docstore ID mapping to disk.
+    The documents are not saved here, the SQLite docstore persists them as they are added.
 
     :param vector_store: The FAISS vector store object to save.
     :param index_path: The file path to save the FAISS index.
     :param id_map_path: The file path to save the index-to-docstore ID mapping.
-    :param docstore_path: The file path to save the document store.
 
     :return: None
     """
-    # save index to the current dir
-    faiss.write_index(vector_store.index, index_path)
-
-    with open(docstore_path, "wb") as f:
-        pickle.dump(vector_store.docstore, f)
+    # save index to the current dir (a directory with one file per shard for a sharded index)
+    write_index(vector_store.index, index_path)
 
     with open(id_map_path, "wb") as f:
         pickle.dump(vector_store.index_to_docstore_id, f)
 
 
-def load_vector_store (index_path, docstore_path, id_map_path):
+def load_vector_store (index_path, id_map_path, mmap=False):
     """
-   Loads an existing FAISS vector store, including the index, document store,
-    and index-to-docstore ID mapping.
+   Loads an existing FAISS index and index-to-docstore ID mapping.
     :param index_path: The file path to the FAISS index.
-    :param docstore_path: The file path to the document store.
     :param id_map_path: The file path to the index-to-docstore ID mapping.
-    :return: A tuple containing the FAISS index, document store, and index-to-docstore ID mapping.
+    :param mmap: Memory-map the index read-only instead of reading it into memory.
+    :return: A tuple containing the FAISS index and index-to-docstore ID mapping.
     """
     # reading index path
-    index = faiss.read_index(index_path)
-    with open(docstore_path, "rb") as f:
-        docstore = pickle.load(f)
+    index = read_index(index_path, mmap=mmap)
     with open(id_map_path, "rb") as f:
         index_to_docstore_id = pickle.load(f)
 
-    return index, docstore, index_to_docstore_id
+    return index, index_to_docstore_id
 
 
 
 # Function to initialize vector store indexed
 def initialize_vector_store_indexed(embeddings, index_path = FAISS_INDEX_PATH, id_map_path=INDEX_TO_DOCSTORE_ID,
-                                    docstore_path=DOCSTORE_PATH):
+                                    docstore_path=DOCSTORE_PATH, delta_log=None, docstore_db_path=DOCSTORE_DB_PATH,
+                                    mmap=False):
     """
     Initializes a FAISS vector store, either by loading an existing index or creating a new one.
+    When a delta log is given, its base snapshot (if any) replaces the paths below and the
+    pending deltas are replayed on top of it.
     :param embeddings: The embedding function to use for generating embeddings.
     :param index_path: The file path to the FAISS index. Defaults to FAISS_INDEX_PATH.
     :param id_map_path: The file path to the index-to-docstore ID mapping. Defaults to INDEX_TO_DOCSTORE_ID.
-    :param docstore_path: The file path to the document store. Defaults to DOCSTORE_PATH.
+    :param docstore_path: The file path to a pickled document store to migrate. Defaults to DOCSTORE_PATH.
+    :param delta_log: Optional DeltaLog of the store.
+    :param docstore_db_path: The file path to the SQLite document store. Defaults to DOCSTORE_DB_PATH.
+    :param mmap: Memory-map the index read-only instead of reading it into memory.
     :return: vector_store: An initialized FAISS vector store object
     """
+    if delta_log is not None and delta_log.base_snapshot() is not None:
+        index_path, id_map_path, docstore_path = snapshot_paths(delta_log.base_snapshot())
+
+    # documents are read from disk only for the search hits
+    docstore = SQLiteDocstore(docstore_db_path)
+    if os.path.exists(docstore_path):
+        # one-off migration of the docstore pickled by previous versions
+        migrated = migrate_pickled_docstore(docstore_path, docstore)
+        print(f"Migrated {migrated} documents from {docstore_path} to {docstore_db_path}")
+
     if os.path.exists(index_path):
         print("Loading existing FAISS index...")
-        # loading faiss index, docstore and index_to_docstore_id
-        index, docstore, index_to_docstore_id = load_vector_store(index_path, docstore_path, id_map_path)
+        # loading faiss index and index_to_docstore_id
+        index, index_to_docstore_id = load_vector_store(index_path, id_map_path, mmap=mmap)
+        # indexes saved by previous versions use positions as ids; also applies the search settings.
+        # A single index saved by previous versions becomes the first shard
+        index = to_sharded_index(to_id_mapped_index(index, index_to_docstore_id))
         print("FAISS index loaded successfully")
     else:
         print("Creating a new FAISS index...")
@@ -78,25 +131,275 @@ def initialize_vector_store_indexed(embeddings, index_path = FAISS_INDEX_PATH, i
         sample_embedding = embeddings.embed_query("test")
         dimension = len(sample_embedding)
 
-        # Create a FAISS index for L2 distance
-        index = faiss.IndexFlatL2(dimension)
-        docstore = InMemoryDocstore()
+        # Start with exact L2 shards with explicit ids so deletions do not renumber them, each shard is
+        # migrated to an approximate index once it passes ANN_MIGRATION_THRESHOLD
+        index = ShardedIndex(dimension)
         index_to_docstore_id = {}
 
 
     # Initialize the FAISS vector store
-    # In the future explore other options like IVFFlat (Inverted File Index Flat)
-    # or IVFPQ (Inverted File with Product Quantization)
-    vector_store = FAISS(
+    vector_store = IdMappedFAISS(
         embedding_function=embeddings,
         index=index,
         docstore=docstore,
         index_to_docstore_id=index_to_docstore_id,
     )
 
+    if delta_log is not None:
+        applied = delta_log.replay(vector_store)
+        print(f"Replayed {applied} delta segments on top of the base snapshot")
+
+    # record the vector ids of documents migrated from previous versions in the file map
+    missing = [id_ for id_ in docstore.ids_missing_index_id() if id_ in vector_store.docstore_id_to_index]
+    if missing:
+        docstore.set_index_ids(missing, vector_store.get_index_ids(missing))
+
     return vector_store
 
 
+def snapshot_paths(snapshot_dir):
+    """
+    :param snapshot_dir: The directory of a base snapshot.
+    :return: A tuple with the index, index-to-docstore ID mapping and (pickled, older snapshots only)
+        docstore paths inside it.
+    """
+    return (os.path.join(snapshot_dir, FAISS_INDEX_PATH),
+            os.path.join(snapshot_dir, INDEX_TO_DOCSTORE_ID),
+            os.path.join(snapshot_dir, DOCSTORE_PATH))
+
+
+def mmap_index_enabled() -> bool:
+    """
+    :return: Whether the base snapshot is memory-mapped, see MMAP_INDEX.
+    """
+    if MMAP_INDEX is not None:
+        return MMAP_INDEX
+    # the number of workers uvicorn (and gunicorn) start when --workers is not given
+    return int(os.getenv("WEB_CONCURRENCY", "1")) > 1
+
+
+def get_delta_log():
+    """
+    Retrieves the global delta log of the vector store. Initializes it if it does not already exist.
+
+    :return: _delta_log: The global DeltaLog object
+    """
+    global _delta_log
+    if _delta_log is None:
+        _delta_log = DeltaLog(VECTOR_STORE_DIR)
+    return _delta_log
+
+
+def compact_vector_store():
+    """
+    Writes the current vector store as a new base snapshot and drops the delta segments it contains.
+    Only the copy of the store is done under the store lock; the writing happens outside it, and the
+    snapshot is committed under the process lock unless another worker committed a newer one meanwhile.
+
+    :return: None
+    """
+    global _loaded_snapshot
+    delta_log = get_delta_log()
+    with span("compaction"), _compaction_lock:
+        with _store_lock:
+            # the segments of other workers not replayed yet are not in the snapshot, and are kept
+            seq = _applied_seq
+            snapshot = FAISS(
+                embedding_function=_vector_store.embedding_function,
+                index=clone_index(_vector_store.index),
+                docstore=_vector_store.docstore,
+                index_to_docstore_id=dict(_vector_store.index_to_docstore_id),
+            )
+
+        staging_dir = delta_log.staging_path(seq)
+        # files of a compaction of a process that crashed with the same pid would end up in the snapshot
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        index_path, id_map_path, _ = snapshot_paths(staging_dir)
+        save_vector_store(snapshot, index_path=index_path, id_map_path=id_map_path)
+        if not delta_log.commit_snapshot(seq, staging_dir):
+            print(f"Base snapshot {seq} discarded, a newer one was published")
+            return
+        # the in-memory store already contains this snapshot, there is nothing to reload
+        _loaded_snapshot = delta_log.snapshot_path(seq)
+    print(f"Vector store compacted into base snapshot {seq}")
+
+
+def _compact_and_remap():
+    compact_vector_store()
+    if mmap_index_enabled():
+        # map the new snapshot here too, instead of keeping a private copy of the index
+        reload_vector_store()
+
+
+def _compact_in_background():
+    # at most one compaction runs at a time
+    global _compaction_thread
+    if _compaction_thread is not None and _compaction_thread.is_alive():
+        return
+    _compaction_thread = threading.Thread(target=_compact_and_remap, daemon=True)
+    _compaction_thread.start()
+
+
+def migrate_index():
+    """
+    Migrates the shards that passed ANN_MIGRATION_THRESHOLD to ANN_INDEX_TYPE. The vectors of a shard
+    are copied under the store lock, and the approximate index is trained and built from the copy
+    outside it, so that searches and uploads go on during the training. The new shard is swapped in
+    under the lock, with the vectors added and removed since the copy.
+
+    :return: True if shards were migrated. They reach the disk with the next base snapshot.
+    """
+    with _store_lock:
+        # another worker may have published the migrated shards already
+        _catch_up()
+        index = _vector_store.index
+        copies = {key: extract_vectors(index.shards[key]) for key in migration_candidates(index)}
+    migrated = {key: build_migrated_index(ids, vectors) for key, (ids, vectors) in copies.items()}
+    if not migrated:
+        return False
+
+    with _store_lock:
+        _catch_up()
+        shards = _vector_store.index.shards
+        replaced = {}
+        for key, migrated_shard in migrated.items():
+            shard = shards.get(key)
+            # dropped with its file, or replaced by a snapshot migrated by another worker meanwhile
+            if shard is None or get_index_type(shard) != "flat":
+                continue
+            replaced[key] = sync_index(migrated_shard, copies[key][0], shard)
+        _vector_store.index.replace_shards(replaced)
+    return bool(replaced)
+
+
+def _migrate_and_publish():
+    if migrate_index():
+        # the migrated shards only reach the disk with a new base snapshot
+        _compact_and_remap()
+
+
+def _migrate_in_background():
+    # at most one migration runs at a time
+    global _migration_thread
+    if _migration_thread is not None and _migration_thread.is_alive():
+        return
+    _migration_thread = threading.Thread(target=_migrate_and_publish, daemon=True)
+    _migration_thread.start()
+
+
+def reload_vector_store():
+    """
+    Reloads (or remaps, see MMAP_INDEX) the global vector store on the base snapshot of the manifest,
+    written by this or by another worker, and replays the pending delta segments on top of it. The store object is
+    updated in place, so the chains that hold it see the new index.
+
+    :return: None
+    """
+    global _loaded_snapshot, _applied_seq
+    delta_log = get_delta_log()
+    # the process lock keeps a compaction from removing the snapshot or the segments while they are read
+    with span("reload"), _store_lock, delta_log.process_lock():
+        delta_log.refresh()
+        snapshot_dir = delta_log.base_snapshot()
+        if snapshot_dir is None:
+            return
+        index_path, id_map_path, _ = snapshot_paths(snapshot_dir)
+        index, index_to_docstore_id = load_vector_store(index_path, id_map_path, mmap=mmap_index_enabled())
+        _vector_store.swap_index(to_sharded_index(to_id_mapped_index(index, index_to_docstore_id)),
+                                 index_to_docstore_id)
+        delta_log.replay(_vector_store)
+        _loaded_snapshot = snapshot_dir
+        _applied_seq = delta_log.last_seq
+        _sync_bm25_index()
+        _bump_corpus_version()
+    print(f"Vector store reloaded from {snapshot_dir}")
+
+
+def _catch_up():
+    # apply the changes other workers published since the last call: a new base snapshot is reloaded,
+    # new delta segments are replayed (a stat and a directory listing when there are none)
+    global _applied_seq
+    delta_log = get_delta_log()
+    with _store_lock:
+        delta_log.refresh()
+        if delta_log.base_snapshot() == _loaded_snapshot and delta_log.last_seq <= _applied_seq:
+            return
+        with delta_log.process_lock():
+            delta_log.refresh()
+            if delta_log.base_snapshot() != _loaded_snapshot:
+                reload_vector_store()
+                return
+            applied = delta_log.replay(_vector_store, after_seq=_applied_seq)
+            _applied_seq = delta_log.last_seq
+            _sync_bm25_index()
+            _bump_corpus_version()
+    print(f"Replayed {applied} delta segments written by other workers")
+
+
+def get_corpus_version():
+    """
+    :return: The version of the indexed documents, incremented on every upload, delete and reload.
+    """
+    return _corpus_version
+
+
+def _bump_corpus_version():
+    global _corpus_version
+    with _store_lock:
+        _corpus_version += 1
+
+
+def _watch_vector_store():
+    while True:
+        time.sleep(INDEX_POLL_INTERVAL)
+        try:
+            _catch_up()
+        except Exception as e:
+            # retried on the next poll
+            print(f"Error reloading the vector store: {e}")
+
+
+def _index_chunks(chunks, file_id, delta_log):
+    # embeds one batch of chunks, then adds it to the store and appends it to the delta log under the
+    # store locks; returns the number of chunks added
+    global _applied_seq
+    if not chunks:
+        return 0
+    for chunk in chunks:
+        # assign id as a key to metadata attribute (which is a dict)
+        chunk.metadata['file_id'] = file_id
+
+    # the embedding requests, and their rate-limit backoff, run before the locks are taken, so that
+    # deletes, compactions and the other workers do not wait for the API
+    texts = [chunk.page_content for chunk in chunks]
+    with span("embed_batch"):
+        vectors = embed_documents(_vector_store.embeddings, texts)
+
+    with span("index_batch"), _store_lock, delta_log.process_lock():
+        # start from the latest version of the store, other workers may have changed it
+        _catch_up()
+        added_ids = _vector_store.add_embeddings(zip(texts, vectors), metadatas=[chunk.metadata for chunk in chunks])
+
+        # Persist only the new vectors as a delta segment, the documents are already in the docstore
+        try:
+            added_index_ids = _vector_store.get_index_ids(added_ids)
+            # file_id -> chunk map, used to delete the file without scanning the corpus
+            _vector_store.docstore.set_index_ids(added_ids, added_index_ids)
+            shards = (_vector_store.index.shard_keys(added_index_ids)
+                      if isinstance(_vector_store.index, ShardedIndex) else None)
+            _applied_seq = delta_log.append_add(added_ids, vectors, added_index_ids, shards=shards)
+        except Exception:
+            # keep the in-memory store consistent with what is on disk
+            _vector_store.delete(added_ids)
+            raise
+
+        if _bm25_index is not None:
+            _bm25_index.add(added_ids, [doc.page_content for doc in _vector_store.docstore.mget(added_ids)])
+
+        _bump_corpus_version()
+    return len(added_ids)
+
 
 # Function to index documents to faiss
 def index_document_to_faiss (chunks, file_id):
@@ -107,26 +410,56 @@ def index_document_to_faiss (chunks, file_id):
     :param file_id: A unique identifier for the file being indexed.
     :return: bool: True if indexing was successful, False otherwise.
     """
-    global _vector_store
-    print("Entering index document to faiss function")
     try:
-        for chunk in chunks:
-            # assign id as a key to metadata attribute (which is a dict)
-            chunk.metadata['file_id'] = file_id
+        return index_document_batches_to_faiss([chunks], file_id)
+    except Exception:
+        return False
 
-        # add documents (as chunks) to vectorstore
-        _vector_store.add_documents(chunks)
 
-        # Persist the FAISS index to disk
-        save_vector_store(_vector_store)
-        print("FAISS index, docstore and index_to_docstore_id saved to disk.")
+def index_document_batches_to_faiss(chunk_batches, file_id, on_batch_indexed=None):
+    """
+    Indexes the chunks of a file batch by batch, as they are produced (e.g. by iter_chunk_batches),
+    so that only one batch is in memory. Each batch is appended to the delta log once embedded, where
+    the other workers pick it up (see _catch_up). If a batch fails, the batches already
+    indexed are removed with delete_doc_from_faiss, through the file_id -> chunk map.
+
+    :param chunk_batches: An iterable of lists of document chunks. It may raise to stop the indexing,
+    which rolls the file back like a failure.
+    :param file_id: A unique identifier for the file being indexed.
+    :param on_batch_indexed: Optional callback called with the number of vectors added by each batch.
+    :return: bool: True
+    :raises Exception: The error that stopped the indexing, once the file is rolled back.
+    """
+    print("Entering index document to faiss function")
+    delta_log = get_delta_log()
+    indexed = 0
+    with _store_lock:
+        if isinstance(_vector_store.index, ShardedIndex):
+            # the file starts a shard of its own, unless the current one is still small
+            _vector_store.index.seal()
+    try:
+        for chunks in chunk_batches:
+            added = _index_chunks(chunks, file_id, delta_log)
+            indexed += added
+            if on_batch_indexed is not None:
+                on_batch_indexed(added)
+            # train an approximate index once a shard is large enough for brute force to be slow
+            if migration_candidates(_vector_store.index):
+                _migrate_in_background()
+
+        if delta_log.needs_compaction():
+            _compact_in_background()
+        print(f"{indexed} vectors appended to the delta log.")
         return True
     except Exception as e:
         print(f"Error indexing document: {e}")
-        return False
+        if indexed:
+            # roll the batches already indexed back
+            delete_doc_from_faiss(file_id)
+        raise
 
 def delete_doc_from_faiss(file_id: int):
-    global _vector_store
+    global _vector_store, _applied_seq
 
     try:
         if _vector_store is None:
@@ -134,26 +467,27 @@ def delete_doc_from_faiss(file_id: int):
 
         print("Deleting from FAIIS")
 
-        # declare documents to delete
-        doc_ids_to_delete = []
-
-        # Iterate over stored document IDs
-        for doc_id in _vector_store.docstore._dict:  # Access stored document IDs
-            doc = _vector_store.docstore.search(doc_id)  # Fetch the document
-
-            if doc and "file_id" in doc.metadata and doc.metadata["file_id"] == file_id:
-                doc_ids_to_delete.append(doc_id)
+        # look the chunks of the file up in the file_id -> chunk map
+        doc_ids_to_delete, _ = _vector_store.docstore.get_file_chunks(file_id)
 
         if not doc_ids_to_delete:
             print(f"No documents found for file_id {file_id}")
             return False
 
 
-        # delete from faiss index and docstore
-        _vector_store.delete(doc_ids_to_delete)
-        # Persist changes to disk
-        save_vector_store(_vector_store)
+        delta_log = get_delta_log()
+        with _store_lock, delta_log.process_lock():
+            _catch_up()
+            # Persist the deletion as a tombstone segment first, replaying it is harmless
+            _applied_seq = delta_log.append_delete(doc_ids_to_delete)
+            # delete from faiss index (remove_ids on the vector ids) and docstore
+            _vector_store.delete(doc_ids_to_delete)
+            if _bm25_index is not None:
+                _bm25_index.delete(doc_ids_to_delete)
+            _bump_corpus_version()
 
+            if delta_log.needs_compaction():
+                _compact_in_background()
         return True
 
     except Exception as e:
@@ -167,23 +501,80 @@ def get_vector_store():
 
     :return: _vector_store: The global FAISS vector store object
     """
-    global _vector_store
+    global _vector_store, _loaded_snapshot, _applied_seq, _watcher_thread
     if _vector_store is None:
-        embeddings =  OpenAIEmbeddings()
-        _vector_store = initialize_vector_store_indexed(embeddings=embeddings)
+        # embeddings are looked up in the persistent cache before calling the OpenAI API
+        embeddings = CachedEmbeddings(OpenAIEmbeddings(), SQLiteEmbeddingCache())
+        delta_log = get_delta_log()
+        with delta_log.process_lock():
+            _vector_store = initialize_vector_store_indexed(embeddings=embeddings, delta_log=delta_log,
+                                                            mmap=mmap_index_enabled())
+            _loaded_snapshot = delta_log.base_snapshot()
+            _applied_seq = delta_log.last_seq
+
+        # stores that passed the threshold before approximate indexes existed are migrated on startup,
+        # in the background so that the app serves the searches meanwhile
+        if migration_candidates(_vector_store.index):
+            _migrate_in_background()
+
+        # apply the changes of the other workers sharing VECTOR_STORE_DIR, whether the index is mapped or not
+        _watcher_thread = threading.Thread(target=_watch_vector_store, daemon=True)
+        _watcher_thread.start()
     return _vector_store
 
-def get_retriever(vector_store, search_type=None, k=5 , lambda_mult=0.5, fetch_k=None, score_threshold=None):
+def get_bm25_index():
+    """
+    Retrieves the global BM25 index of the chunks. Builds it from the docstore if it does not already exist;
+    index_document_to_faiss and delete_doc_from_faiss keep it up to date afterwards.
+
+    :return: _bm25_index: The global BM25Index object
+    """
+    global _bm25_index
+    if _bm25_index is None:
+        vector_store = get_vector_store()
+        with _store_lock:
+            if _bm25_index is None:
+                bm25_index = BM25Index()
+                ids, texts = [], []
+                for id_, text in vector_store.docstore.iter_texts():
+                    # documents without a vector (e.g. left by an interrupted upload) are not searchable
+                    if id_ in vector_store.docstore_id_to_index:
+                        ids.append(id_)
+                        texts.append(text)
+                bm25_index.add(ids, texts)
+                print(f"BM25 index built over {len(bm25_index)} chunks")
+                _bm25_index = bm25_index
+    return _bm25_index
+
+
+def _sync_bm25_index():
+    # apply the changes made by other workers, found by comparing the indexed ids with the vector store
+    if _bm25_index is None:
+        return
+    indexed = _bm25_index.ids()
+    present = set(_vector_store.docstore_id_to_index)
+    _bm25_index.delete(indexed - present)
+    added = list(present - indexed)
+    documents = _vector_store.docstore.mget(added)
+    _bm25_index.add([id_ for id_, doc in zip(added, documents) if doc is not None],
+                    [doc.page_content for doc in documents if doc is not None])
+
+
+def get_retriever(vector_store, search_type=None, k=5 , lambda_mult=0.5, fetch_k=None, score_threshold=None,
+                  filter=None):
     """
         Returns a retriever based on the search type.
 
         Args:
             vector_store: FAISS vector store.
-            search_type (str): The type of retrieval. Options: 'mmr', 'similarity_score_threshold', or None (default L2).
+            search_type (str): The type of retrieval. Options: 'mmr', 'similarity_score_threshold', 'hybrid'
+                (L2 and BM25 fused with reciprocal-rank fusion) or None (default L2).
             k (int): Number of results to return.
             lambda_mult (float): Balances relevance & diversity for MMR. Default 0.5.
-            fetch_k (int): Number of documents to fetch initially in MMR.
+            fetch_k (int): Number of documents to fetch initially in MMR, or from each search in hybrid.
             score_threshold (float): Minimum similarity score for similarity_score_threshold search.
+            filter (dict): Optional metadata filter, e.g. {"file_id": [3], "nps_type": "detractor"}. Filters on
+                file_id, customer and nps_type restrict the vector search itself to the matching chunks.
 
         Returns:
             retriever: Configured retriever.
@@ -191,10 +582,9 @@ def get_retriever(vector_store, search_type=None, k=5 , lambda_mult=0.5, fetch_k
 
     if search_type is None:
         # Default FAISS similarity search - L2 distance
-
-        faiss.normalize_L2(vector_store.index) # ensure cosine similarity if needed
+        # (OpenAI embeddings have unit length, so it ranks like cosine similarity)
         retriever = vector_store.as_retriever(
-            search_kwargs ={"k": k}
+            search_kwargs ={"k": k, "filter": filter}
         )
 
     # using maximum marginal relevance algorith
@@ -204,7 +594,7 @@ def get_retriever(vector_store, search_type=None, k=5 , lambda_mult=0.5, fetch_k
 
         retriever = vector_store.as_retriever(
             search_type= search_type,
-            search_kwargs={"k": k, 'lambda_mult': lambda_mult, "fetch_k": fetch_k}
+            search_kwargs={"k": k, 'lambda_mult': lambda_mult, "fetch_k": fetch_k, "filter": filter}
         )
 
     elif search_type == 'similarity_score_threshold':
@@ -212,10 +602,25 @@ def get_retriever(vector_store, search_type=None, k=5 , lambda_mult=0.5, fetch_k
             raise ValueError("score_threshold must be specified for similarity_score_threshold")
         retriever = vector_store.as_retriever(
             search_type = search_type,
-            search_kwargs={"k": k, "score_threshold": score_threshold}
+            search_kwargs={"k": k, "score_threshold": score_threshold, "filter": filter}
+        )
+    # dense and lexical (BM25) results fused by rank, finds exact terms such as customer names
+    elif search_type == 'hybrid':
+        if fetch_k is None:
+            fetch_k = k * 4
+
+        retriever = HybridRetriever(
+            vector_retriever=vector_store.as_retriever(search_kwargs={"k": fetch_k, "filter": filter}),
+            lexical_index=get_bm25_index(),
+            docstore=vector_store.docstore,
+            k=k,
+            fetch_k=fetch_k,
+            # the BM25 results are filtered with the metadata index of the vector store
+            allowed=(lambda id_: vector_store.matches_filter(id_, filter)) if filter else None,
         )
     else:
-        raise ValueError(f"Unknown search_type: {search_type}. Use 'mmr', 'similarity_score_threshold' or do not specify ")
+        raise ValueError(f"Unknown search_type: {search_type}. Use 'mmr', 'similarity_score_threshold', 'hybrid' "
+                         f"or do not specify ")
 
 
     return retriever
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+
+def normalize_query(query: str) -> str:
+    """
+    Collapses the whitespace of a query, so questions differing only by spacing share their work.
+    :param query: The query text.
+    :return: The normalized text.
+    """
+    return " ".join(query.split())
+
+
+class _LeaderInterrupted(Exception):
+    """
+    Set on the future of a call whose leader was cancelled or interrupted, so its followers retry.
+    """
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the call, the callers
+    arriving while it is in flight wait for it and get the same result (or exception).
+    If the caller running it is cancelled instead (CancelledError, KeyboardInterrupt...), the
+    waiting callers are not: they retry, and one of them runs the call.
+    Works across threads and event loops, the in-flight calls are concurrent futures.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        # number of calls that waited for an identical call instead of running
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _abandon(self, key, future):
+        # the leader was interrupted, the key is free for the caller that becomes the next leader
+        self._finish(key, future, error=_LeaderInterrupted())
+
+    def do(self, key: Hashable, function: Callable, *args) -> Any:
+        """
+        Runs function(*args), unless a call with the same key is in flight.
+        :param key: The key identifying identical calls.
+        :param function: The function to run.
+        :param args: Its arguments.
+        :return: The result of the call.
+        """
+        future, leader = self._join(key)
+        while not leader:
+            try:
+                return future.result()
+            except _LeaderInterrupted:
+                future, leader = self._join(key)
+        try:
+            result = function(*args)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._abandon(key, future)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def ado(self, key: Hashable, function: Callable, *args) -> Any:
+        """
+        Async variant of do, function is a coroutine function.
+        :param key: The key identifying identical calls.
+        :param function: The coroutine function to run.
+        :param args: Its arguments.
+        :return: The result of the call.
+        """
+        future, leader = self._join(key)
+        while not leader:
+            try:
+                # shielded: cancelling a waiting caller must not cancel the call shared with the others
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except _LeaderInterrupted:
+                future, leader = self._join(key)
+        try:
+            result = await function(*args)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._abandon(key, future)
+            raise
+        self._finish(key, future, result)
+        return result
+
+
+class CoalescingRetriever(BaseRetriever):
+    """
+    Wraps a retriever so that concurrent identical queries share one retrieval, e.g. when a
+    dashboard refresh asks the same question from many sessions at once.
+    """
+
+    retriever: BaseRetriever
+    flight: Any
+    # identifies the retriever settings in the keys, so a flight can be shared by several retrievers
+    namespace: str = ""
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.flight.do((self.namespace, normalize_query(query)), self.retriever.invoke, query,
+                                   {"callbacks": run_manager.get_child()})
+        # each caller gets its own list
+        return list(documents)
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        documents = await self.flight.ado((self.namespace, normalize_query(query)), self.retriever.ainvoke, query,
+                                          {"callbacks": run_manager.get_child()})
+        return list(documents)
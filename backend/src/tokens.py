@@ -0,0 +1,53 @@
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Encoding used for models tiktoken does not know
+DEFAULT_ENCODING = "o200k_base"
+# Characters per token of the estimate used when tiktoken or its encoding files are unavailable
+CHARS_PER_TOKEN = 4
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(model: str = "gpt-4o-mini"):
+    """
+    Returns the tiktoken encoding of a model, loaded once. The encoding files are downloaded on
+    first use, so a failure is remembered and the token counts fall back to an estimate.
+
+    :param model: The name of the OpenAI model.
+    :return: The encoding, or None if it cannot be loaded.
+    """
+    if model in _encodings:
+        return _encodings[model]
+    with _encodings_lock:
+        if model not in _encodings:
+            encoding = None
+            if tiktoken is not None:
+                try:
+                    try:
+                        encoding = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+                except Exception as e:
+                    print(f"Token counts of {model} are estimated, tiktoken encoding unavailable: {e}")
+            _encodings[model] = encoding
+    return _encodings[model]
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """
+    Counts the tokens of a text for a model.
+
+    :param text: The text.
+    :param model: The name of the OpenAI model.
+    :return: The number of tokens, estimated from the length if tiktoken is unavailable.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
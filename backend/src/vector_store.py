@@ -0,0 +1,317 @@
+import operator
+import threading
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from backend.src.index_factory import ShardedIndex, make_writable, remove_ids, search_parameters
+from backend.src.metadata_index import MetadataIndex
+from backend.src.metrics import span
+from backend.src.mmr import mmr_select
+
+# Filtered searches over at most this many vectors compute the exact distances to the subset
+# instead of running the index search with an id selector
+EXACT_FILTER_MAX_IDS = 20_000
+
+
+class IdMappedFAISS(FAISS):
+    """
+    FAISS vector store over an index with explicit ids (IndexIDMap2, an IVF index, or a ShardedIndex of
+    them, see index_factory).
+    Every vector gets a stable int64 id, so deleting documents removes their ids directly with
+    remove_ids instead of renumbering the whole store.
+    The index-to-docstore ID mapping is keyed by those ids, and a reverse mapping is kept.
+
+    Dict filters on the fields of the metadata index are applied inside the search, with a faiss
+    IDSelector over the matching ids; other filters are applied to the results, as in FAISS.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.docstore_id_to_index = {doc_id: index_id for index_id, doc_id in self.index_to_docstore_id.items()}
+        self._next_index_id = max(self.index_to_docstore_id, default=-1) + 1
+        # built on the first filtered search
+        self.metadata_index = None
+        self._metadata_index_lock = threading.Lock()
+
+    def get_metadata_index(self) -> MetadataIndex:
+        """
+        Returns the metadata index of the store, building it from the docstore on first use.
+        It is kept up to date by the methods that add and delete vectors afterwards.
+        :return: The MetadataIndex.
+        """
+        if self.metadata_index is None:
+            with self._metadata_index_lock:
+                if self.metadata_index is None:
+                    metadata_index = MetadataIndex()
+                    index_ids, metadatas = [], []
+                    for id_, metadata in self.docstore.iter_metadata():
+                        if id_ in self.docstore_id_to_index:
+                            index_ids.append(self.docstore_id_to_index[id_])
+                            metadatas.append(metadata)
+                    metadata_index.add(index_ids, metadatas)
+                    self.metadata_index = metadata_index
+        return self.metadata_index
+
+    def matches_filter(self, id_: str, filter: dict) -> bool:
+        """
+        :param id_: A docstore id.
+        :param filter: A dict filter on the fields of the metadata index.
+        :return: True if the document has a vector and matches the filter.
+        """
+        index_id = self.docstore_id_to_index.get(id_)
+        return index_id is not None and self.get_metadata_index().matches(index_id, filter)
+
+    def next_index_ids(self, count: int) -> np.ndarray:
+        """
+        Reserves new vector ids.
+        :param count: Number of ids.
+        :return: The ids as an int64 array.
+        """
+        index_ids = np.arange(self._next_index_id, self._next_index_id + count, dtype=np.int64)
+        self._next_index_id += count
+        return index_ids
+
+    def get_index_ids(self, ids: List[str]) -> List[int]:
+        """
+        :param ids: Docstore ids.
+        :return: The vector ids of those documents.
+        """
+        return [self.docstore_id_to_index[id_] for id_ in ids]
+
+    def restore_vectors(self, ids: List[str], vectors, index_ids=None, metadatas: Optional[List[dict]] = None,
+                        shards: Optional[List[int]] = None) -> None:
+        """
+        Adds vectors of documents that are already in the docstore (used when replaying the delta log).
+        :param ids: The docstore ids.
+        :param vectors: The vectors, in the order of the ids.
+        :param index_ids: The vector ids, new ones are reserved when not given.
+        :param metadatas: The metadata of the documents, read from the docstore when not given.
+        :param shards: The keys of the shards the vectors were added to, for a ShardedIndex.
+        :return: None
+        """
+        if not len(ids):
+            return
+        if index_ids is None:
+            index_ids = self.next_index_ids(len(ids))
+        index_ids = np.asarray(index_ids, dtype=np.int64)
+        if shards and isinstance(self.index, ShardedIndex):
+            # the vectors go back to the shards they were in
+            self.index.ensure_shards(shards)
+        make_writable(self.index)
+        self.index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), index_ids)
+        for index_id, id_ in zip(index_ids.tolist(), ids):
+            self.index_to_docstore_id[index_id] = id_
+            self.docstore_id_to_index[id_] = index_id
+        self._next_index_id = max(self._next_index_id, int(index_ids.max()) + 1)
+
+        if self.metadata_index is not None:
+            if metadatas is None:
+                metadatas = [doc.metadata if doc is not None else {} for doc in self.docstore.mget(list(ids))]
+            self.metadata_index.add(index_ids.tolist(), metadatas)
+
+    def swap_index(self, index, index_to_docstore_id: dict) -> None:
+        """
+        Replaces the index and the id mappings, e.g. with a snapshot published by another process.
+        Vector ids never change meaning, so the new ids are mapped before the index is swapped and
+        the removed ones are dropped after it: searches already running on either index can resolve
+        the hits that were not deleted.
+
+        :param index: The new faiss index.
+        :param index_to_docstore_id: Its index-to-docstore ID mapping.
+        :return: None
+        """
+        self.index_to_docstore_id = {**self.index_to_docstore_id, **index_to_docstore_id}
+        self.index = index
+        self.index_to_docstore_id = dict(index_to_docstore_id)
+        self.docstore_id_to_index = {doc_id: index_id for index_id, doc_id in index_to_docstore_id.items()}
+        self._next_index_id = max(self._next_index_id, max(index_to_docstore_id, default=-1) + 1)
+
+        if self.metadata_index is not None:
+            indexed = self.metadata_index.ids()
+            self.metadata_index.delete(indexed - index_to_docstore_id.keys())
+            added = [index_id for index_id in index_to_docstore_id if index_id not in indexed]
+            documents = self.docstore.mget([index_to_docstore_id[index_id] for index_id in added])
+            self.metadata_index.add(added, [doc.metadata if doc is not None else {} for doc in documents])
+
+    def _add_with_ids(self, texts: List[str], embeddings, metadatas: Optional[List[dict]] = None,
+                      ids: Optional[List[str]] = None) -> List[str]:
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        if len(ids) != len(set(ids)):
+            raise ValueError("Duplicate ids found in the ids list.")
+
+        vectors = np.array(embeddings, dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+
+        self.docstore.add({id_: Document(id=id_, page_content=text, metadata=metadata)
+                           for id_, text, metadata in zip(ids, texts, metadatas)})
+        self.restore_vectors(ids, vectors, metadatas=metadatas)
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs) -> List[str]:
+        texts = list(texts)
+        return self._add_with_ids(texts, self._embed_documents(texts), metadatas=metadatas, ids=ids)
+
+    async def aadd_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                         ids: Optional[List[str]] = None, **kwargs) -> List[str]:
+        texts = list(texts)
+        return self._add_with_ids(texts, await self._aembed_documents(texts), metadatas=metadatas, ids=ids)
+
+    def add_embeddings(self, text_embeddings: Iterable[Tuple[str, List[float]]],
+                       metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None,
+                       **kwargs) -> List[str]:
+        texts, embeddings = zip(*text_embeddings)
+        return self._add_with_ids(list(texts), embeddings, metadatas=metadatas, ids=ids)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs) -> Optional[bool]:
+        """
+        Deletes documents by docstore id, in time proportional to the number of ids.
+        Ids without a vector are only removed from the docstore.
+
+        :param ids: The docstore ids to delete.
+        :return: True
+        """
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+
+        index_ids = [self.docstore_id_to_index.pop(id_) for id_ in ids if id_ in self.docstore_id_to_index]
+        if index_ids:
+            # HNSW indexes cannot remove vectors, theirs are tombstoned (see remove_ids)
+            self.index = remove_ids(self.index, np.array(index_ids, dtype=np.int64))
+        for index_id in index_ids:
+            del self.index_to_docstore_id[index_id]
+        if self.metadata_index is not None:
+            self.metadata_index.delete(index_ids)
+        self.docstore.delete(ids)
+        return True
+
+    def _get_documents(self, index_ids) -> List[Optional[Document]]:
+        # one docstore query for all the hits; None for documents deleted since the search
+        doc_ids = [self.index_to_docstore_id.get(int(index_id)) for index_id in index_ids]
+        with span("docstore"):
+            found = self.docstore.mget([doc_id for doc_id in doc_ids if doc_id is not None])
+        documents = iter(found)
+        return [next(documents) if doc_id is not None else None for doc_id in doc_ids]
+
+    def _supports_filter(self, filter) -> bool:
+        # dict filters on indexed fields are applied inside the search
+        return isinstance(filter, dict) and self.get_metadata_index().supports(filter)
+
+    def _filtered_search(self, vector: np.ndarray, k: int, filter: dict) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches only the vectors matching a metadata filter.
+        Small subsets are searched exactly from their stored vectors, which also avoids the recall
+        loss of IVF indexes when few of the probed lists contain matching vectors.
+
+        :param vector: The query vector, of shape (1, d).
+        :param k: Number of results.
+        :param filter: A dict filter on the fields of the metadata index.
+        :return: The (distances, ids) arrays, as returned by index.search.
+        """
+        subset = self.get_metadata_index().select(filter)
+        if len(subset) > EXACT_FILTER_MAX_IDS:
+            selector = faiss.IDSelectorBatch(subset)
+            return self.index.search(vector, k, params=search_parameters(self.index, selector))
+
+        distances = np.full((1, k), np.inf, dtype=np.float32)
+        indices = np.full((1, k), -1, dtype=np.int64)
+        if len(subset):
+            vectors = self.index.reconstruct_batch(subset)
+            subset_distances = ((vectors - vector) ** 2).sum(axis=1)
+            top = np.argsort(subset_distances)[:k]
+            distances[0, :len(top)] = subset_distances[top]
+            indices[0, :len(top)] = subset[top]
+        return distances, indices
+
+    def similarity_search_with_score_by_vector(
+            self, embedding: List[float], k: int = 4, filter: Optional[Union[Callable, Dict[str, Any]]] = None,
+            fetch_k: int = 20, **kwargs: Any) -> List[Tuple[Document, float]]:
+        """
+        Similarity search where dict filters on indexed metadata fields restrict the search itself
+        (see _filtered_search) instead of filtering fetch_k results. Other filters use FAISS' own search.
+
+        :param embedding: The query embedding.
+        :param k: Number of documents to return.
+        :param filter: Optional metadata filter, a dict or a callable taking the metadata.
+        :param fetch_k: Number of results fetched before filtering, for the filters applied to the results.
+        :param kwargs: May contain score_threshold, the maximum L2 distance of the results.
+        :return: The documents with their L2 distance to the query.
+        """
+        if not self._supports_filter(filter):
+            # FAISS' own search, which also reads the documents
+            with span("vector_search"):
+                return super().similarity_search_with_score_by_vector(embedding, k=k, filter=filter,
+                                                                      fetch_k=fetch_k, **kwargs)
+
+        vector = np.array([embedding], dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vector)
+        with span("vector_search"):
+            scores, indices = self._filtered_search(vector, k, filter)
+        found = indices[0] != -1
+        scores, index_ids = scores[0][found], indices[0][found]
+        docs = [(doc, score) for doc, score in zip(self._get_documents(index_ids), scores) if doc is not None]
+
+        score_threshold = kwargs.get("score_threshold")
+        if score_threshold is not None:
+            cmp = (operator.ge if self.distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT,
+                                                              DistanceStrategy.JACCARD) else operator.le)
+            docs = [(doc, score) for doc, score in docs if cmp(score, score_threshold)]
+        return docs
+
+    def max_marginal_relevance_search_with_score_by_vector(
+            self, embedding: List[float], *, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5,
+            filter: Optional[Union[Callable, Dict[str, Any]]] = None) -> List[Tuple[Document, float]]:
+        """
+        Same selection as the LangChain implementation, but the candidate vectors are read with one
+        reconstruct_batch call, the selection is vectorized (see mmr_select) and the documents are
+        read with one docstore query, so large fetch_k values stay cheap. Dict filters on indexed metadata
+        fields restrict the search itself, so the fetch_k candidates all match the filter.
+
+        :param embedding: The query embedding.
+        :param k: Number of documents to return.
+        :param fetch_k: Number of candidates fetched from the index.
+        :param lambda_mult: Between 0 (maximum diversity) and 1 (maximum relevance).
+        :param filter: Optional metadata filter, a dict or a callable taking the metadata.
+        :return: The selected documents with their L2 distance to the query.
+        """
+        vector = np.array([embedding], dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vector)
+        indexed_filter = self._supports_filter(filter)
+        with span("vector_search"):
+            if indexed_filter:
+                scores, indices = self._filtered_search(vector, fetch_k, filter)
+            else:
+                scores, indices = self.index.search(vector, fetch_k if filter is None else fetch_k * 2)
+        # -1 happens when not enough docs are returned
+        found = indices[0] != -1
+        scores, index_ids = scores[0][found], indices[0][found]
+
+        documents = None
+        if filter is not None and not indexed_filter:
+            filter_func = self._create_filter_func(filter)
+            documents = self._get_documents(index_ids)
+            keep = np.array([doc is not None and filter_func(doc.metadata) for doc in documents], dtype=bool)
+            scores, index_ids = scores[keep], index_ids[keep]
+            documents = [doc for doc, kept in zip(documents, keep) if kept]
+        if not len(index_ids):
+            return []
+
+        with span("mmr"):
+            vectors = self.index.reconstruct_batch(index_ids)
+            selected = mmr_select(vector[0], vectors, k=k, lambda_mult=lambda_mult)
+
+        if documents is None:
+            selected_documents = self._get_documents(index_ids[selected])
+        else:
+            selected_documents = [documents[i] for i in selected]
+        return [(doc, scores[i]) for i, doc in zip(selected, selected_documents) if doc is not None]
@@ -0,0 +1,66 @@
+"""
+Throughput benchmark for embedding and indexing chunks during ingestion, against a local fake
+embedding server that rate limits requests above a concurrency limit.
+
+Compares the previous single add_documents call with add_documents_in_batches at several
+batch sizes and concurrency levels. Run from the project root:
+
+    python -m benchmarks.bench_ingestion
+"""
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_openai import run_fake_openai
+
+NUM_CHUNKS = 5000
+# fake server: 300 ms per request + 1 ms per text, 429 above 8 requests in flight
+SERVER_SETTINGS = {"embedding_latency": 0.3, "embedding_latency_per_input": 0.001, "embedding_concurrency_limit": 8}
+CONFIGS = [(256, 1), (256, 4), (128, 8), (64, 16)]
+
+
+def new_vector_store(workdir):
+    from langchain_openai import OpenAIEmbeddings
+    from backend.src.retriever import initialize_vector_store_indexed
+
+    # raw strings are sent to the server and client retries are disabled so the backoff is ours
+    embeddings = OpenAIEmbeddings(check_embedding_ctx_length=False, max_retries=0)
+    return initialize_vector_store_indexed(embeddings, index_path=os.path.join(workdir, "missing_index"))
+
+
+def main():
+    sys.path.insert(0, os.getcwd())
+    workdir = tempfile.mkdtemp(prefix="rag_bench_ingestion_")
+    os.chdir(workdir)
+
+    with run_fake_openai(**SERVER_SETTINGS) as base_url:
+        os.environ["OPENAI_BASE_URL"] = base_url
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+
+        from langchain_core.documents import Document
+        from backend.src.ingestion import add_documents_in_batches
+
+        documents = [Document(page_content=f"Customer: {i}\nNPS Score: {i % 11}", metadata={"file_id": 1})
+                     for i in range(NUM_CHUNKS)]
+        print(f"Embedding and indexing {NUM_CHUNKS} chunks")
+
+        vector_store = new_vector_store(workdir)
+        start = time.perf_counter()
+        vector_store.add_documents(documents)
+        elapsed = time.perf_counter() - start
+        print(f"{'serial add_documents':<32} {elapsed:7.2f} s  {NUM_CHUNKS / elapsed:9.1f} chunks/s")
+
+        for batch_size, max_concurrency in CONFIGS:
+            vector_store = new_vector_store(workdir)
+            start = time.perf_counter()
+            add_documents_in_batches(vector_store, documents, batch_size=batch_size, max_concurrency=max_concurrency,
+                                     backoff_base=0.1)
+            elapsed = time.perf_counter() - start
+            assert vector_store.index.ntotal == NUM_CHUNKS
+            name = f"batch={batch_size} concurrency={max_concurrency}"
+            print(f"{name:<32} {elapsed:7.2f} s  {NUM_CHUNKS / elapsed:9.1f} chunks/s")
+
+
+if __name__ == '__main__':
+    main()
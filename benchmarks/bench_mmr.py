@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of the MMR re-ranking used by the retriever (search_type='mmr').
+
+Compares the LangChain path (one reconstruct and one docstore lookup per candidate, Python
+selection loop) with IdMappedFAISS's vectorized path at several fetch_k values, both for the
+selection step alone and for the whole search. Run from the project root:
+
+    python -m benchmarks.bench_mmr
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+NUM_VECTORS = 20_000
+DIMENSION = 1536
+K = 5
+LAMBDA_MULT = 0.5
+FETCH_KS = [50, 200, 500]
+REPEATS = 20
+
+
+def timed(function, repeats=REPEATS):
+    function()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = function()
+    return (time.perf_counter() - start) * 1000 / repeats, result
+
+
+def new_vector_store(workdir, vectors):
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import FakeEmbeddings
+    from backend.src.docstore import SQLiteDocstore
+    from backend.src.index_factory import create_index
+    from backend.src.vector_store import IdMappedFAISS
+
+    vector_store = IdMappedFAISS(embedding_function=FakeEmbeddings(size=DIMENSION),
+                                 index=create_index("flat", DIMENSION),
+                                 docstore=SQLiteDocstore(os.path.join(workdir, "docstore.db")),
+                                 index_to_docstore_id={})
+    ids = [str(i) for i in range(len(vectors))]
+    vector_store.docstore.add({id_: Document(id=id_, page_content=f"chunk {id_}", metadata={"file_id": 1})
+                               for id_ in ids})
+    vector_store.restore_vectors(ids, vectors)
+    return vector_store
+
+
+def main():
+    sys.path.insert(0, os.getcwd())
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+    from backend.src.mmr import mmr_select
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(NUM_VECTORS, DIMENSION)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    query = vectors[0] + 0.1 * rng.normal(size=DIMENSION).astype(np.float32)
+    vector_store = new_vector_store(tempfile.mkdtemp(prefix="rag_bench_mmr_"), vectors)
+    print(f"{NUM_VECTORS} vectors of dimension {DIMENSION}, k={K}, {REPEATS} repeats")
+
+    print("\nSelection only (ms per query)")
+    print(f"{'fetch_k':>8} {'langchain':>10} {'vectorized':>11} {'speedup':>8}")
+    for fetch_k in FETCH_KS:
+        candidates = vectors[:fetch_k]
+        langchain_ms, expected = timed(lambda: maximal_marginal_relevance(query, list(candidates), LAMBDA_MULT, K))
+        vectorized_ms, selected = timed(lambda: mmr_select(query, candidates, K, LAMBDA_MULT))
+        assert selected == expected
+        print(f"{fetch_k:>8} {langchain_ms:>10.2f} {vectorized_ms:>11.2f} {langchain_ms / vectorized_ms:>7.1f}x")
+
+    print("\nWhole MMR search: index search, vectors, selection and documents (ms per query)")
+    print(f"{'fetch_k':>8} {'langchain':>10} {'vectorized':>11} {'speedup':>8}")
+    for fetch_k in FETCH_KS:
+        search_kwargs = {"k": K, "fetch_k": fetch_k, "lambda_mult": LAMBDA_MULT}
+        langchain_ms, expected = timed(lambda: FAISS.max_marginal_relevance_search_with_score_by_vector(
+            vector_store, query, **search_kwargs))
+        vectorized_ms, results = timed(lambda: vector_store.max_marginal_relevance_search_with_score_by_vector(
+            query, **search_kwargs))
+        assert [doc.id for doc, _ in results] == [doc.id for doc, _ in expected]
+        print(f"{fetch_k:>8} {langchain_ms:>10.2f} {vectorized_ms:>11.2f} {langchain_ms / vectorized_ms:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark of the survey preprocessing of data_processing on synthetic survey CSV files.
+
+Compares the previous row-wise load_and_clean_data (one df.apply(axis=1) per part of the customer
+information) with the vectorized one, and times the streaming SurveyCSVLoader and the chunking of
+the upload path at several file sizes. The row-wise version is skipped above ROW_WISE_MAX_ROWS,
+where it takes minutes. Run from the project root:
+
+    python -m benchmarks.bench_preprocessing
+"""
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROW_COUNTS = [10_000, 100_000, 1_000_000]
+ROW_WISE_MAX_ROWS = 100_000
+NUM_CUSTOMERS = 500
+WORDS = ["slow", "claim", "agent", "great", "price", "manager", "quick", "report", "support", "renewal"]
+
+
+def write_survey_csv(path, num_rows, seed=0):
+    from backend.src.data_processing import SURVEY_COLUMNS
+
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(SURVEY_COLUMNS)
+        for i in range(num_rows):
+            nps_value = rng.randint(0, 10)
+            nps_type = "detrator" if nps_value <= 6 else "neutro" if nps_value <= 8 else "promotor"
+            writer.writerow([f"Customer {i % NUM_CUSTOMERS}", *(rng.randint(1, 5) for _ in range(5)), nps_value,
+                             nps_type, " ".join(rng.choices(WORDS, k=rng.randint(0, 40))),
+                             "" if rng.random() < 0.8 else "Contact the account manager"])
+
+
+def row_wise_load_and_clean_data(file_path):
+    # the previous implementation, kept here as the baseline
+    import pandas as pd
+    from backend.src.data_processing import NPS_TRANSLATION, SURVEY_QUESTIONS
+
+    def create_customer_info(row, info_type, questions):
+        if info_type == "scores":
+            content = "\n".join([f"{questions[col]}: {row[col]}" for col in ["Q1", "Q2", "Q3", "Q4", "Q5"]])
+        elif info_type == "nps_score":
+            content = f"NPS Score: {row['nps_value']}"
+        elif info_type == "nps_type":
+            content = f"NPS Type: {row['nps_type']}"
+        else:
+            content = "Open Responses: " + "\n".join([f"{questions[col]}: {row[col]}" for col in ["Q6", "Q7"]])
+        return pd.Series(content)
+
+    df = pd.read_csv(file_path, delimiter=",")
+    df["nps_type"] = df["nps_type"].map(NPS_TRANSLATION)
+    for info_type in ["scores", "nps_score", "nps_type", "open_responses"]:
+        df[info_type] = df.apply(lambda row: create_customer_info(row, info_type, SURVEY_QUESTIONS), axis=1)
+    df["customer_info"] = df.apply(
+        lambda row: f"Customer: {row['customer']}\nScores: {row['scores']}\nNPS Score: {row['nps_score']}\n"
+                    f"NPS Type: {row['nps_type']}\nOpen Responses: {row['open_responses']}\n", axis=1)
+    return df
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    sys.path.insert(0, os.getcwd())
+    from backend.src.chunking import iter_chunk_batches
+    from backend.src.data_processing import CSV_ENGINE, SurveyCSVLoader, load_and_clean_data
+
+    workdir = tempfile.mkdtemp(prefix="rag_bench_preprocessing_")
+    print(f"CSV engine: {CSV_ENGINE}")
+    print(f"{'rows':>9} {'row-wise':>10} {'vectorized':>11} {'speedup':>8} {'documents':>10} {'chunks':>10}"
+          f" {'rows/s (chunks)':>16}")
+    for num_rows in ROW_COUNTS:
+        path = os.path.join(workdir, f"survey_{num_rows}.csv")
+        write_survey_csv(path, num_rows)
+
+        row_wise = None
+        if num_rows <= ROW_WISE_MAX_ROWS:
+            row_wise, _ = timed(lambda: row_wise_load_and_clean_data(path))
+        vectorized, df = timed(lambda: load_and_clean_data(path))
+        assert len(df) == num_rows
+        documents, count = timed(lambda: sum(1 for _ in SurveyCSVLoader(path).lazy_load()))
+        assert count == num_rows
+        chunking, _ = timed(lambda: sum(len(batch) for batch in iter_chunk_batches(path, 1000, 200)))
+
+        row_wise_text = f"{row_wise:>9.2f}s" if row_wise is not None else f"{'skipped':>10}"
+        speedup_text = f"{row_wise / vectorized:>7.1f}x" if row_wise is not None else f"{'-':>8}"
+        print(f"{num_rows:>9} {row_wise_text} {vectorized:>10.2f}s {speedup_text} {documents:>9.2f}s"
+              f" {chunking:>9.2f}s {num_rows / chunking:>16.0f}")
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
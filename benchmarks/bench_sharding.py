@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of the sharded FAISS index.
+
+Compares the single-query search latency of one flat index with a ShardedIndex holding the same
+vectors split into 1 to 8 shards, searched in parallel and merged with a result heap, at several
+corpus sizes. The results of both are checked to be identical. Run from the project root:
+
+    python -m benchmarks.bench_sharding
+
+The fan-out only pays off with several cores (SHARD_SEARCH_THREADS); on one core the numbers show
+the overhead of the dispatch and the merge.
+"""
+import time
+
+import numpy as np
+
+CORPUS_SIZES = [20_000, 100_000, 200_000]
+SHARD_COUNTS = [1, 2, 4, 8]
+DIMENSION = 1536
+K = 5
+QUERIES = 50
+
+
+def timed_queries(index, queries):
+    index.search(queries[:1], K)
+    start = time.perf_counter()
+    results = [index.search(queries[i:i + 1], K)[1] for i in range(len(queries))]
+    return (time.perf_counter() - start) * 1000 / len(queries), np.vstack(results)
+
+
+def sharded(vectors, num_shards):
+    from backend.src.index_factory import ShardedIndex
+
+    index = ShardedIndex(DIMENSION)
+    ids = np.arange(len(vectors), dtype=np.int64)
+    for shard in np.array_split(np.arange(len(vectors)), num_shards):
+        index.seal(min_vectors=0)
+        index.add_with_ids(vectors[shard], ids[shard])
+    return index
+
+
+def main():
+    from backend.src import index_factory
+    from backend.src.index_factory import create_index
+
+    # one shard per split, whatever its size
+    index_factory.SHARD_MAX_VECTORS = max(CORPUS_SIZES)
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((QUERIES, DIMENSION), dtype=np.float32)
+
+    print(f"Search threads: {index_factory.SHARD_SEARCH_THREADS}")
+    print(f"{'vectors':>9} {'flat':>9}" + "".join(f" {f'{n} shards':>9}" for n in SHARD_COUNTS)
+          + "  (ms per query)")
+    for num_vectors in CORPUS_SIZES:
+        vectors = rng.standard_normal((num_vectors, DIMENSION), dtype=np.float32)
+        flat = create_index("flat", DIMENSION)
+        flat.add_with_ids(vectors, np.arange(num_vectors, dtype=np.int64))
+        flat_ms, expected = timed_queries(flat, queries)
+
+        row = f"{num_vectors:>9} {flat_ms:>9.2f}"
+        for num_shards in SHARD_COUNTS:
+            shard_ms, found = timed_queries(sharded(vectors, num_shards), queries)
+            assert (found == expected).all(), "sharded results differ from the flat index"
+            row += f" {shard_ms:>9.2f}"
+        print(row)
+        del vectors, flat
+
+
+if __name__ == "__main__":
+    main()
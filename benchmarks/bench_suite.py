@@ -0,0 +1,266 @@
+"""
+Offline benchmark suite of the backend, against the local fake OpenAI API (deterministic fake
+embeddings and a fake LLM), so that it runs without network access or API keys.
+
+For each size of synthetic survey CSV it measures, in a fresh process and working directory:
+  - ingestion: rows/s of an upload through the background ingestion job (chunking, embedding, indexing);
+  - save/load: time to write the vector store as a base snapshot and to load it back;
+  - retrieval: p50/p95/p99 latency of a query for every search_type of get_retriever;
+  - chat: throughput and latency of /chat through the FastAPI app at several concurrency levels.
+
+The results are written as JSON; pass a previous results file with --baseline to print the change
+of every metric. Run from the project root:
+
+    python -m benchmarks.bench_suite
+    python -m benchmarks.bench_suite --sizes 1000 10000 --baseline benchmarks/results/<previous>.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks.bench_preprocessing import NUM_CUSTOMERS, write_survey_csv
+from benchmarks.fake_openai import run_fake_openai
+
+ROW_COUNTS = [1_000, 10_000, 50_000]
+RESULTS_DIR = os.path.join("benchmarks", "results")
+# fake server: no embedding latency, so ingestion measures the backend itself
+SERVER_SETTINGS = {"llm_latency": 0.05, "embedding_latency": 0.0}
+QUERIES = 200
+# get_retriever settings by name, "default" is search_type=None
+SEARCH_TYPES = {
+    "default": {"search_type": None},
+    "mmr": {"search_type": "mmr"},
+    "similarity_score_threshold": {"search_type": "similarity_score_threshold", "score_threshold": 0.0},
+    "hybrid": {"search_type": "hybrid"},
+}
+K = 5
+CHAT_CONCURRENCY_LEVELS = [1, 10]
+CHAT_REQUESTS = 50
+# relative change above which --baseline flags a metric
+REGRESSION_THRESHOLD = 0.10
+# metrics where a higher value is better, the others are durations
+HIGHER_IS_BETTER = ("rows_per_s", "requests_per_s")
+
+
+def percentiles(latencies):
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3), "p99_ms": round(float(p99), 3)}
+
+
+def question(i):
+    # distinct questions, so that neither the answer nor the query embedding caches are hit
+    return f"What did Customer {i % NUM_CUSTOMERS} say about the claims process? ({i})"
+
+
+def bench_ingestion(csv_path, num_rows):
+    from backend.src.database_utils import insert_document_record
+    from backend.src.jobs import submit_ingestion_job
+    from backend.src.retriever import get_vector_store
+
+    # created on startup by the app, before any upload
+    get_vector_store()
+    start = time.perf_counter()
+    job = submit_ingestion_job("survey.csv", csv_path, insert_document_record("survey.csv"))
+    job.future.result()
+    elapsed = time.perf_counter() - start
+    if job.status != "succeeded":
+        raise RuntimeError(f"Ingestion job {job.status}: {job.error}")
+    return {"seconds": round(elapsed, 3), "rows_per_s": round(num_rows / elapsed, 1),
+            "chunks": job.chunks_done, "vectors": job.vectors_done}
+
+
+def bench_save_load():
+    from backend.src.retriever import compact_vector_store, get_delta_log, reload_vector_store
+
+    start = time.perf_counter()
+    compact_vector_store()
+    save_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reload_vector_store()
+    load_seconds = time.perf_counter() - start
+
+    snapshot_dir = get_delta_log().base_snapshot()
+    size = sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(snapshot_dir) for name in names)
+    return {"save_seconds": round(save_seconds, 3), "load_seconds": round(load_seconds, 3),
+            "snapshot_mb": round(size / 2 ** 20, 2)}
+
+
+def bench_retrieval(num_queries):
+    from backend.src.retriever import get_retriever, get_vector_store
+
+    vector_store = get_vector_store()
+    # the fake embeddings are random, the threshold search warns on every query about their scores
+    warnings.filterwarnings("ignore", message="Relevance scores must be between")
+    logging.getLogger("langchain_core.vectorstores.base").setLevel(logging.ERROR)
+    results = {}
+    for n, (name, settings) in enumerate(SEARCH_TYPES.items()):
+        try:
+            retriever = get_retriever(vector_store, k=K, **settings)
+            retriever.invoke(question(-1 - n))
+            latencies = []
+            # questions of its own per search type, the query embeddings of the previous ones are cached
+            for i in range(n * num_queries, (n + 1) * num_queries):
+                start = time.perf_counter()
+                retriever.invoke(question(i))
+                latencies.append(time.perf_counter() - start)
+            results[name] = percentiles(latencies)
+        except Exception as e:
+            # recorded rather than raised, so that one broken search type does not hide the others
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+    return results
+
+
+async def run_chat_load(app, concurrency, total_requests):
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def one_request(i):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/chat", json={"question": question(i), "session_id": f"bench-{i}"})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_request(i) for i in range(total_requests)))
+        elapsed = time.perf_counter() - start
+    return {"requests_per_s": round(total_requests / elapsed, 2), **percentiles(latencies)}
+
+
+def bench_chat(total_requests):
+    from backend.main import app
+    from backend.src.database_utils import stop_log_writer
+
+    results = {}
+    for concurrency in CHAT_CONCURRENCY_LEVELS:
+        results[f"concurrency_{concurrency}"] = asyncio.run(run_chat_load(app, concurrency, total_requests))
+    stop_log_writer()
+    return results
+
+
+def run_size(project_root, num_rows, num_queries, chat_requests):
+    """
+    Runs every benchmark on one corpus size. Runs in a process of its own, since the backend keeps
+    its stores in module globals and its files in the working directory.
+
+    :param project_root: The project root, added to sys.path.
+    :param num_rows: Number of rows of the synthetic survey CSV.
+    :param num_queries: Number of queries per search type.
+    :param chat_requests: Number of /chat requests per concurrency level.
+    :return: A dict with the results.
+    """
+    sys.path.insert(0, project_root)
+    workdir = tempfile.mkdtemp(prefix="rag_bench_suite_")
+    os.chdir(workdir)
+
+    with run_fake_openai(**SERVER_SETTINGS) as base_url:
+        os.environ["OPENAI_BASE_URL"] = base_url
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+        from langchain_openai import OpenAIEmbeddings
+        from backend.src import retriever
+
+        # raw strings are sent to the server, the tiktoken encoding files would be downloaded otherwise
+        retriever.OpenAIEmbeddings = functools.partial(OpenAIEmbeddings, check_embedding_ctx_length=False)
+
+        csv_path = os.path.join(workdir, "survey.csv")
+        write_survey_csv(csv_path, num_rows)
+        print(f"[{num_rows} rows] ingestion")
+        results = {"ingestion": bench_ingestion(csv_path, num_rows)}
+        print(f"[{num_rows} rows] save/load")
+        results["persistence"] = bench_save_load()
+        print(f"[{num_rows} rows] retrieval")
+        results["retrieval"] = bench_retrieval(num_queries)
+        print(f"[{num_rows} rows] chat")
+        results["chat"] = bench_chat(chat_requests)
+    return results
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results, baseline):
+    """
+    Prints the relative change of every metric present in both runs, flagging the regressions
+    above REGRESSION_THRESHOLD.
+    """
+    current, previous = flatten(results["sizes"]), flatten(baseline["sizes"])
+    print(f"\nChange against the baseline of {baseline['timestamp']}")
+    for metric in sorted(current.keys() & previous.keys()):
+        if not previous[metric]:
+            continue
+        change = (current[metric] - previous[metric]) / previous[metric]
+        worse = -change if metric.endswith(HIGHER_IS_BETTER) else change
+        flag = "  REGRESSION" if worse > REGRESSION_THRESHOLD else ""
+        print(f"{metric:<60} {previous[metric]:>12} {current[metric]:>12} {change:>+8.1%}{flag}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark suite of the RAG backend.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=ROW_COUNTS, help="Rows of the survey CSVs.")
+    parser.add_argument("--queries", type=int, default=QUERIES, help="Queries per search type.")
+    parser.add_argument("--chat-requests", type=int, default=CHAT_REQUESTS,
+                        help="/chat requests per concurrency level.")
+    parser.add_argument("--output", help="Path of the JSON results (default: benchmarks/results/<timestamp>.json).")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    results = {"timestamp": timestamp, "commit": git_commit(), "python": platform.python_version(),
+               "cpu_count": os.cpu_count(), "settings": {"fake_server": SERVER_SETTINGS, "queries": args.queries,
+                                                         "chat_requests": args.chat_requests, "k": K},
+               "sizes": {}}
+    project_root = os.getcwd()
+    # a fresh interpreter per size, the backend state does not leak from one size to the next
+    context = multiprocessing.get_context("spawn")
+    for num_rows in args.sizes:
+        with context.Pool(1) as pool:
+            results["sizes"][str(num_rows)] = pool.apply(run_size, (project_root, num_rows, args.queries,
+                                                                    args.chat_requests))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{timestamp}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results["sizes"], indent=2))
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
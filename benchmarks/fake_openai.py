@@ -0,0 +1,133 @@
+import asyncio
+import base64
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+# Dimension of the deterministic fake embeddings
+FAKE_EMBEDDING_DIM = 256
+FAKE_ANSWER = "The average NPS score across the surveyed customers is 42, driven mostly by promoters."
+
+
+def fake_embedding(text, dim=FAKE_EMBEDDING_DIM):
+    """
+    Builds a deterministic unit vector for a piece of text (or a list of token ids).
+
+    :param text: The string or token list to embed.
+    :param dim: The dimension of the vector.
+    :return: A float32 numpy array.
+    """
+    seed = int.from_bytes(hashlib.sha256(str(text).encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    vector /= np.linalg.norm(vector)
+    return vector
+
+
+def create_fake_openai_app(llm_latency=0.2, embedding_latency=0.0, dim=FAKE_EMBEDDING_DIM,
+                           embedding_latency_per_input=0.0, embedding_concurrency_limit=None):
+    """
+    Creates a FastAPI app that mimics the subset of the OpenAI API used by the backend
+    (chat completions and embeddings), with configurable latencies.
+
+    :param llm_latency: Seconds each chat completion takes.
+    :param embedding_latency: Seconds each embeddings request takes.
+    :param embedding_latency_per_input: Extra seconds per embedded text in a request.
+    :param dim: Dimension of the returned embeddings.
+    :param embedding_concurrency_limit: If set, embeddings requests above this number in flight
+        get a 429 rate limit response.
+    :return: The FastAPI app.
+    """
+    app = FastAPI(title="Fake OpenAI API")
+    in_flight = {"embeddings": 0}
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+
+        if embedding_concurrency_limit is not None and in_flight["embeddings"] >= embedding_concurrency_limit:
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "requests",
+                                           "code": "rate_limit_exceeded"}},
+                                status_code=429, headers={"retry-after": "0.2"})
+
+        in_flight["embeddings"] += 1
+        try:
+            await asyncio.sleep(embedding_latency + embedding_latency_per_input * len(inputs))
+        finally:
+            in_flight["embeddings"] -= 1
+        # the openai client asks for base64 unless a format is given, which is much cheaper to encode
+        if body.get("encoding_format") == "base64":
+            encode = lambda vector: base64.b64encode(vector.tobytes()).decode("ascii")
+        else:
+            encode = lambda vector: vector.tolist()
+        data = [{"object": "embedding", "index": i, "embedding": encode(fake_embedding(text, dim))}
+                for i, text in enumerate(inputs)]
+        return JSONResponse({"object": "list", "data": data, "model": body.get("model", "fake"),
+                             "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "fake")
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(llm_latency)
+            return JSONResponse({
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": FAKE_ANSWER}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+        tokens = FAKE_ANSWER.split(" ")
+
+        async def event_stream():
+            # spread the generation time evenly over the tokens
+            for i, token in enumerate(tokens):
+                await asyncio.sleep(llm_latency / len(tokens))
+                content = token if i == 0 else f" {token}"
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created,
+                         "model": model,
+                         "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    return app
+
+
+@contextmanager
+def run_fake_openai(port=8765, **app_kwargs):
+    """
+    Runs the fake OpenAI API in a background thread for the duration of the context.
+
+    :param port: Local port to listen on.
+    :param app_kwargs: Keyword arguments forwarded to create_fake_openai_app.
+    :return: The base url to use as OPENAI_BASE_URL.
+    """
+    config = uvicorn.Config(create_fake_openai_app(**app_kwargs), host="127.0.0.1", port=port,
+                            log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}/v1"
+    finally:
+        server.should_exit = True
+        thread.join()
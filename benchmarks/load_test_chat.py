@@ -0,0 +1,114 @@
+"""
+Load test for the /chat endpoint against a local fake OpenAI API.
+
+Compares the async request path of backend.main against the previous blocking
+implementation (synchronous chain.invoke and sqlite calls inside the async handler),
+at several concurrency levels. Run from the project root:
+
+    python -m benchmarks.load_test_chat
+"""
+import asyncio
+import functools
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from benchmarks.fake_openai import run_fake_openai
+
+CONCURRENCY_LEVELS = [1, 10, 50]
+REQUESTS_PER_LEVEL = 100
+LLM_LATENCY = 0.2
+
+
+def build_blocking_app():
+    """
+    Builds an app exposing /chat with the old blocking implementation, used as the baseline.
+    """
+    from backend.src.chain import get_chain
+    from backend.src.database_utils import get_chat_history, insert_application_logs
+    from backend.src.pydantic_models import QueryInput, QueryResponse
+
+    app = FastAPI()
+
+    @app.post("/chat", response_model=QueryResponse)
+    async def chat(query_input: QueryInput) -> QueryResponse:
+        session_id = query_input.session_id or "load-test"
+        chat_history = get_chat_history(session_id)
+        rag_chain = get_chain(query_input.model.value)
+        answer = rag_chain.invoke({"input": query_input.question, "chat_history": chat_history})["answer"]
+        insert_application_logs(session_id=session_id, user_query=query_input.question,
+                                model_response=answer, model=query_input.model.value)
+        return QueryResponse(answer=answer, session_id=session_id, model=query_input.model)
+
+    return app
+
+
+async def run_load(app, concurrency, total_requests):
+    """
+    Sends total_requests questions to the app with at most `concurrency` in flight.
+
+    :return: A tuple (throughput in requests/s, list of latencies in seconds).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None) as client:
+        async def one_request(i):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/chat", json={"question": f"What is the NPS of customer {i % 10}?",
+                                                            "session_id": f"session-{i % concurrency}"})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_request(i) for i in range(total_requests)))
+        elapsed = time.perf_counter() - start
+
+    return total_requests / elapsed, latencies
+
+
+def report(name, concurrency, throughput, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<10} concurrency={concurrency:<4} throughput={throughput:8.2f} req/s "
+          f"p50={statistics.median(latencies) * 1000:8.1f} ms  p95={p95 * 1000:8.1f} ms")
+
+
+def main():
+    # the backend keeps its sqlite database and faiss files in the working directory
+    workdir = tempfile.mkdtemp(prefix="rag_load_test_")
+    sys.path.insert(0, os.getcwd())
+    os.chdir(workdir)
+
+    with run_fake_openai(llm_latency=LLM_LATENCY) as base_url:
+        os.environ["OPENAI_BASE_URL"] = base_url
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+
+        from langchain_core.documents import Document
+        from langchain_openai import OpenAIEmbeddings
+        from backend.src import retriever
+
+        # raw strings are sent to the server, the tiktoken encoding files would be downloaded otherwise
+        retriever.OpenAIEmbeddings = functools.partial(OpenAIEmbeddings, check_embedding_ctx_length=False)
+        from backend.main import app
+        from backend.src.retriever import index_document_to_faiss
+
+        docs = [Document(page_content=f"Customer: {i}\nNPS Score: {i * 7 % 11}") for i in range(100)]
+        index_document_to_faiss(docs, file_id=1)
+
+        print(f"Fake LLM latency: {LLM_LATENCY * 1000:.0f} ms, {REQUESTS_PER_LEVEL} requests per level")
+        for name, target in [("blocking", build_blocking_app()), ("async", app)]:
+            for concurrency in CONCURRENCY_LEVELS:
+                throughput, latencies = asyncio.run(run_load(target, concurrency, REQUESTS_PER_LEVEL))
+                report(name, concurrency, throughput, latencies)
+
+
+if __name__ == '__main__':
+    main()
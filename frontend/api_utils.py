@@ -1,10 +1,18 @@
+import json
+
 import requests
 import streamlit as st
 
-def get_api_response(question, session_id, model="gpt-4o-mini"):
-    # define headers
+# status of the jobs the API does not know
+JOB_NOT_FOUND = "not_found"
+
+def stream_api_response(question, session_id, model="gpt-4o-mini"):
+    """
+    Calls the streaming chat endpoint and yields the answer tokens as they arrive.
+    The session id sent in the final event is stored in the session state.
+    """
     headers = {
-        "accept" : "application/json",
+        "accept": "text/event-stream",
         "Content-Type": "application/json"
     }
 
@@ -17,16 +25,32 @@ def get_api_response(question, session_id, model="gpt-4o-mini"):
         data["session_id"] = session_id
 
     try:
-        response = requests.post("http://localhost:8000/chat", headers=headers, json= data)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            st.error(f"API request failed! Status code {response.status_code}: {response.text}")
-            return None
+        with requests.post("http://localhost:8000/chat/stream", headers=headers, json=data, stream=True) as response:
+            if response.status_code != 200:
+                st.error(f"API request failed! Status code {response.status_code}: {response.text}")
+                return
+
+            response.encoding = "utf-8"
+            event = None
+            # chunk_size=None reads the events as soon as they are received
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if not line:
+                    # a blank line closes the current event
+                    event = None
+                elif line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    payload = json.loads(line[len("data:"):].strip())
+                    if event is None:
+                        yield payload["token"]
+                    elif event == "end":
+                        st.session_state.session_id = payload["session_id"]
+                    elif event == "error":
+                        st.error(f"Error when generating the answer: {payload['detail']}")
 
     except Exception as e:
         st.error(f"Some error occured when calling the chat API: {e}")
-        return None
+
 
 def upload_file (file):
     try:
@@ -35,7 +59,8 @@ def upload_file (file):
         }
         response = requests.post("http://localhost:8000/upload-doc",  files=files )
 
-        if response.status_code == 200:
+        # 202: the file is indexed in the background by the job whose id is returned
+        if response.status_code in (200, 202):
             return response.json()
         else:
             st.error(f"Failed to upload the file! Error {response.status_code}: {response.text}")
@@ -45,3 +70,31 @@ def upload_file (file):
         return None
 
 
+def get_job_status(job_id):
+    """
+    Returns the status and progress of an ingestion job, a JOB_NOT_FOUND status if the API does not
+    know it (e.g. it was restarted or forgot the finished job), or None if it cannot be read.
+    """
+    try:
+        response = requests.get(f"http://localhost:8000/jobs/{job_id}")
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code == 404:
+            return {"job_id": job_id, "status": JOB_NOT_FOUND}
+        return None
+    except Exception:
+        # polled every second, a failed poll is retried by the next one
+        return None
+
+
+def cancel_job(job_id):
+    try:
+        response = requests.post(f"http://localhost:8000/jobs/{job_id}/cancel")
+        if response.status_code == 200:
+            return response.json()
+        else:
+            st.error(f"Failed to cancel the upload! Error {response.status_code}: {response.text}")
+            return None
+    except Exception as e:
+        st.error(f"Some error occured when cancelling the upload: {e}")
+        return None
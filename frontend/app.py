@@ -17,6 +17,10 @@ if "messages" not in st.session_state:
 if "session_id" not in st.session_state:
     st.session_state.session_id = None
 
+if "upload_jobs" not in st.session_state:
+    # ids of the ingestion jobs of the uploaded files, whose progress is shown in the sidebar
+    st.session_state.upload_jobs = []
+
 # Display sidebar
 display_bar_upload_doc()
 # Display chat
@@ -1,7 +1,7 @@
 import streamlit as st
 from click import prompt
 
-from frontend.api_utils import get_api_response, upload_file
+from frontend.api_utils import JOB_NOT_FOUND, cancel_job, get_job_status, stream_api_response, upload_file
 
 
 def display_chat():
@@ -22,20 +22,15 @@ def display_chat():
             # displays the message inside the chat bubble
             st.markdown(prompt)
 
-        with st.spinner("Generating response..."):
-            response = get_api_response(prompt, st.session_state.session_id)
+        # creates the assistant bubble and renders the tokens as they arrive
+        with st.chat_message("assistant"):
+            answer = st.write_stream(stream_api_response(prompt, st.session_state.session_id))
 
-            if response:
-                answer = response["answer"]
-
-                # store the assistant message
-                st.session_state.messages.append({"role": "assistant", "content": answer})
-
-                # Display the assistant message in chat UI
-                with st.chat_message("assistant"):
-                    st.markdown(answer)
-            else:
-                st.error("Error when getting response from the API.")
+        if answer:
+            # store the assistant message
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+        else:
+            st.error("Error when getting response from the API.")
 
 
 def display_bar_upload_doc():
@@ -45,4 +40,36 @@ def display_bar_upload_doc():
     if uploaded_file is not None:
         if st.sidebar.button("Upload"):
             with st.spinner("Uploading file..."):
-                upload_response = upload_file(uploaded_file)
\ No newline at end of file
+                upload_response = upload_file(uploaded_file)
+            if upload_response:
+                # the file is indexed in the background, its progress is shown below
+                st.session_state.upload_jobs.append(upload_response["job_id"])
+
+    with st.sidebar:
+        display_upload_jobs()
+
+
+@st.fragment(run_every=1)
+def display_upload_jobs():
+    # reruns every second on its own, without rerunning the chat
+    for job_id in list(st.session_state.upload_jobs):
+        job = get_job_status(job_id)
+        if job is None:
+            continue
+        if job["status"] in ("queued", "running"):
+            # the number of rows of the file is not known until it is read, so the counts are shown without a bar
+            st.caption(f"{job['filename']}: {job['status']}, {job['rows_done']} rows read, "
+                       f"{job['chunks_done']} chunks, {job['vectors_done']} vectors indexed")
+            if st.button("Cancel", key=f"cancel_{job_id}"):
+                cancel_job(job_id)
+            continue
+        # a finished job shows its final status once and is no longer polled, nor is a job the API forgot
+        st.session_state.upload_jobs.remove(job_id)
+        if job["status"] == JOB_NOT_FOUND:
+            continue
+        if job["status"] == "succeeded":
+            st.toast(f"{job['filename']} indexed: {job['vectors_done']} vectors")
+        elif job["status"] == "cancelled":
+            st.toast(f"{job['filename']}: upload cancelled")
+        elif job["status"] == "failed":
+            st.toast(f"{job['filename']} failed: {job['error']}")
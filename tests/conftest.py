@@ -0,0 +1,57 @@
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+# small vectors, the same text always gets the same one
+EMBEDDING_SIZE = 16
+
+
+@pytest.fixture(scope="session", autouse=True)
+def session_workdir(tmp_path_factory):
+    # modules such as database_utils create their SQLite files in the working directory when imported,
+    # so the tests import them inside fixtures or tests, never at the top of the module
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(tmp_path_factory.mktemp("work"))
+        yield
+
+
+@pytest.fixture
+def embeddings():
+    return DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # a fresh working directory for the stores created by the test
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(scope="session")
+def app_module(session_workdir):
+    # importing the app builds the global vector store, with fake embeddings instead of the OpenAI API
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+        from backend.src import retriever
+        monkeypatch.setattr(retriever, "OpenAIEmbeddings", lambda: DeterministicFakeEmbedding(size=EMBEDDING_SIZE))
+        # the app's watcher would outlive the session directory
+        monkeypatch.setattr(retriever, "INDEX_POLL_INTERVAL", 3600)
+        from backend import main
+    return main
+
+
+@pytest.fixture
+def retriever(workdir, embeddings, monkeypatch):
+    # the global vector store of the retriever module, in a fresh directory and without the watcher thread
+    from backend.src import retriever
+    for name, value in {"_vector_store": None, "_delta_log": None, "_loaded_snapshot": None, "_applied_seq": 0,
+                        "_bm25_index": None, "_compaction_thread": None, "_migration_thread": None}.items():
+        monkeypatch.setattr(retriever, name, value)
+    delta_log = retriever.get_delta_log()
+    monkeypatch.setattr(retriever, "_vector_store",
+                        retriever.initialize_vector_store_indexed(embeddings, delta_log=delta_log))
+    return retriever
+
+
+def make_documents(prefix, count):
+    from langchain_core.documents import Document
+    return [Document(page_content=f"{prefix} {i}", metadata={}) for i in range(count)]
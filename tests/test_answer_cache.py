@@ -0,0 +1,47 @@
+import asyncio
+
+import numpy as np
+
+from backend.src.answer_cache import SemanticAnswerCache, cache_namespace
+from tests.conftest import make_documents
+
+NAMESPACE = cache_namespace("gpt-4o-mini")
+
+
+def test_answers_are_found_by_text_and_by_similar_embedding(embeddings):
+    cache = SemanticAnswerCache()
+    vector = embeddings.embed_query("How are claims handled?")
+    cache.put(NAMESPACE, "How are claims handled?", vector, "quickly", version=1)
+
+    assert cache.get_exact(NAMESPACE, "  how are CLAIMS handled? ", 1) == "quickly"
+    close = np.asarray(vector) + 0.01
+    assert cache.get_similar(NAMESPACE, close.tolist(), 1) == "quickly"
+    assert cache.get_similar(cache_namespace("gpt-4o", {"nps_type": "promoter"}), vector, 1) is None
+
+
+def test_a_new_corpus_version_drops_the_answers(embeddings):
+    cache = SemanticAnswerCache()
+    vector = embeddings.embed_query("How are claims handled?")
+    cache.put(NAMESPACE, "How are claims handled?", vector, "quickly", version=1)
+
+    assert cache.get_exact(NAMESPACE, "How are claims handled?", 2) is None
+    assert len(cache) == 0
+    # an answer computed on the previous version is not stored
+    cache.put(NAMESPACE, "How are claims handled?", vector, "stale", version=1)
+    assert cache.get_similar(NAMESPACE, vector, 2) is None
+
+
+def test_indexing_and_deleting_documents_invalidates_the_cached_answers(retriever, embeddings):
+    cache = SemanticAnswerCache()
+    question = "What did the customers say?"
+    answer, vector = asyncio.run(cache.aget(NAMESPACE, question, embeddings, retriever.get_corpus_version()))
+    assert answer is None
+    cache.put(NAMESPACE, question, vector, "nothing yet", retriever.get_corpus_version())
+    assert cache.get_exact(NAMESPACE, question, retriever.get_corpus_version()) == "nothing yet"
+
+    retriever.index_document_to_faiss(make_documents("row", 3), 1)
+    assert cache.get_exact(NAMESPACE, question, retriever.get_corpus_version()) is None
+
+    cache.put(NAMESPACE, question, vector, "three rows", retriever.get_corpus_version())
+    retriever.delete_doc_from_faiss(1)
+    assert cache.get_exact(NAMESPACE, question, retriever.get_corpus_version()) is None
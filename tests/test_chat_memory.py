@@ -0,0 +1,82 @@
+import asyncio
+import uuid
+
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+
+@pytest.fixture
+def chat_memory(app_module):
+    from backend.src import chat_memory
+    return chat_memory
+
+
+@pytest.fixture
+def summarized(chat_memory, monkeypatch):
+    # the turns sent to the summary model, which answers with a fixed summary
+    calls = []
+
+    def summarize(inputs):
+        calls.append(inputs["turns"])
+        return "summary"
+
+    monkeypatch.setattr(chat_memory, "_summary_chain", RunnableLambda(summarize))
+    return calls
+
+
+def test_short_turns_beyond_a_page_are_kept_until_folded(chat_memory, summarized):
+    page = chat_memory.HISTORY_PAGE_SIZE
+    session_id = str(uuid.uuid4())
+    fold_needed = [chat_memory.add_turn(session_id, turn_id, f"question {turn_id}", f"answer {turn_id}")
+                   for turn_id in range(1, page + 6)]
+
+    # the turns are short, they leave the window by number only
+    assert not any(fold_needed[:page]) and all(fold_needed[page:])
+    session = chat_memory._sessions[session_id]
+    assert len(session.turns) == page + 5
+    assert len(session.messages()) == 2 * page
+
+    asyncio.run(chat_memory.afold_session(session_id))
+
+    # folded down to half a page, starting from the oldest turn
+    folded = page + 5 - page // 2
+    assert "question 1\n" in summarized[0] and f"question {folded}\n" in summarized[0]
+    assert f"question {folded + 1}\n" not in summarized[0]
+    assert session.summarized_id == folded
+    assert [turn[0] for turn in session.turns] == list(range(folded + 1, page + 6))
+    assert session.messages()[0]["content"] == "Summary of the earlier conversation: summary"
+
+
+def test_turns_leave_the_window_when_over_the_token_budget(chat_memory):
+    budget = 300
+    session_id = str(uuid.uuid4())
+    long_answer = "The customer was unhappy with the claim delays. " * 15
+    fold_needed = [chat_memory.add_turn(session_id, turn_id, f"question {turn_id}", long_answer, budget=budget)
+                   for turn_id in range(1, 6)]
+
+    assert fold_needed[0] is False and fold_needed[-1] is True
+    session = chat_memory._sessions[session_id]
+    window = session.turns[session.window_start(budget):]
+    assert 0 < len(window) < len(session.turns)
+    assert sum(turn[3] for turn in window) <= budget
+
+
+def test_failed_fold_keeps_the_turns_and_lets_the_next_one_run(chat_memory, summarized, monkeypatch):
+    session_id = str(uuid.uuid4())
+    for turn_id in range(1, chat_memory.HISTORY_PAGE_SIZE + 2):
+        chat_memory.add_turn(session_id, turn_id, f"question {turn_id}", f"answer {turn_id}")
+    session = chat_memory._sessions[session_id]
+    summary_chain = chat_memory._summary_chain
+
+    def unavailable(inputs):
+        raise RuntimeError("summary model unavailable")
+
+    monkeypatch.setattr(chat_memory, "_summary_chain", RunnableLambda(unavailable))
+    asyncio.run(chat_memory.afold_session(session_id))
+
+    assert not session.folding and session.summarized_id == 0
+    assert len(session.turns) == chat_memory.HISTORY_PAGE_SIZE + 1
+
+    monkeypatch.setattr(chat_memory, "_summary_chain", summary_chain)
+    asyncio.run(chat_memory.afold_session(session_id))
+    assert len(summarized) == 1 and session.summarized_id > 0
@@ -0,0 +1,29 @@
+from langchain_core.documents import Document
+
+from backend.src.context_packing import _SEPARATOR_TOKENS, chunk_tokens, pack_context
+
+MODEL = "gpt-4o-mini"
+ROW = ("Customer: Customer 7 Scores: the manager answered quickly and the claim was paid within two weeks "
+       "NPS Type: promoter Open Responses: keep the same manager for our account next year")
+
+
+def test_overlapping_and_near_duplicate_chunks_are_packed_once():
+    first, second = ROW[:120], ROW[70:]
+    duplicate = first.upper() + " again"
+    documents = [Document(id="1", page_content=first), Document(id="2", page_content=duplicate),
+                 Document(id="3", page_content=second)]
+
+    packed = pack_context(documents, MODEL, token_budget=1000)
+
+    assert [doc.id for doc in packed] == ["1", "3"]
+    # the span of the second chunk already at the end of the first is cut
+    assert packed[1].page_content == ROW[120:].strip()
+    assert documents[2].page_content == second
+
+
+def test_chunks_are_added_while_they_fit_the_token_budget():
+    long, short = Document(id="long", page_content="long answer " * 50), Document(id="short", page_content="short")
+    best = Document(id="best", page_content="the best answer")
+    budget = chunk_tokens(best.page_content, MODEL) + chunk_tokens(short.page_content, MODEL) + 2 * _SEPARATOR_TOKENS
+
+    assert [doc.id for doc in pack_context([best, long, short], MODEL, token_budget=budget)] == ["best", "short"]
@@ -0,0 +1,22 @@
+from backend.src.data_processing import SURVEY_COLUMNS, SurveyCSVLoader, is_survey_csv, iter_survey_frames, \
+    load_and_clean_data
+
+
+def write_survey(path, header):
+    row = ["Customer 1", "9", "8", "", "7", "10", "9", "promotor", "Faster claims", "No"]
+    path.write_text("﻿" + ",".join(header) + "\n" + ",".join(row) + "\n", encoding="utf-8")
+
+
+def test_survey_columns_are_read_from_a_padded_header(tmp_path):
+    path = tmp_path / "survey.csv"
+    write_survey(path, [f" {column} " for column in SURVEY_COLUMNS])
+
+    assert is_survey_csv(str(path))
+    [df] = list(iter_survey_frames(str(path)))
+    assert list(df.columns) == SURVEY_COLUMNS
+    assert df.loc[0, "customer"] == "Customer 1"
+    assert (df.loc[0, "Q3"], df.loc[0, "nps_type"]) == ("", "promoter")
+
+    [document] = SurveyCSVLoader(str(path)).load()
+    assert document.metadata["nps_value"] == 9
+    assert load_and_clean_data(str(path)).loc[0, "customer_info"] == document.page_content
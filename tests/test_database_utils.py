@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def database_utils(tmp_path, monkeypatch):
+    # a fresh database and log writer for each test, the import creates the global tables in the session directory
+    from backend.src import database_utils
+    monkeypatch.setattr(database_utils, "_pool", database_utils.ConnectionPool(str(tmp_path / "app.db")))
+    monkeypatch.setattr(database_utils, "_log_writer", database_utils.LogWriter(batch_size=3))
+    database_utils.create_app_logs()
+    yield database_utils
+    database_utils.stop_log_writer()
+
+
+@pytest.fixture
+def written_batches(database_utils, monkeypatch):
+    # the sizes of the batches written, the first write waits for the release event
+    batches, started, release = [], threading.Event(), threading.Event()
+    write = database_utils.LogWriter._write
+
+    def recorded_write(batch):
+        if not batches:
+            started.set()
+            release.wait()
+        batches.append(len(batch))
+        write(batch)
+
+    monkeypatch.setattr(database_utils.LogWriter, "_write", staticmethod(recorded_write))
+    return batches, started, release
+
+
+def log(database_utils, i, session_id="session"):
+    return database_utils.insert_application_logs(session_id, f"question {i}", f"answer {i}", "gpt-4o-mini")
+
+
+def test_rows_queued_during_a_write_form_the_next_batches(database_utils, written_batches):
+    batches, started, release = written_batches
+    futures = [log(database_utils, 0)]
+    # the writer thread holds the first row until released, the next rows queue up meanwhile
+    started.wait(5)
+    futures += [log(database_utils, i) for i in range(1, 8)]
+    release.set()
+
+    ids = [future.result(timeout=5) for future in futures]
+
+    assert batches == [1, 3, 3, 1]
+    assert ids == sorted(ids) and len(set(ids)) == 8
+
+
+def test_future_resolves_to_the_id_of_the_row(database_utils):
+    log_id = log(database_utils, 1, session_id="other").result(timeout=5)
+    log(database_utils, 2).result(timeout=5)
+
+    with database_utils.get_db_connection() as conn:
+        row = conn.execute("SELECT session_id, user_query FROM app_logs WHERE id = ?", (log_id,)).fetchone()
+    assert tuple(row) == ("other", "question 1")
+    assert database_utils.get_last_turn_id("other") == log_id
+
+
+def test_stop_writes_the_queued_rows_and_a_later_row_restarts_the_writer(database_utils, written_batches):
+    _, started, release = written_batches
+    futures = [log(database_utils, i) for i in range(5)]
+    started.wait(5)
+    # stopped while the rows are still queued behind the first write
+    stopper = threading.Thread(target=database_utils.stop_log_writer)
+    stopper.start()
+    release.set()
+    stopper.join(5)
+
+    assert all(future.done() for future in futures)
+    assert len(database_utils.get_chat_turns("session")) == 5
+    assert database_utils._log_writer._thread is None
+
+    assert log(database_utils, 5).result(timeout=5) > futures[-1].result()
+    assert len(database_utils.get_chat_turns("session")) == 6
+
+
+def test_pool_reuses_its_connections_and_waits_beyond_its_size(database_utils, tmp_path):
+    pool = database_utils.ConnectionPool(str(tmp_path / "pool.db"), size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as again:
+        assert again is first
+
+    borrowed = []
+
+    def borrow():
+        with pool.connection() as conn:
+            borrowed.append(conn)
+
+    with pool.connection() as a, pool.connection() as b:
+        assert a is not b and pool._opened == 2
+        waiter = threading.Thread(target=borrow)
+        waiter.start()
+        waiter.join(0.2)
+        # the third borrower waits for a connection to be returned
+        assert waiter.is_alive()
+    waiter.join(5)
+    assert borrowed[0] in (a, b) and pool._opened == 2
+
+
+def test_transaction_left_open_is_rolled_back(database_utils):
+    with pytest.raises(RuntimeError):
+        with database_utils.get_db_connection() as conn:
+            conn.execute("INSERT INTO app_logs (session_id) VALUES ('lost')")
+            raise RuntimeError("request failed")
+
+    assert database_utils.get_last_turn_id("lost") == 0
@@ -0,0 +1,23 @@
+from langchain_core.documents import Document
+
+from backend.src.docstore import SQLiteDocstore
+
+
+def test_documents_and_file_map_persist_in_sqlite(workdir):
+    docstore = SQLiteDocstore("docs.db")
+    docstore.add({"a": Document(page_content="first", metadata={"file_id": 1}),
+                  "b": Document(page_content="second", metadata={"file_id": 1}),
+                  "c": Document(page_content="third", metadata={"file_id": 2})})
+    docstore.set_index_ids(["a", "b"], [10, 11])
+
+    reopened = SQLiteDocstore("docs.db")
+    assert [doc and doc.page_content for doc in reopened.mget(["c", "missing", "a"])] == ["third", None, "first"]
+    assert reopened.search("b").metadata == {"file_id": 1}
+    assert reopened.search("missing") == "ID missing not found."
+    assert reopened.get_file_chunks(1) == (["a", "b"], [10, 11])
+    assert reopened.ids_missing_index_id() == ["c"]
+
+    reopened.delete(["a", "unknown"])
+    assert len(reopened) == 2
+    assert reopened.get_file_chunks(1) == (["b"], [11])
+    assert dict(reopened.iter_texts(batch_size=1)) == {"b": "second", "c": "third"}
@@ -0,0 +1,110 @@
+import asyncio
+import itertools
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from backend.src import embedding_cache
+from backend.src.embedding_cache import CachedEmbeddings, SQLiteEmbeddingCache
+from tests.conftest import EMBEDDING_SIZE
+
+
+class RecordingEmbeddings(DeterministicFakeEmbedding):
+    # records the texts sent to the model
+    calls: list
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        self.calls.append([text])
+        return super().embed_query(text)
+
+
+@pytest.fixture
+def model():
+    return RecordingEmbeddings(size=EMBEDDING_SIZE, calls=[])
+
+
+@pytest.fixture
+def cache(workdir):
+    return SQLiteEmbeddingCache(str(workdir / "cache.db"))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # a last used time that grows by one at each read, so the LRU order does not depend on the clock
+    ticks = itertools.count(1)
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: next(ticks))
+
+
+def test_only_the_misses_are_embedded_and_the_hits_persist(model, cache, workdir):
+    cached = CachedEmbeddings(model, cache, model_name="fake")
+    expected = DeterministicFakeEmbedding(size=EMBEDDING_SIZE).embed_documents(["a", "b", "c"])
+
+    np.testing.assert_allclose(cached.embed_documents(["a", "b"]), expected[:2], rtol=1e-6)
+    np.testing.assert_allclose(cached.embed_documents(["b", "c", "a"]), [expected[1], expected[2], expected[0]],
+                               rtol=1e-6)
+    assert model.calls == [["a", "b"], ["c"]]
+
+    # a new process finds the vectors on disk
+    reopened = CachedEmbeddings(model, SQLiteEmbeddingCache(str(workdir / "cache.db")), model_name="fake")
+    np.testing.assert_allclose(reopened.embed_documents(["c"]), expected[2:], rtol=1e-6)
+    assert len(model.calls) == 2
+    # another model does not get the vectors of this one
+    CachedEmbeddings(model, cache, model_name="other").embed_documents(["a"])
+    assert model.calls[-1] == ["a"]
+
+
+def test_repeated_misses_are_embedded_once(model, cache):
+    vectors = CachedEmbeddings(model, cache, model_name="fake").embed_documents(["row", "other", "row"])
+
+    assert model.calls == [["row", "other"]]
+    assert vectors[0] == vectors[2]
+
+
+def test_least_recently_used_vectors_are_evicted_past_the_maximum(workdir, clock):
+    cache = SQLiteEmbeddingCache(str(workdir / "cache.db"), max_entries=3)
+    cache.put_many({"a": [1.0], "b": [2.0], "c": [3.0]})
+    cache.get_many(["a"])
+
+    cache.put_many({"d": [4.0]})
+
+    assert len(cache) == 3
+    assert set(cache.get_many(["a", "b", "c", "d"])) == {"a", "c", "d"}
+
+
+def test_queries_are_normalized_and_kept_in_memory(model, cache):
+    cached = CachedEmbeddings(model, cache, model_name="fake", query_cache_size=1)
+
+    vector = cached.embed_query("what  is the\nNPS")
+    assert cached.embed_query("what is the NPS") == vector
+    assert model.calls == [["what is the NPS"]]
+    assert cached.stats()["hits"] == 1
+
+    # evicted from memory by the next query, then read back from SQLite
+    cached.embed_query("another question")
+    assert cached.embed_query("what is the NPS") == pytest.approx(vector)
+    assert len(model.calls) == 2
+
+
+def test_async_path_shares_the_cache(model, cache):
+    cached = CachedEmbeddings(model, cache, model_name="fake")
+
+    async def embed():
+        documents = await cached.aembed_documents(["a", "b", "a"])
+        # the vector of the same text embedded as a document
+        cached_query = await cached.aembed_query("b")
+        return documents, cached_query, await cached.aembed_query("c")
+
+    documents, cached_query, query = asyncio.run(embed())
+
+    # the default async methods of the model run its sync ones
+    assert model.calls == [["a", "b"], ["c"]]
+    assert documents[0] == documents[2]
+    # the vectors read back from SQLite are float32
+    np.testing.assert_allclose(cached_query, documents[1], rtol=1e-6)
+    np.testing.assert_allclose(cached.embed_documents(["c"]), [query], rtol=1e-6)
+    assert len(model.calls) == 2
@@ -0,0 +1,29 @@
+from backend.src import bm25
+from backend.src.bm25 import BM25Index
+from backend.src.hybrid_retriever import reciprocal_rank_fusion
+
+
+def test_bm25_ranks_the_documents_with_the_rare_query_terms_first():
+    index = BM25Index()
+    index.add(["a", "b", "c"], ["the claim was paid late", "Customer Smith liked the claim process",
+                                "the manager answered the claim"])
+
+    assert [doc_id for doc_id, _ in index.search("what did Smith say", k=2)] == ["b"]
+    assert {doc_id for doc_id, _ in index.search("claim", k=3, allowed=lambda doc_id: doc_id != "a")} == {"b", "c"}
+
+
+def test_bm25_deletes_and_reindexes_documents(monkeypatch):
+    monkeypatch.setattr(bm25, "PURGE_RATIO", 0.3)
+    index = BM25Index()
+    index.add([str(i) for i in range(10)], [f"row {i} about claims" for i in range(10)])
+    index.add(["3"], ["row 3 about the Smith account"])
+    # past PURGE_RATIO of deleted slots, the postings are renumbered
+    index.delete(["0", "1", "2", "4", "unknown"])
+
+    assert len(index) == 6
+    assert index.search("Smith", k=3) and index.search("Smith", k=3)[0][0] == "3"
+    assert {doc_id for doc_id, _ in index.search("claims", k=10)} == {"5", "6", "7", "8", "9"}
+
+
+def test_reciprocal_rank_fusion_favours_the_ids_ranked_by_both_lists():
+    assert reciprocal_rank_fusion([["a", "b", "c"], ["c", "d", "b"]]) == ["c", "b", "a", "d"]
@@ -0,0 +1,50 @@
+import faiss
+import numpy as np
+
+from backend.src import index_factory
+from backend.src.index_factory import ShardedIndex, build_index, live_count, read_index, remove_ids, stored_ids, \
+    write_index
+
+DIMENSION = 16
+
+
+def vectors(count, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, DIMENSION), dtype=np.float32)
+
+
+def test_hnsw_removal_tombstones_the_vectors_without_rebuilding(tmp_path):
+    data = vectors(200)
+    index = build_index("hnsw", np.arange(200), data)
+    removed = np.arange(0, 200, 10)
+
+    assert remove_ids(index, removed) is index
+    assert index.ntotal == 200
+    assert live_count(index) == 180
+    assert not np.isin(stored_ids(index), removed).any()
+
+    # searches through a sharded index fill k with live vectors only
+    sharded = ShardedIndex(DIMENSION, {0: index})
+    assert sharded.ntotal == 180
+    _, labels = sharded.search(data[removed], 5)
+    assert (labels >= 0).all() and not np.isin(labels, removed).any()
+
+    write_index(sharded, str(tmp_path / "index"))
+    assert np.array_equal(stored_ids(read_index(str(tmp_path / "index")).shards[0]), stored_ids(index))
+
+
+def test_hnsw_index_is_rebuilt_past_the_tombstone_fraction():
+    index = build_index("hnsw", np.arange(100), vectors(100))
+    index = remove_ids(index, np.arange(int(100 * index_factory.HNSW_REBUILD_TOMBSTONES)))
+    rebuilt = remove_ids(index, [99])
+
+    assert rebuilt is not index
+    assert isinstance(faiss.downcast_index(rebuilt.index), faiss.IndexHNSW)
+    assert rebuilt.ntotal == live_count(rebuilt) == 79
+
+
+def test_removing_the_last_live_vectors_drops_the_hnsw_shard():
+    sharded = ShardedIndex(DIMENSION, {0: build_index("flat", np.arange(10), vectors(10)),
+                                       10: build_index("hnsw", np.arange(10, 20), vectors(10, seed=1))})
+    assert sharded.remove_ids([10, 11]) == 2
+    assert sharded.remove_ids(np.arange(12, 20)) == 8
+    assert list(sharded.shards) == [0]
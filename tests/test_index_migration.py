@@ -0,0 +1,40 @@
+import threading
+
+import numpy as np
+
+from backend.src import index_factory
+from tests.conftest import make_documents
+
+
+def test_migration_is_built_outside_the_lock_and_keeps_the_changes_made_meanwhile(retriever, monkeypatch):
+    monkeypatch.setattr(index_factory, "ANN_MIGRATION_THRESHOLD", 300)
+    monkeypatch.setattr(index_factory, "ANN_INDEX_TYPE", "ivf_flat")
+    started, release = threading.Event(), threading.Event()
+
+    def blocked_build(ids, vectors):
+        started.set()
+        release.wait(10)
+        return index_factory.build_migrated_index(ids, vectors)
+
+    monkeypatch.setattr(retriever, "build_migrated_index", blocked_build)
+    assert retriever.index_document_to_faiss(make_documents("first", 300), 1)
+    assert started.wait(10)
+
+    # the store is not locked while the approximate index is trained
+    vector_store = retriever._vector_store
+    assert retriever.index_document_to_faiss(make_documents("second", 20), 2)
+    assert retriever.index_document_to_faiss(make_documents("third", 10), 3)
+    assert retriever.delete_doc_from_faiss(2)
+    assert vector_store.similarity_search("third 4", k=1)[0].page_content == "third 4"
+
+    release.set()
+    retriever._migration_thread.join()
+
+    [shard] = vector_store.index.shards.values()
+    assert index_factory.get_index_type(shard) == "ivf_flat"
+    expected_ids = sorted(vector_store.index_to_docstore_id)
+    assert np.array_equal(np.sort(index_factory.stored_ids(shard)), expected_ids)
+    assert len(expected_ids) == 310
+    assert vector_store.similarity_search("third 4", k=1)[0].page_content == "third 4"
+    # published with a base snapshot
+    assert retriever.get_delta_log().base_snapshot() is not None
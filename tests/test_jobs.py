@@ -0,0 +1,55 @@
+import pytest
+
+from tests.conftest import make_documents
+
+
+@pytest.fixture
+def jobs(retriever):
+    # indexes into the store of the retriever fixture
+    from backend.src import jobs
+    return jobs
+
+
+def run_job(jobs, tmp_path):
+    upload = tmp_path / "upload.csv"
+    upload.write_text("")
+    job = jobs.submit_ingestion_job("upload.csv", str(upload), 1)
+    job.future.result()
+    return job
+
+
+def test_job_indexes_the_batches(jobs, retriever, tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "iter_chunk_batches", lambda *args: iter([make_documents("row", 3),
+                                                                         make_documents("more", 2)]))
+    job = run_job(jobs, tmp_path)
+
+    assert (job.status, job.error, job.chunks_done, job.vectors_done) == ("succeeded", None, 5, 5)
+    assert retriever._vector_store.index.ntotal == 5
+    assert not (tmp_path / "upload.csv").exists()
+
+
+def test_failed_job_is_rolled_back_and_reports_the_error(jobs, retriever, tmp_path, monkeypatch):
+    def batches(*args):
+        yield make_documents("row", 3)
+        raise ValueError("malformed row 4")
+
+    monkeypatch.setattr(jobs, "iter_chunk_batches", batches)
+    job = run_job(jobs, tmp_path)
+
+    assert job.status == "failed"
+    assert "malformed row 4" in job.error
+    assert retriever._vector_store.index.ntotal == 0
+
+
+def test_cancelled_job_is_rolled_back(jobs, retriever, tmp_path, monkeypatch):
+    def batches(*args):
+        yield make_documents("row", 3)
+        for job in jobs.list_jobs():
+            job.cancel_requested.set()
+        yield make_documents("more", 2)
+
+    monkeypatch.setattr(jobs, "iter_chunk_batches", batches)
+    job = run_job(jobs, tmp_path)
+
+    assert (job.status, job.error) == ("cancelled", None)
+    assert retriever._vector_store.index.ntotal == 0
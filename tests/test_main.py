@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+# seconds spent by each request in the blocking history read and in the llm call
+DELAY = 0.1
+REQUESTS = 8
+
+
+@pytest.fixture
+def main(app_module, monkeypatch, embeddings):
+    main = app_module
+
+    def slow_history(session_id):
+        time.sleep(DELAY)
+        return []
+
+    class SlowChain:
+        async def ainvoke(self, inputs):
+            await asyncio.sleep(DELAY)
+            return {"answer": f"answer to {inputs['input']}"}
+
+    monkeypatch.setattr(main, "get_history_messages", slow_history)
+    monkeypatch.setattr(main, "get_chain", lambda model, filter=None: SlowChain())
+    monkeypatch.setattr(main, "get_vector_store", lambda: SimpleNamespace(embedding_function=embeddings))
+    return main
+
+
+async def post_questions(app, questions):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(*(client.post("/chat", json={"question": question})
+                                      for question in questions))
+
+
+def test_concurrent_chat_requests_do_not_block_each_other(main):
+    questions = [f"question {i}" for i in range(REQUESTS)]
+    start = time.perf_counter()
+    responses = asyncio.run(post_questions(main.app, questions))
+    elapsed = time.perf_counter() - start
+
+    assert [response.json()["answer"] for response in responses] == [f"answer to {q}" for q in questions]
+    # one after the other they would take REQUESTS * 2 * DELAY
+    assert elapsed < REQUESTS * DELAY
+
+
+def test_chat_stream_prepares_and_finishes_the_request_like_chat(main, monkeypatch):
+    from backend.src import jobs
+
+    interactive = []
+    chain_calls = []
+
+    def history(session_id):
+        interactive.append(jobs._interactive_requests)
+        return []
+
+    class StreamingChain:
+        async def astream(self, inputs):
+            chain_calls.append(inputs["input"])
+            for token in ("streamed ", "answer"):
+                yield {"answer": token}
+
+    monkeypatch.setattr(main, "get_history_messages", history)
+    monkeypatch.setattr(main, "get_chain", lambda model, filter=None: StreamingChain())
+
+    async def stream_twice():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return [await client.post("/chat/stream", json={"question": "a streamed question"}) for _ in range(2)]
+
+    first, second = asyncio.run(stream_twice())
+
+    # the history is read while the request holds the ingestion jobs back
+    assert interactive == [1, 1]
+    # the second answer comes from the answer cache filled by the first
+    assert chain_calls == ["a streamed question"]
+    assert 'data: {"token": "streamed "}' in first.text and "event: end" in first.text
+    assert 'data: {"token": "streamed answer"}' in second.text
+
+
+def test_delete_waiting_for_the_store_lock_does_not_block_chat(main, monkeypatch):
+    release = threading.Event()
+
+    def delete_waiting_for_the_lock(file_id):
+        # an ingestion batch holds the store lock
+        release.wait(2)
+        return True
+
+    monkeypatch.setattr(main, "delete_doc_from_faiss", delete_waiting_for_the_lock)
+    monkeypatch.setattr(main, "delete_document_record", lambda file_id: True)
+
+    async def chat_during_delete():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            start = time.perf_counter()
+            delete = asyncio.create_task(client.post("/delete-doc", json={"file_id": 1}))
+            await asyncio.sleep(0.05)
+            chat = await client.post("/chat", json={"question": "asked during a delete"})
+            elapsed = time.perf_counter() - start
+            release.set()
+            return chat, elapsed, await delete
+
+    chat, elapsed, delete = asyncio.run(chat_during_delete())
+    assert chat.status_code == 200 and delete.status_code == 200
+    assert elapsed < 1
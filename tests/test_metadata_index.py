@@ -0,0 +1,30 @@
+import numpy as np
+from langchain_core.documents import Document
+
+from backend.src.metadata_index import MetadataIndex
+
+
+def test_filters_or_the_values_of_a_field_and_and_the_fields():
+    index = MetadataIndex()
+    index.add([1, 2, 3, 4], [{"file_id": 1, "nps_type": "Promoter"}, {"file_id": "2", "nps_type": "detractor"},
+                             {"file_id": 2, "nps_type": " promoter "}, {"file_id": 3}])
+
+    assert index.supports({"file_id": 1}) and not index.supports({"source": "a.csv"})
+    assert np.array_equal(index.select({"file_id": [1, 2]}), [1, 2, 3])
+    assert np.array_equal(index.select({"file_id": [2, 3], "nps_type": "promoter"}), [3])
+    assert index.matches(3, {"nps_type": ["PROMOTER"]}) and not index.matches(4, {"nps_type": "promoter"})
+
+    index.delete([3])
+    assert np.array_equal(index.select({"nps_type": "promoter"}), [1])
+
+
+def test_filtered_search_only_returns_the_matching_chunks(retriever):
+    for file_id in (1, 2):
+        retriever.index_document_to_faiss([
+            Document(page_content=f"file {file_id} answer {i}",
+                     metadata={"nps_type": "promoter" if i % 2 else "detractor"}) for i in range(10)], file_id)
+    vector_store = retriever._vector_store
+
+    found = vector_store.similarity_search("file 1 answer 3", k=4, filter={"file_id": 2, "nps_type": "Promoter"})
+    assert len(found) == 4
+    assert all(doc.metadata["file_id"] == 2 and doc.metadata["nps_type"] == "promoter" for doc in found)
@@ -0,0 +1,111 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+from starlette.responses import StreamingResponse
+
+from backend.src import metrics
+
+STREAM_DELAY = 0.05
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # the metrics created by a test are rendered on their own
+    monkeypatch.setattr(metrics, "_registry", [])
+    return metrics._registry
+
+
+@pytest.fixture
+def request_duration(registry, monkeypatch):
+    histogram = metrics.Histogram("request_seconds", "Requests.", ("method", "route", "status"))
+    monkeypatch.setattr(metrics, "REQUEST_DURATION", histogram)
+    return histogram
+
+
+@pytest.fixture
+def app():
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int):
+        if item_id == 0:
+            raise HTTPException(status_code=404, detail="Item not found")
+        with metrics.span("lookup"):
+            await asyncio.sleep(0.01)
+        return {"id": item_id}
+
+    @app.get("/stream")
+    async def stream():
+        async def chunks():
+            for i in range(3):
+                await asyncio.sleep(STREAM_DELAY)
+                yield f"chunk {i}\n"
+        return StreamingResponse(chunks(), media_type="text/plain")
+
+    return app
+
+
+def get(app, *paths):
+    async def send():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return [await client.get(path) for path in paths]
+    return asyncio.run(send())
+
+
+def test_metrics_are_rendered_in_the_prometheus_text_format(registry):
+    requests = metrics.Counter("requests_total", "Requests.", ("route",))
+    entries = metrics.Gauge("entries", 'Entries of the "cache".')
+    latency = metrics.Histogram("latency_seconds", "Latency.", ("stage",), buckets=(0.1, 1.0))
+    requests.inc(1, "/chat")
+    requests.inc(2, "/chat")
+    requests.inc(1, 'a "quoted"\nroute')
+    entries.set(3.5)
+    for seconds in (0.05, 0.5, 2.0):
+        latency.observe(seconds, "search")
+
+    assert metrics.render() == "\n".join([
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{route="/chat"} 3',
+        'requests_total{route="a \\"quoted\\"\\nroute"} 1',
+        '# HELP entries Entries of the "cache".',
+        "# TYPE entries gauge",
+        "entries 3.5",
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{stage="search",le="0.1"} 1',
+        'latency_seconds_bucket{stage="search",le="1"} 2',
+        'latency_seconds_bucket{stage="search",le="+Inf"} 3',
+        'latency_seconds_sum{stage="search"} 2.55',
+        'latency_seconds_count{stage="search"} 3',
+    ]) + "\n"
+
+
+def test_requests_are_labelled_by_route_template_and_status(app, request_duration):
+    get(app, "/items/1", "/items/2", "/items/0", "/missing")
+
+    counts = {labels: count for labels, (_, _, count) in request_duration._values.items()}
+    assert counts == {("GET", "/items/{item_id}", 200): 2, ("GET", "/items/{item_id}", 404): 1,
+                      ("GET", "unmatched", 404): 1}
+
+
+def test_streamed_response_is_timed_until_its_last_byte(app, request_duration):
+    [response] = get(app, "/stream")
+
+    assert response.text == "chunk 0\nchunk 1\nchunk 2\n"
+    [(_, total, count)] = request_duration._values.values()
+    assert count == 1 and total >= 3 * STREAM_DELAY
+
+
+def test_server_timing_header_lists_the_stages(app, request_duration, monkeypatch):
+    [response] = get(app, "/items/1")
+    stage, duration = response.headers["server-timing"].split(";dur=")
+    assert stage == "lookup" and float(duration) > 5
+
+    monkeypatch.setattr(metrics, "SERVER_TIMING", False)
+    [response] = get(app, "/items/1")
+    assert "server-timing" not in response.headers
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+from backend.src.mmr import mmr_select
+
+
+@pytest.mark.parametrize("lambda_mult", [0.0, 0.25, 0.5, 1.0])
+@pytest.mark.parametrize("seed", range(5))
+def test_selects_the_candidates_of_langchain(seed, lambda_mult):
+    rng = np.random.default_rng(seed)
+    query = rng.standard_normal(16, dtype=np.float32)
+    candidates = rng.standard_normal((50, 16), dtype=np.float32)
+    # near duplicates, which the diversity term has to skip
+    candidates[10:20] = candidates[:10] + 0.01 * rng.standard_normal((10, 16), dtype=np.float32)
+
+    assert mmr_select(query, candidates, k=8, lambda_mult=lambda_mult) == \
+        maximal_marginal_relevance(query, list(candidates), k=8, lambda_mult=lambda_mult)
+
+
+def test_zero_vectors_and_small_candidate_sets():
+    query = np.ones(4, dtype=np.float32)
+    candidates = np.array([[0, 0, 0, 0], [1, 1, 1, 0.9], [1, 0, 0, 0]], dtype=np.float32)
+
+    # the zero vector has a similarity of 0 to everything
+    assert mmr_select(query, candidates, k=3) == maximal_marginal_relevance(query, list(candidates), k=3) == [1, 0, 2]
+    assert mmr_select(query, candidates, k=10) == [1, 0, 2]
+    assert mmr_select(query, candidates[:0], k=4) == []
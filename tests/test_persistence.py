@@ -0,0 +1,91 @@
+import os
+import threading
+
+from backend.src.persistence import DeltaLog
+from tests.conftest import make_documents
+
+
+def reopen(retriever, embeddings):
+    # the store a restarted process loads from the directory: base snapshot, then the pending segments
+    delta_log = DeltaLog(retriever.get_delta_log().store_dir)
+    return retriever.initialize_vector_store_indexed(embeddings, delta_log=delta_log), delta_log
+
+
+def contents(vector_store):
+    return sorted(vector_store.index_to_docstore_id.items()), vector_store.index.ntotal
+
+
+def test_store_is_rebuilt_from_the_delta_log_after_a_crash(retriever, embeddings):
+    retriever.index_document_to_faiss(make_documents("first", 5), 1)
+    retriever.index_document_to_faiss(make_documents("second", 3), 2)
+    retriever.delete_doc_from_faiss(1)
+    delta_log = retriever.get_delta_log()
+    # a segment whose write was interrupted, before its rename
+    with open(os.path.join(delta_log.deltas_dir, f"{delta_log.last_seq + 1:012d}.delta.tmp"), "wb") as f:
+        f.write(b"partial")
+
+    reopened, reopened_log = reopen(retriever, embeddings)
+
+    assert contents(reopened) == contents(retriever._vector_store)
+    assert contents(reopened)[1] == 3
+    assert reopened.similarity_search("second 2", k=1)[0].page_content == "second 2"
+    # replaying the segments again changes nothing
+    reopened_log.replay(reopened)
+    assert contents(reopened) == contents(retriever._vector_store)
+
+
+def test_compaction_interrupted_before_its_commit_is_replayed_then_redone(retriever, embeddings):
+    retriever.index_document_to_faiss(make_documents("first", 5), 1)
+    delta_log = retriever.get_delta_log()
+    # a snapshot left half-written by a crashed compaction, the manifest still points to no base
+    os.makedirs(delta_log.staging_path(delta_log.last_seq))
+    with open(os.path.join(delta_log.staging_path(delta_log.last_seq), "crashed.tmp"), "wb") as f:
+        f.write(b"partial")
+
+    reopened, _ = reopen(retriever, embeddings)
+    assert contents(reopened) == contents(retriever._vector_store)
+
+    retriever.compact_vector_store()
+    assert delta_log.base_snapshot() == delta_log.snapshot_path(delta_log.last_seq)
+    assert "crashed.tmp" not in os.listdir(delta_log.base_snapshot())
+    assert delta_log.pending_segments() == []
+    reopened, _ = reopen(retriever, embeddings)
+    assert contents(reopened) == contents(retriever._vector_store)
+
+
+def test_snapshot_older_than_the_base_is_refused(retriever):
+    retriever.index_document_to_faiss(make_documents("first", 5), 1)
+    retriever.compact_vector_store()
+    delta_log = retriever.get_delta_log()
+    base = delta_log.base_snapshot()
+
+    stale = delta_log.staging_path(delta_log.manifest["base_seq"] - 1)
+    os.makedirs(stale)
+    assert not delta_log.commit_snapshot(delta_log.manifest["base_seq"] - 1, stale)
+    assert delta_log.base_snapshot() == base
+    assert not os.path.exists(stale)
+
+
+def test_chunks_are_embedded_before_the_store_locks_are_taken(retriever, monkeypatch):
+    embedding, release = threading.Event(), threading.Event()
+    embed_documents = retriever.embed_documents
+
+    def slow_embed_documents(embeddings, texts):
+        # e.g. waiting out a rate limit
+        embedding.set()
+        release.wait(5)
+        return embed_documents(embeddings, texts)
+
+    monkeypatch.setattr(retriever, "embed_documents", slow_embed_documents)
+    upload = threading.Thread(target=retriever.index_document_to_faiss, args=(make_documents("row", 3), 1))
+    upload.start()
+    assert embedding.wait(5)
+
+    try:
+        with retriever._store_lock, retriever.get_delta_log().process_lock():
+            # a delete of another file could run meanwhile
+            assert retriever._vector_store.index.ntotal == 0
+    finally:
+        release.set()
+        upload.join()
+    assert retriever._vector_store.index.ntotal == 3
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+
+import httpx
+import pytest
+
+from backend.src import profiling
+
+STACKS = {("thread request", "handler (main.py:1)", "search (retriever.py:10)"): 3,
+          ("thread request", "handler (main.py:1)"): 1}
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    # profiling by admin token only, into a fresh directory
+    monkeypatch.setattr(profiling, "PROFILE_ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0.0)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path / "profiles"))
+    return tmp_path / "profiles"
+
+
+def scope(path="/chat", headers=()):
+    return {"type": "http", "method": "POST", "path": path, "headers": list(headers)}
+
+
+def test_settings_are_read_from_the_environment(monkeypatch):
+    for name in ("PROFILE_SAMPLE_RATE", "PROFILE_ADMIN_TOKEN", "PROFILE_DIR", "PROFILE_MAX_FILES",
+                 "PROFILE_FORMAT", "PROFILE_INTERVAL"):
+        monkeypatch.setattr(profiling, name, getattr(profiling, name))
+    assert not profiling.profiling_enabled()
+
+    profiling.configure_profiling({"PROFILE_SAMPLE_RATE": "0.25", "PROFILE_ADMIN_TOKEN": "secret",
+                                   "PROFILE_DIR": "/var/profiles", "PROFILE_MAX_FILES": "10"})
+
+    assert (profiling.PROFILE_SAMPLE_RATE, profiling.PROFILE_ADMIN_TOKEN, profiling.PROFILE_DIR,
+            profiling.PROFILE_MAX_FILES, profiling.PROFILE_FORMAT) == (0.25, "secret", "/var/profiles", 10,
+                                                                       "speedscope")
+    assert profiling.profiling_enabled()
+
+
+def test_only_the_admin_token_selects_a_request(settings):
+    middleware = profiling.ProfilingMiddleware(app=None)
+
+    assert middleware._wants_profile(scope(headers=[(b"x-profile-token", b"secret")]))
+    assert not middleware._wants_profile(scope(headers=[(b"x-profile-token", b"wrong")]))
+    assert not middleware._wants_profile(scope())
+    # only the routes of PROFILE_ROUTES are profiled
+    assert not middleware._wants_profile(scope(path="/metrics", headers=[(b"x-profile-token", b"secret")]))
+
+
+def test_sample_rate_selects_a_fraction_of_the_requests(settings, monkeypatch):
+    middleware = profiling.ProfilingMiddleware(app=None)
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0.1)
+
+    monkeypatch.setattr(profiling.random, "random", lambda: 0.05)
+    assert middleware._wants_profile(scope())
+    monkeypatch.setattr(profiling.random, "random", lambda: 0.5)
+    assert not middleware._wants_profile(scope())
+
+
+def test_rotation_removes_the_oldest_profiles(tmp_path):
+    for i in range(5):
+        path = tmp_path / f"profile_{i}"
+        path.write_text("")
+        os.utime(path, (1000 + i, 1000 + i))
+
+    profiling._rotate(str(tmp_path), 3)
+
+    assert sorted(os.listdir(tmp_path)) == ["profile_2", "profile_3", "profile_4"]
+
+
+def test_collapsed_output():
+    assert profiling.to_collapsed(STACKS) == ("thread request;handler (main.py:1);search (retriever.py:10) 3\n"
+                                              "thread request;handler (main.py:1) 1\n")
+
+
+def test_speedscope_output():
+    profile = profiling.to_speedscope(STACKS, 0.005, "POST /chat")
+
+    frames = [frame["name"] for frame in profile["shared"]["frames"]]
+    assert frames == ["thread request", "handler (main.py:1)", "search (retriever.py:10)"]
+    sampled = profile["profiles"][0]
+    assert sampled["type"] == "sampled" and sampled["unit"] == "seconds"
+    assert sampled["samples"] == [[0, 1, 2], [0, 1]]
+    assert sampled["weights"] == pytest.approx([0.015, 0.005])
+    assert sampled["endValue"] == pytest.approx(0.02)
+
+
+async def app(scope, receive, send):
+    await asyncio.sleep(0.05)
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+    await send({"type": "http.response.body", "body": b"answer"})
+
+
+def request(token):
+    async def post():
+        transport = httpx.ASGITransport(app=profiling.ProfilingMiddleware(app))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/chat", headers={"X-Profile-Token": token})
+    return asyncio.run(post())
+
+
+@pytest.mark.parametrize("format, extension", [("speedscope", ".speedscope.json"), ("collapsed", ".collapsed")])
+def test_profiled_request_writes_its_profile(settings, monkeypatch, format, extension):
+    monkeypatch.setattr(profiling, "PROFILE_FORMAT", format)
+
+    response = request("secret")
+
+    assert response.text == "answer"
+    path = settings / (response.headers["x-profile"] + extension)
+    content = path.read_text()
+    if format == "speedscope":
+        assert json.loads(content)["profiles"][0]["name"].startswith("POST /chat")
+    else:
+        assert any(line.startswith("thread request;") for line in content.splitlines())
+
+
+def test_profiles_beyond_the_maximum_are_removed(settings, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_MAX_FILES", 2)
+
+    names = [request("secret").headers["x-profile"] for _ in range(3)]
+
+    assert sorted(os.listdir(settings)) == sorted(f"{name}.speedscope.json" for name in names[1:])
+
+
+def test_request_without_the_token_is_not_profiled(settings):
+    response = request("wrong")
+
+    assert response.text == "answer"
+    assert "x-profile" not in response.headers
+    assert not settings.exists()
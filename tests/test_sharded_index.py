@@ -0,0 +1,156 @@
+import pickle
+import threading
+
+import faiss
+import numpy as np
+import pytest
+
+from backend.src import index_factory
+from backend.src.index_factory import ShardedIndex
+from tests.conftest import make_documents
+
+DIMENSION = 16
+
+
+def vectors(count, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, DIMENSION), dtype=np.float32)
+
+
+@pytest.fixture
+def small_shards(monkeypatch):
+    monkeypatch.setattr(index_factory, "SHARD_MAX_VECTORS", 100)
+    monkeypatch.setattr(index_factory, "SHARD_MIN_VECTORS", 50)
+
+
+def layout(index):
+    return {key: shard.ntotal for key, shard in index.shards.items()}
+
+
+def test_shards_roll_over_when_full_and_when_sealed_past_the_minimum(small_shards):
+    index = ShardedIndex(DIMENSION)
+    index.add_with_ids(vectors(100), np.arange(100))
+    index.add_with_ids(vectors(10, seed=1), np.arange(100, 110))
+    assert layout(index) == {0: 100, 100: 10}
+
+    # an upload starting while the open shard is below SHARD_MIN_VECTORS shares it
+    index.seal()
+    index.add_with_ids(vectors(50, seed=2), np.arange(110, 160))
+    assert layout(index) == {0: 100, 100: 60}
+
+    index.seal()
+    index.add_with_ids(vectors(5, seed=3), np.arange(160, 165))
+    assert layout(index) == {0: 100, 100: 60, 160: 5}
+    assert index.shard_keys([5, 120, 164]) == [0, 100, 160]
+
+
+def test_merged_top_k_equals_a_flat_index(small_shards, monkeypatch):
+    monkeypatch.setattr(index_factory, "SHARD_SEARCH_THREADS", 2)
+    data, queries = vectors(350), vectors(20, seed=1)
+    index = ShardedIndex(DIMENSION)
+    for start in range(0, 350, 70):
+        index.seal()
+        index.add_with_ids(data[start:start + 70], np.arange(start, start + 70))
+    assert len(index.shards) > 2
+    flat = faiss.IndexFlatL2(DIMENSION)
+    flat.add(data)
+
+    distances, labels = index.search(queries, 10)
+    expected_distances, expected_labels = flat.search(queries, 10)
+
+    np.testing.assert_array_equal(labels, expected_labels)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-5)
+
+
+def test_shard_is_dropped_once_all_its_vectors_are_deleted(small_shards):
+    index = ShardedIndex(DIMENSION)
+    index.add_with_ids(vectors(100), np.arange(100))
+    index.add_with_ids(vectors(30, seed=1), np.arange(100, 130))
+
+    assert index.remove_ids(np.arange(60)) == 60
+    assert layout(index) == {0: 40, 100: 30}
+    assert index.remove_ids(np.arange(60, 100)) == 40
+    assert layout(index) == {100: 30}
+    # the open shard too, the next vectors start a new one
+    assert index.remove_ids(np.arange(100, 130)) == 30
+    assert layout(index) == {}
+    index.add_with_ids(vectors(5, seed=2), np.arange(130, 135))
+    assert layout(index) == {130: 5}
+
+
+def test_snapshot_round_trip(small_shards, tmp_path):
+    index = ShardedIndex(DIMENSION)
+    index.add_with_ids(vectors(130), np.arange(130))
+    path = str(tmp_path / "index")
+
+    index_factory.write_index(index, path)
+    loaded = index_factory.read_index(path)
+
+    assert isinstance(loaded, ShardedIndex) and layout(loaded) == layout(index)
+    np.testing.assert_array_equal(loaded.reconstruct_batch(np.arange(130)), vectors(130))
+
+
+def test_legacy_single_file_snapshot_becomes_the_first_shard(workdir, embeddings):
+    from langchain_core.documents import Document
+    from backend.src import retriever
+    from backend.src.docstore import SQLiteDocstore
+    texts = [f"legacy {i}" for i in range(4)]
+    # previous versions saved a single flat index with positions as ids
+    legacy = faiss.IndexFlatL2(len(embeddings.embed_query("test")))
+    legacy.add(np.array(embeddings.embed_documents(texts), dtype=np.float32))
+    faiss.write_index(legacy, "legacy.index")
+    with open("legacy.pkl", "wb") as f:
+        pickle.dump({i: f"doc-{i}" for i in range(4)}, f)
+    SQLiteDocstore("docs.db").add({f"doc-{i}": Document(page_content=text) for i, text in enumerate(texts)})
+
+    store = retriever.initialize_vector_store_indexed(embeddings, index_path="legacy.index",
+                                                      id_map_path="legacy.pkl", docstore_db_path="docs.db")
+
+    assert isinstance(store.index, ShardedIndex) and layout(store.index) == {0: 4}
+    assert store.similarity_search("legacy 2", k=1)[0].page_content == "legacy 2"
+
+
+def test_delta_replay_rebuilds_the_same_layout(retriever, embeddings, monkeypatch):
+    from backend.src.persistence import DeltaLog
+    # each upload gets shards of its own
+    monkeypatch.setattr(index_factory, "SHARD_MIN_VECTORS", 1)
+    for file_id, count in [(1, 4), (2, 3), (3, 5)]:
+        retriever.index_document_to_faiss(make_documents(f"file {file_id}", count), file_id)
+    retriever.delete_doc_from_faiss(2)
+
+    reopened = retriever.initialize_vector_store_indexed(
+        embeddings, delta_log=DeltaLog(retriever.get_delta_log().store_dir))
+
+    assert layout(retriever._vector_store.index) == {0: 4, 7: 5}
+    assert layout(reopened.index) == layout(retriever._vector_store.index)
+    assert sorted(reopened.index_to_docstore_id.items()) == sorted(retriever._vector_store.index_to_docstore_id.items())
+
+
+def test_searches_run_safely_while_vectors_are_added():
+    # adds grow the open shard in place, which crashed the searches running on it
+    index = ShardedIndex(64)
+    rng = np.random.default_rng(0)
+    index.add_with_ids(rng.standard_normal((300, 64), dtype=np.float32), np.arange(300))
+    stop, errors = threading.Event(), []
+
+    def search():
+        query = rng.standard_normal((1, 64), dtype=np.float32)
+        try:
+            while not stop.is_set():
+                _, labels = index.search(query, 5)
+                assert (labels >= 0).all()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=search) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for batch in range(1, 200):
+        index.add_with_ids(rng.standard_normal((300, 64), dtype=np.float32), np.arange(batch * 300, (batch + 1) * 300))
+        if batch % 20 == 0:
+            index.remove_ids(np.arange(batch * 300, batch * 300 + 50))
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert index.ntotal == 200 * 300 - 9 * 50
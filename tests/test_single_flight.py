@@ -0,0 +1,135 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backend.src.single_flight import SingleFlight
+
+
+class Interrupted(BaseException):
+    # stands for KeyboardInterrupt or SystemExit in the caller running the call
+    pass
+
+
+def wait_for_followers(flight, count):
+    while flight.coalesced < count:
+        time.sleep(0.001)
+
+
+def run_in_threads(flight, function, count):
+    results = [None] * count
+
+    def call(i):
+        try:
+            results[i] = flight.do("key", function)
+        except BaseException as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_concurrent_calls_run_once_and_share_the_result():
+    flight, release, calls = SingleFlight(), threading.Event(), []
+
+    def function():
+        calls.append(1)
+        release.wait()
+        return "result"
+
+    threads, results = run_in_threads(flight, function, 5)
+    wait_for_followers(flight, 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["result"] * 5
+    assert len(calls) == 1
+    assert len(flight) == 0
+
+
+def test_error_of_the_call_is_raised_to_every_caller():
+    flight, release = SingleFlight(), threading.Event()
+
+    def function():
+        release.wait()
+        raise ValueError("failed")
+
+    threads, results = run_in_threads(flight, function, 3)
+    wait_for_followers(flight, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert all(isinstance(result, ValueError) for result in results)
+    # the failure is not cached, the next call runs again
+    assert len(flight) == 0
+    assert flight.do("key", lambda: "retried") == "retried"
+
+
+def test_interrupted_leader_lets_a_waiting_caller_run_the_call():
+    flight, release, calls = SingleFlight(), threading.Event(), []
+
+    def function():
+        calls.append(1)
+        release.wait()
+        if len(calls) == 1:
+            raise Interrupted()
+        return "result"
+
+    threads, results = run_in_threads(flight, function, 3)
+    wait_for_followers(flight, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    # only the interrupted caller sees the interruption, a follower ran the call again
+    assert sum(isinstance(result, Interrupted) for result in results) == 1
+    assert results.count("result") == 2
+    # the second follower joins the new leader, or runs the call itself if it already finished
+    assert len(calls) in (2, 3)
+    assert len(flight) == 0
+
+
+def test_cancelled_leader_does_not_cancel_the_waiting_callers():
+    async def scenario():
+        flight, calls = SingleFlight(), []
+
+        async def function():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        leader = asyncio.create_task(flight.ado("key", function))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flight.ado("key", function))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower, len(calls), len(flight)
+
+    assert asyncio.run(scenario()) == ("result", 2, 0)
+
+
+def test_cancelled_waiting_caller_does_not_cancel_the_call():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def function():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        leader = asyncio.create_task(flight.ado("key", function))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flight.ado("key", function))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+
+    assert asyncio.run(scenario()) == "result"
@@ -0,0 +1,60 @@
+import pytest
+
+from backend.src import chunking
+from backend.src.persistence import DeltaLog
+from tests.conftest import make_documents
+
+
+def write_csv(path, rows):
+    path.write_text("customer,comment\n" + "".join(f"Customer {i},comment {i}\n" for i in range(rows)))
+
+
+def test_chunk_batches_hold_at_most_batch_rows_rows(tmp_path, monkeypatch):
+    path = tmp_path / "comments.csv"
+    write_csv(path, 25)
+    rows_read = []
+    lazy_load = chunking.CSVLoader.lazy_load
+
+    def counted_lazy_load(loader):
+        for row in lazy_load(loader):
+            rows_read.append(row)
+            yield row
+
+    monkeypatch.setattr(chunking.CSVLoader, "lazy_load", counted_lazy_load)
+    batches = chunking.iter_chunk_batches(str(path), chunk_size=1000, chunk_overlap=0, batch_rows=10)
+
+    first = next(batches)
+    # the rows are read as the batches are consumed, not all at once
+    assert len(first) == len(rows_read) == 10
+    assert [len(batch) for batch in batches] == [10, 5]
+    assert first[0].metadata["customer"] == "Customer 0"
+
+
+def test_failed_later_batch_leaves_no_chunk_of_the_file(retriever, embeddings, monkeypatch):
+    retriever.index_document_to_faiss(make_documents("kept", 2), 1)
+    kept = sorted(retriever._vector_store.index_to_docstore_id.items())
+    embed_documents = retriever.embed_documents
+    calls = []
+
+    def failing_embed_documents(embeddings, texts):
+        calls.append(len(texts))
+        if len(calls) == 3:
+            raise RuntimeError("rate limited")
+        return embed_documents(embeddings, texts)
+
+    monkeypatch.setattr(retriever, "embed_documents", failing_embed_documents)
+    batches = [make_documents("batch 1", 3), make_documents("batch 2", 3), make_documents("batch 3", 3)]
+    with pytest.raises(RuntimeError, match="rate limited"):
+        retriever.index_document_batches_to_faiss(batches, 2)
+
+    # the first two batches were indexed before the third failed
+    assert len(calls) == 3
+    assert sorted(retriever._vector_store.index_to_docstore_id.items()) == kept
+    assert retriever._vector_store.index.ntotal == 2
+    assert retriever._vector_store.docstore.get_file_chunks(2) == ([], [])
+
+    # a restarted process replaying the delta log does not get them back either
+    reopened = retriever.initialize_vector_store_indexed(
+        embeddings, delta_log=DeltaLog(retriever.get_delta_log().store_dir))
+    assert sorted(reopened.index_to_docstore_id.items()) == kept
+    assert reopened.index.ntotal == 2